@@ -86,11 +86,102 @@ TEMPLATES = [
 ASGI_APPLICATION = 'DjangoChat.asgi.application'
 
 # Channel Layer Configuration
-# Using InMemoryChannelLayer as requested (Note: Not suitable for multi-instance production)
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Single process: FastInMemoryChannelLayer.
+# Several worker processes on one host: set CHANNEL_BROKER_SOCKET and run
+# `python manage.py run_channel_broker` next to them (see Procfile).
+CHANNEL_BROKER_SOCKET = os.environ.get('CHANNEL_BROKER_SOCKET')
+
+if CHANNEL_BROKER_SOCKET:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chatix.layers.broker.BrokerChannelLayer",
+            "CONFIG": {
+                "path": CHANNEL_BROKER_SOCKET,
+            },
+        }
+    }
+else:
+    # Drop-in for channels.layers.InMemoryChannelLayer with indexed groups,
+    # bounded queues and stats(); overflow is "error", "drop_oldest" or "drop_newest"
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "chatix.layers.memory.FastInMemoryChannelLayer",
+            "CONFIG": {
+                "capacity": int(os.environ.get('CHANNEL_CAPACITY', '100')),
+                "overflow": os.environ.get('CHANNEL_OVERFLOW', 'error'),
+            },
+        }
     }
+
+# ===============================
+# MESSAGE PERSISTENCE
+# ===============================
+# Write-behind: broadcast first, store messages in bulk_create batches
+CHATIX_WRITE_BEHIND = os.environ.get('CHATIX_WRITE_BEHIND', 'False') == 'True'
+CHATIX_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHATIX_WRITE_BEHIND_BATCH_SIZE', '200'))
+CHATIX_WRITE_BEHIND_INTERVAL = float(os.environ.get('CHATIX_WRITE_BEHIND_INTERVAL', '0.25'))
+# Message ids: 0-15, must differ between processes sharing a database. Unset, each
+# process claims a free id with a lock file in CHATIX_WORKER_LOCK_DIR (one host only)
+CHATIX_WORKER_ID = int(os.environ['CHATIX_WORKER_ID']) if os.environ.get('CHATIX_WORKER_ID') else None
+CHATIX_WORKER_LOCK_DIR = os.environ.get('CHATIX_WORKER_LOCK_DIR', '')
+
+# ===============================
+# PRESENCE
+# ===============================
+# Seconds without a heartbeat before a socket no longer counts as online
+CHATIX_PRESENCE_TIMEOUT = int(os.environ.get('CHATIX_PRESENCE_TIMEOUT', '90'))
+# last_login ("last seen") is written at most once per user per interval
+CHATIX_PRESENCE_WRITE_INTERVAL = int(os.environ.get('CHATIX_PRESENCE_WRITE_INTERVAL', '60'))
+# Read cursors are debounced and written in one batch per interval (seconds)
+CHATIX_READ_WRITE_INTERVAL = float(os.environ.get('CHATIX_READ_WRITE_INTERVAL', '2'))
+
+# ===============================
+# USER SEARCH
+# ===============================
+# In-process autocomplete cache: prefixes kept (0 disables) and seconds before re-query
+CHATIX_USER_SEARCH_CACHE_SIZE = int(os.environ.get('CHATIX_USER_SEARCH_CACHE_SIZE', '1024'))
+CHATIX_USER_SEARCH_CACHE_TTL = int(os.environ.get('CHATIX_USER_SEARCH_CACHE_TTL', '30'))
+
+# ===============================
+# MEMBERSHIP
+# ===============================
+# In-process "user in room" / "room is favorite" answers (0 disables). Changes clear
+# them locally; other worker processes see a removal after at most the TTL (seconds)
+CHATIX_MEMBERSHIP_CACHE_SIZE = int(os.environ.get('CHATIX_MEMBERSHIP_CACHE_SIZE', '10000'))
+CHATIX_MEMBERSHIP_CACHE_TTL = int(os.environ.get('CHATIX_MEMBERSHIP_CACHE_TTL', '30'))
+
+# ===============================
+# CACHES
+# ===============================
+# Rendered chat history chunks (chatix.fragments) and the version counters that
+# invalidate them and answer conditional GETs (chatix.versions). Every worker must
+# see the same counters, so with several processes (the channel broker, or
+# WEB_CONCURRENCY > 1) the default is a file-based cache they all share on this
+# host; a single process keeps a local-memory LRU.
+CHATIX_MULTI_PROCESS = bool(CHANNEL_BROKER_SOCKET) or int(os.environ.get('WEB_CONCURRENCY', '1')) > 1
+CHATIX_FRAGMENT_CACHE_BACKEND = os.environ.get(
+    'CHATIX_FRAGMENT_CACHE_BACKEND',
+    'django.core.cache.backends.filebased.FileBasedCache' if CHATIX_MULTI_PROCESS
+    else 'django.core.cache.backends.locmem.LocMemCache'
+)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'fragments': {
+        'BACKEND': CHATIX_FRAGMENT_CACHE_BACKEND,
+        'LOCATION': os.environ.get(
+            'CHATIX_FRAGMENT_CACHE_LOCATION',
+            '/tmp/chatix-fragments' if CHATIX_FRAGMENT_CACHE_BACKEND.endswith('FileBasedCache')
+            else 'chatix-fragments'
+        ),
+        'TIMEOUT': int(os.environ.get('CHATIX_FRAGMENT_CACHE_TIMEOUT', '600')),
+        # LRU bound per process (local memory) or entries before culling (files)
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CHATIX_FRAGMENT_CACHE_MAX_ENTRIES', '2000')),
+        },
+    },
 }
 
 # ===============================
@@ -101,9 +192,48 @@ import dj_database_url
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-if DATABASE_URL:
+# Threads that run async-side database work (chatix.db); the pool is sized from it
+CHATIX_DB_EXECUTOR_SIZE = int(os.environ.get('CHATIX_DB_EXECUTOR_SIZE', '8'))
+
+# PostgreSQL connection pool (psycopg 3), on unless CHATIX_DB_POOL=False
+CHATIX_DB_POOL = os.environ.get('CHATIX_DB_POOL', 'True') == 'True'
+# Extra connections beyond the executor for sync views and the write flushers
+CHATIX_DB_POOL_HEADROOM = int(os.environ.get('CHATIX_DB_POOL_HEADROOM', '4'))
+
+try:
+    import psycopg_pool
+except ImportError:
+    psycopg_pool = None
+
+
+
+def db_pool_options(executor_size, headroom, environ=os.environ):
+    # One connection per executor thread, plus headroom; never below min_size
+    min_size = int(environ.get('CHATIX_DB_POOL_MIN_SIZE', '2'))
+    return {
+        'min_size': min_size,
+        'max_size': max(executor_size + headroom, min_size),
+        # Seconds a request may wait for a free connection before erroring
+        'timeout': float(environ.get('CHATIX_DB_POOL_TIMEOUT', '10')),
+        # Recycle: replace connections after this age / idle time (seconds)
+        'max_lifetime': float(environ.get('CHATIX_DB_POOL_MAX_LIFETIME', '1800')),
+        'max_idle': float(environ.get('CHATIX_DB_POOL_MAX_IDLE', '300')),
+    }
+
+
+if DATABASE_URL and CHATIX_DB_POOL and psycopg_pool is not None:
+    # Pooled connections are returned after each request / async call, so CONN_MAX_AGE must be 0
     DATABASES = {
-        'default': dj_database_url.config(default=DATABASE_URL, conn_max_age=600)
+        'default': dj_database_url.config(default=DATABASE_URL, conn_max_age=0)
+    }
+    DATABASES['default'].setdefault('OPTIONS', {})['pool'] = db_pool_options(
+        CHATIX_DB_EXECUTOR_SIZE, CHATIX_DB_POOL_HEADROOM
+    )
+    # Pre-ping: Django passes ConnectionPool.check_connection to the pool when this is on
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+elif DATABASE_URL:
+    DATABASES = {
+        'default': dj_database_url.config(default=DATABASE_URL, conn_max_age=600, conn_health_checks=True)
     }
 else:
     # Fallback for local development
@@ -114,6 +244,32 @@ else:
         }
     }
 
+# SQLite high-concurrency mode (opt-in): WAL so readers never wait on the
+# writer, IMMEDIATE transactions + busy_timeout instead of "database is
+# locked", and all chatix writes on one thread (chatix.writelane)
+CHATIX_SQLITE_TUNED = os.environ.get('CHATIX_SQLITE_TUNED', 'False') == 'True' and not DATABASE_URL
+CHATIX_SQLITE_WRITE_LANE = CHATIX_SQLITE_TUNED and os.environ.get('CHATIX_SQLITE_WRITE_LANE', 'True') == 'True'
+
+
+
+def sqlite_tuned_options(environ=os.environ):
+    return {
+        'init_command': (
+            'PRAGMA journal_mode=WAL;'
+            'PRAGMA synchronous=NORMAL;'
+            f"PRAGMA busy_timeout={int(environ.get('CHATIX_SQLITE_BUSY_TIMEOUT_MS', '5000'))};"
+            f"PRAGMA mmap_size={int(environ.get('CHATIX_SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))};"
+            'PRAGMA temp_store=MEMORY;'
+        ),
+        'transaction_mode': 'IMMEDIATE',
+    }
+
+
+if CHATIX_SQLITE_TUNED:
+    DATABASES['default']['OPTIONS'] = sqlite_tuned_options()
+    # Keep connections (and their pragmas) instead of reopening per request
+    DATABASES['default']['CONN_MAX_AGE'] = 600
+
 # ===============================
 # AUTH
 # ===============================
@@ -154,6 +310,36 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are saved under content-hashed names (chatix.storage), which is
+# what lets /media/ answer with immutable, far-future caching headers
+STORAGES = {
+    'default': {'BACKEND': 'chatix.storage.HashedMediaStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Threads that read /media/ files for chatix.media.serve_media
+CHATIX_MEDIA_IO_THREADS = int(os.environ.get('CHATIX_MEDIA_IO_THREADS', '4'))
+
+# Behind nginx, an internal location aliased to MEDIA_ROOT (e.g.
+# '/protected-media/'): /media/ then only checks and answers headers and
+# nginx sends the bytes itself with sendfile
+CHATIX_MEDIA_ACCEL_REDIRECT = os.environ.get('CHATIX_MEDIA_ACCEL_REDIRECT', '')
+
+# ATTACHMENTS (chatix.attachments): kept outside MEDIA_ROOT, /media/ never
+# serves them, only the membership-checked /attachments/<id>/
+CHATIX_ATTACHMENT_ROOT = os.environ.get('CHATIX_ATTACHMENT_ROOT', str(BASE_DIR / 'attachments'))
+CHATIX_ATTACHMENT_MAX_SIZE = int(os.environ.get('CHATIX_ATTACHMENT_MAX_SIZE', str(100 * 1024 * 1024)))
+# Largest PATCH body; under ASGI each chunk is spooled to a temp file before the view sees it
+CHATIX_UPLOAD_CHUNK_SIZE = int(os.environ.get('CHATIX_UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))
+CHATIX_UPLOAD_IO_THREADS = int(os.environ.get('CHATIX_UPLOAD_IO_THREADS', '4'))
+# Unfinished uploads and unsent files are dropped after this (cleanup_attachments)
+CHATIX_UPLOAD_EXPIRY_HOURS = int(os.environ.get('CHATIX_UPLOAD_EXPIRY_HOURS', '24'))
+# Same as CHATIX_MEDIA_ACCEL_REDIRECT, for an internal location aliased to CHATIX_ATTACHMENT_ROOT
+CHATIX_ATTACHMENT_ACCEL_REDIRECT = os.environ.get('CHATIX_ATTACHMENT_ACCEL_REDIRECT', '')
+
+# Background threads that render avatar thumbnails after an upload (chatix.avatars)
+CHATIX_THUMBNAIL_WORKERS = int(os.environ.get('CHATIX_THUMBNAIL_WORKERS', '2'))
+
 CLOUDINARY_STORAGE = {
     'CLOUD_NAME': os.environ.get('CLOUDINARY_CLOUD_NAME'),
     'API_KEY': os.environ.get('CLOUDINARY_API_KEY'),
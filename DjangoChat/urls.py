@@ -16,8 +16,8 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include, re_path
-from django.conf import settings
-from django.views.static import serve
+
+from chatix.media import serve_media
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -25,6 +25,7 @@ urlpatterns = [
 
     # Serve media files in ALL environments (including production)
     # django.conf.urls.static.static() returns empty list when DEBUG=False,
-    # so we use re_path + serve directly to ensure media always works.
-    re_path(r'^media/(?P<path>.*)$', serve, {'document_root': settings.MEDIA_ROOT}),
+    # so the route is always here. serve_media streams from its own threads,
+    # with ETag / Range / immutable caching (see chatix.media).
+    re_path(r'^media/(?P<path>.*)$', serve_media),
 ]
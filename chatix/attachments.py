@@ -0,0 +1,291 @@
+"""
+File attachments.
+
+A file is sent in three steps, so its bytes never ride on the chat socket
+or through the channel layer:
+
+1. POST /chatroom/<id>/uploads/ opens an Upload (name, size and, when the
+   client has it, the file's sha256)
+2. PATCH /uploads/<id>/ with an Upload-Offset header appends one chunk.
+   The body is copied to CHATIX_ATTACHMENT_ROOT/incoming/<id>.part 64 KB at
+   a time on the upload threads, never read whole (no request.body or
+   request.FILES). After a dropped connection, HEAD /uploads/<id>/ says
+   where to carry on.
+3. After the last chunk the file is hashed, checked against the client's
+   sha256 and renamed to CHATIX_ATTACHMENT_ROOT/<sha[:2]>/<sha>. Bytes that
+   are already stored are kept once: the new Attachment shares the Blob and
+   the part file is dropped.
+
+The chat frame then carries only attachment ids. The consumer links them to
+the new message and broadcasts their metadata (name, size, type, URL).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from .media import serve_file
+from .models import Attachment, Blob, Upload
+from .writelane import database_write_to_async
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+
+ATTACHMENT_SNIPPET = "📎 Attachment"
+
+# Shown in the browser rather than downloaded; anything else (HTML, SVG...) never is
+INLINE_CONTENT_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+ATTACHMENT_CACHE_CONTROL = "private, max-age=31536000, immutable"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CHATIX_UPLOAD_IO_THREADS", 4),
+                thread_name_prefix="chatix-uploads",
+            )
+        return _executor
+
+
+async def _run(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+
+
+def max_attachment_size():
+    return getattr(settings, "CHATIX_ATTACHMENT_MAX_SIZE", 100 * 1024 * 1024)
+
+
+def upload_chunk_size():
+    return getattr(settings, "CHATIX_UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024)
+
+
+# =========================
+# PATHS
+# =========================
+
+def attachment_root():
+    return str(getattr(settings, "CHATIX_ATTACHMENT_ROOT", settings.BASE_DIR / "attachments"))
+
+
+def part_path(upload_id):
+    return os.path.join(attachment_root(), "incoming", f"{upload_id}.part")
+
+
+def blob_name(sha256):
+    """Where a blob lives, relative to the attachment root"""
+    return f"{sha256[:2]}/{sha256}"
+
+
+# =========================
+# METADATA
+# =========================
+
+def serialize_attachment(attachment):
+    """What chat frames and history carry instead of the file"""
+    return {
+        "id": attachment.id,
+        "filename": attachment.filename,
+        "size": attachment.size,
+        "content_type": attachment.content_type,
+        "url": reverse("attachment_file", args=[attachment.id]),
+    }
+
+
+def link_attachments(msg, attachment_ids):
+    """
+    Hang the sender's not yet sent uploads in this room on msg (inside the
+    message's transaction) and return their metadata.
+    """
+    Attachment.objects.filter(
+        id__in=attachment_ids[:MAX_ATTACHMENTS_PER_MESSAGE],
+        uploader_id=msg.sender_id,
+        chatroom_id=msg.chatroom_id,
+        message__isnull=True,
+    ).update(message=msg)
+    return [serialize_attachment(a) for a in msg.attachments.order_by("id")]
+
+
+# =========================
+# UPLOADS
+# =========================
+
+async def aappend_chunk(upload, stream, offset, length):
+    """
+    Write length bytes of stream at offset (the upload's current offset) and
+    return the new offset. None when another request moved the upload on
+    first, or its part file is gone.
+    """
+    written = await _run(_write_chunk, stream, part_path(upload.id), offset, length)
+    if written is None:
+        return None
+
+    new_offset = offset + written
+    # Only from where we started: two racing copies of a chunk advance it once
+    moved = await database_write_to_async(_advance)(upload.id, offset, new_offset)
+    return new_offset if moved else None
+
+
+def _write_chunk(stream, path, offset, length):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        part = open(path, "r+b")
+    except FileNotFoundError:
+        if offset:
+            return None
+        part = open(path, "wb")
+
+    with part:
+        if part.seek(0, os.SEEK_END) < offset:
+            return None
+        part.seek(offset)
+        written = 0
+        while written < length:
+            chunk = stream.read(min(COPY_CHUNK_SIZE, length - written))
+            if not chunk:
+                break  # client went away, it resumes from HEAD
+            part.write(chunk)
+            written += len(chunk)
+        # Drop whatever an earlier, interrupted try left after this chunk
+        part.truncate()
+    return written
+
+
+def _advance(upload_id, offset, new_offset):
+    return Upload.objects.filter(id=upload_id, offset=offset).update(offset=new_offset)
+
+
+async def afinish_upload(upload):
+    """
+    Hash the complete file, store it (once per content) and return its
+    Attachment, or None when it does not match the sha256 the client sent.
+    """
+    path = part_path(upload.id)
+    sha256 = await _run(_hash_file, path)
+
+    if upload.sha256 and upload.sha256 != sha256:
+        logger.warning("Upload %s hashed to %s, client said %s", upload.id, sha256, upload.sha256)
+        await _run(_remove, path)
+        await database_write_to_async(Upload.objects.filter(id=upload.id).delete)()
+        return None
+
+    return await database_write_to_async(_store_attachment)(upload, path, sha256)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as part:
+        for chunk in iter(lambda: part.read(COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _move_to_blob(path, sha256):
+    target = os.path.join(attachment_root(), blob_name(sha256))
+    if os.path.exists(target):
+        # Same bytes already stored
+        os.remove(path)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(path, target)  # a rename, the bytes are not copied
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _store_attachment(upload, path, sha256):
+    """
+    Move the part file to its blob and create the Attachment. The Blob row is
+    created or locked before the file is looked at, so purge_stale_attachments
+    cannot remove a blob between the dedup check and the new attachment.
+    """
+    with transaction.atomic():
+        blob, _ = Blob.objects.select_for_update().get_or_create(sha256=sha256, defaults={"size": upload.size})
+        _move_to_blob(path, sha256)
+        attachment = Attachment.objects.create(
+            chatroom_id=upload.chatroom_id,
+            uploader_id=upload.user_id,
+            blob=blob,
+            filename=upload.filename,
+            content_type=upload.content_type,
+            size=blob.size,
+        )
+        Upload.objects.filter(id=upload.id).delete()
+    return attachment
+
+
+# =========================
+# DOWNLOADS
+# =========================
+
+async def serve_attachment(request, attachment):
+    """Stream an attachment's blob (the caller has checked access)"""
+    inline = attachment.content_type in INLINE_CONTENT_TYPES
+    return await serve_file(
+        request, attachment_root(), blob_name(attachment.blob.sha256),
+        digest=attachment.blob.sha256,
+        cache_control=ATTACHMENT_CACHE_CONTROL,
+        accel=getattr(settings, "CHATIX_ATTACHMENT_ACCEL_REDIRECT", ""),
+        content_type=attachment.content_type,
+        extra_headers={
+            "Content-Disposition": content_disposition_header(not inline, attachment.filename),
+            "X-Content-Type-Options": "nosniff",
+        },
+    )
+
+
+# =========================
+# CLEANUP
+# =========================
+
+def purge_stale_attachments(max_age=None):
+    """
+    Forget uploads nobody finished, uploaded files nobody sent and blobs no
+    attachment uses any more. Returns the three counts.
+    """
+    if max_age is None:
+        max_age = timedelta(hours=getattr(settings, "CHATIX_UPLOAD_EXPIRY_HOURS", 24))
+    cutoff = timezone.now() - max_age
+
+    uploads = list(Upload.objects.filter(updated_at__lt=cutoff).values_list("id", flat=True))
+    for upload_id in uploads:
+        _remove(part_path(upload_id))
+    Upload.objects.filter(id__in=uploads).delete()
+
+    unsent, _ = Attachment.objects.filter(message__isnull=True, created_at__lt=cutoff).delete()
+
+    orphans = Blob.objects.filter(attachments__isnull=True, created_at__lt=cutoff).values_list("id", flat=True)
+    blobs = 0
+    for blob_id in list(orphans):
+        # One at a time under the row lock uploads take (_store_attachment), and
+        # the file goes before the lock does: a blob just reused keeps its file
+        with transaction.atomic():
+            blob = Blob.objects.select_for_update().filter(id=blob_id).first()
+            if blob is None or Attachment.objects.filter(blob_id=blob_id).exists():
+                continue
+            blob.delete()
+            _remove(os.path.join(attachment_root(), blob_name(blob.sha256)))
+        blobs += 1
+
+    return len(uploads), unsent, blobs
@@ -0,0 +1,147 @@
+"""
+Avatar thumbnails.
+
+Uploaded profile pictures are full-size originals, while the pages show
+them at 24-120 px. After an upload commits, a worker thread renders square
+WebP copies (JPEG where Pillow has no WebP) at AVATAR_SIZES next to the
+original, e.g. profile_images/thumbs/me_96.webp, and records their names in
+UserInfo.thumbnails. avatar_url() then hands out the smallest copy that is
+at least as large as asked for, and the original until the copies exist.
+"""
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps, UnidentifiedImageError, features
+
+from .models import InboxEntry, UserInfo
+
+logger = logging.getLogger(__name__)
+
+# 2x the largest CSS size each one serves: bubbles, cards / navbar, settings page
+AVATAR_SIZES = (48, 96, 256)
+
+# What the JSON / socket payloads ask for: chat bubbles, and the people lists
+BUBBLE_AVATAR_SIZE = 48
+LIST_AVATAR_SIZE = 96
+
+_FORMAT, _EXTENSION = ("WEBP", "webp") if features.check("webp") else ("JPEG", "jpg")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CHATIX_THUMBNAIL_WORKERS", 2),
+                thread_name_prefix="chatix-thumbs",
+            )
+        return _executor
+
+
+# =========================
+# URLS
+# =========================
+
+def avatar_url(info, size):
+    """URL of info's avatar for a size x size box, or None without a picture"""
+    if info is None or not info.image:
+        return None
+
+    thumbnails = info.thumbnails or {}
+    for candidate in AVATAR_SIZES:
+        if candidate >= size and str(candidate) in thumbnails:
+            return info.image.storage.url(thumbnails[str(candidate)])
+
+    try:
+        return info.image.url
+    except ValueError:
+        return None
+
+
+# =========================
+# GENERATION
+# =========================
+
+def schedule_thumbnails(info):
+    """Render info's thumbnails in the background once the upload is committed"""
+    if not info.image:
+        return
+    info_id, name = info.id, info.image.name
+    transaction.on_commit(lambda: _get_executor().submit(_generate_logged, info_id, name))
+
+
+def _generate_logged(info_id, name):
+    close_old_connections()
+    try:
+        generate_thumbnails(info_id, name)
+    except Exception:
+        logger.exception("Thumbnails failed for UserInfo %s (%s)", info_id, name)
+    finally:
+        close_old_connections()
+
+
+def generate_thumbnails(info_id, name):
+    """
+    Render and store every size of one original, then point the row at
+    them. Returns False when the row has moved on to another picture.
+    """
+    from .writelane import run_write
+
+    storage = UserInfo._meta.get_field("image").storage
+    with storage.open(name, "rb") as original:
+        try:
+            image = Image.open(io.BytesIO(original.read()))
+            image = ImageOps.exif_transpose(image)
+        except (UnidentifiedImageError, OSError):
+            logger.warning("Not an image, no thumbnails for %s", name)
+            return False
+
+    image = image.convert("RGBA" if _FORMAT == "WEBP" and image.mode in ("RGBA", "LA", "P") else "RGB")
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    folder = os.path.join(os.path.dirname(name), "thumbs")
+    thumbnails = {}
+    for size in AVATAR_SIZES:
+        thumb = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        thumb.save(buffer, _FORMAT, quality=82)
+        thumbnails[str(size)] = storage.save(
+            os.path.join(folder, f"{stem}_{size}.{_EXTENSION}"), ContentFile(buffer.getvalue())
+        )
+
+    return run_write(_store_thumbnails, info_id, name, thumbnails)
+
+
+def _store_thumbnails(info_id, name, thumbnails):
+    # Only if the row still shows the picture these were made from
+    with transaction.atomic():
+        updated = UserInfo.objects.filter(id=info_id, image=name).update(thumbnails=thumbnails)
+        if updated:
+            _avatar_changed(info_id)
+    return bool(updated)
+
+
+def _avatar_changed(info_id):
+    from .directory import invalidate_user_directory
+    from .services import publish_room_changed
+    from .versions import bump_inbox_versions, bump_room_versions
+
+    user_id = UserInfo.objects.values_list("user_id", flat=True).get(id=info_id)
+    room_ids = list(
+        InboxEntry.objects.filter(user_id=user_id).values_list("chatroom_id", flat=True)
+    )
+
+    # Cached pages and open sockets still carry the original's URL
+    bump_room_versions(room_ids)
+    bump_inbox_versions([user_id, *InboxEntry.objects.filter(peer_id=user_id).values_list("user_id", flat=True)])
+    invalidate_user_directory()
+    transaction.on_commit(lambda: publish_room_changed(room_ids, user_id=user_id))
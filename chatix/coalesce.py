@@ -0,0 +1,91 @@
+"""
+Keyed write coalescing.
+
+CoalescingWriter keeps only the latest value per key and hands everything
+that changed to one write_batch(dict) call every ``interval`` seconds, so a
+user who is active all minute costs one row in one UPDATE instead of one
+UPDATE per event.
+"""
+import asyncio
+import atexit
+import logging
+import threading
+
+from .writelane import database_write_to_async
+
+
+logger = logging.getLogger(__name__)
+
+
+class CoalescingWriter:
+
+    def __init__(self, name, write_batch, interval, merge=None):
+        self.name = name
+        self.write_batch = write_batch  # callable(dict key -> value), runs in a DB thread
+        self.interval = interval
+        self.merge = merge              # callable(old, new) -> kept value; default keeps new
+
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._task = None
+        self._loop = None
+        atexit.register(self._flush_at_exit)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+        self._ensure_flusher()
+
+    def _put(self, key, value):
+        if self.merge is not None and key in self._pending:
+            value = self.merge(self._pending[key], value)
+        self._pending[key] = value
+
+    # ---------- FLUSHING ----------
+
+    def _ensure_flusher(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # sync caller: picked up by the next flusher or at exit
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._pending:
+                continue
+            try:
+                await database_write_to_async(self.flush)()
+            except Exception:
+                logger.exception("%s flush failed, %d keys kept for retry", self.name, len(self._pending))
+
+    def flush(self):
+        """Write everything pending now; on failure it is kept for the next round"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        try:
+            self.write_batch(batch)
+        except Exception:
+            with self._lock:
+                # Values that arrived meanwhile are newer than the failed ones
+                newer, self._pending = self._pending, batch
+                for key, value in newer.items():
+                    self._put(key, value)
+            raise
+
+    def _flush_at_exit(self):
+        if not self._pending:
+            return
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("%s lost %d keys at shutdown", self.name, len(self._pending))
@@ -1,7 +1,37 @@
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from django.core.exceptions import ObjectDoesNotExist
 import json
+from urllib.parse import parse_qs
+
+from .attachments import ATTACHMENT_SNIPPET, MAX_ATTACHMENTS_PER_MESSAGE
+from .db import database_sync_to_async
+from .membership import ais_member
+from .presence import aonline_user_ids, apresence_connect, apresence_disconnect, presence, presence_group
+from .receipts import read_cursors
+from .services import EmptyMessage, clean_message_content
+from .writebehind import get_write_behind, write_behind_enabled
+from .writelane import database_write_to_async
+
+
+# =====================
+# PRESENCE
+# =====================
+
+async def presence_connected(channel_layer, user_id):
+    if await apresence_connect(channel_layer, user_id):
+        await channel_layer.group_send(presence_group(user_id), {
+            "type": "presence_update",
+            "user_id": user_id,
+            "online": True,
+        })
+
+
+async def presence_disconnected(channel_layer, user_id):
+    if await apresence_disconnect(channel_layer, user_id):
+        await channel_layer.group_send(presence_group(user_id), {
+            "type": "presence_update",
+            "user_id": user_id,
+            "online": False,
+        })
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
@@ -15,9 +45,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         self.room_id = self.scope['url_route']['kwargs']['room_id']
         self.room_group_name = f'chat_{self.room_id}'
+        self.last_read_id = 0
+        self.newest_message_id = 0  # newest chat frame delivered on this socket
 
-        room_exists = await self.room_exists(self.room_id)
-        if not room_exists:
+        # 🔒 Participants only. Asked of the database: the socket outlives any
+        # request, and a removal made on another worker never reaches our cache
+        if not await ais_member(self.room_id, self.user.id, fresh=True):
+            await self.close()
+            return
+
+        # Room name, participants and our avatar, cached for the whole connection
+        self.room_context = await self.load_room_context(self.room_id)
+        if self.room_context is None:
             await self.close()
             return
 
@@ -28,7 +67,34 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         await self.accept()
 
+        # 🟢 PRESENCE: count us online, watch the other participants
+        self.watched_user_ids = [
+            pid for pid in self.room_context["participant_ids"] if pid != self.user.id
+        ]
+        for pid in self.watched_user_ids:
+            await self.channel_layer.group_add(presence_group(pid), self.channel_name)
+        await presence_connected(self.channel_layer, self.user.id)
+
+        online = await aonline_user_ids(self.channel_layer, self.watched_user_ids)
+        for pid in self.watched_user_ids:
+            await self.send(json.dumps({
+                "type": "presence",
+                "user_id": pid,
+                "online": pid in online,
+            }))
+
+        # 🔁 Reconnect: catch up from ?since_message_id=<id>
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        since = query.get("since_message_id", [None])[0]
+        if since:
+            await self.send_resume(since)
+
     async def disconnect(self, close_code):
+        if hasattr(self, "watched_user_ids"):
+            await presence_disconnected(self.channel_layer, self.user.id)
+            for pid in self.watched_user_ids:
+                await self.channel_layer.group_discard(presence_group(pid), self.channel_name)
+
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -36,53 +102,70 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     async def receive(self, text_data):
         data = json.loads(text_data)
-        message = data.get("message")
-        
+
+        # 💓 Keep-alive frames only refresh presence
+        if data.get("type") == "heartbeat":
+            presence.heartbeat(self.user.id)
+            return
+
+        # 🔁 Catch-up request sent as the first frame instead of in the URL
+        if data.get("type") == "resume":
+            await self.send_resume(data.get("since_message_id"))
+            return
+
+        # 👀 Read cursor: receipt to the room now, DB write debounced
+        if data.get("type") == "read":
+            await self.mark_read(data.get("message_id"))
+            return
+
+        # 📎 Ids of files already uploaded over HTTP (chatix.attachments), never the bytes
+        attachment_ids = self.parse_attachment_ids(data.get("attachments"))
+
+        # Frames without storable text are dropped; the socket stays open
+        message = clean_message_content(data.get("message"), bool(attachment_ids))
+        if message is None:
+            return
+
         # Use authenticated user from scope, ignore "sender" in payload for security
         sender_user = self.user
         sender_username = sender_user.username
+        presence.heartbeat(sender_user.id)
 
-        room = await self.get_room_safe(self.room_id)
+        context = self.room_context
+        result = None
+        if context is not None and write_behind_enabled() and not attachment_ids:
+            # Broadcast now, the INSERT happens in the next batch flush
+            result = get_write_behind().submit(
+                self.room_id, sender_user, message, context["participant_ids"]
+            )
+        elif context is not None:
+            # Attachments are linked in the message's own transaction, so never write-behind
+            try:
+                result = await self.ingest_message(
+                    self.room_id, sender_user, message, context["participant_ids"], attachment_ids
+                )
+            except EmptyMessage:
+                return  # bogus or foreign attachment ids and no text: dropped like an empty frame
 
         # 🚫 ROOM DELETED
-        if room is None:
+        if result is None:
             await self.send(json.dumps({
                 "type": "room_deleted"
             }))
             await self.close()
             return
 
-        await self.update_last_seen(sender_user)  # Update last seen on message send
-        msg_instance = await self.save_message(room, sender_user, message)
-
-        # 🔥 UNHIDE ROOM & NOTIFY PARTICIPANTS
-        participants = await self.get_participants(room)
-        for p in participants:
-            if p != sender_user:  # Don't notify sender, but ensure room is visible
-                await self.unhide_room_for_user(room, p)
-                
-                await self.channel_layer.group_send(
-                    f"user_{p.id}",
-                    {
-                        "type": "chat_notification",
-                        "room_id": self.room_id,
-                        "room_name": room.name,
-                        "sender": sender_username,
-                        "message": message,
-                    }
-                )
-        
-        # Ensure visible for sender too (if they deleted it previously)
-        await self.unhide_room_for_user(room, sender_user)
-
-        # Get Avatar URL
-        avatar_url = None
-        try:
-            user_info = await database_sync_to_async(lambda: sender_user.userinfo)()
-            if user_info.image:
-                avatar_url = user_info.image.url
-        except:
-            pass
+        # 🔥 NOTIFY PARTICIPANTS (room already unhidden by the ingest)
+        await self.group_send_many(
+            [f"user_{pid}" for pid in context["participant_ids"] if pid != sender_user.id],
+            {
+                "type": "chat_notification",
+                "room_id": self.room_id,
+                "room_name": context["room_name"],
+                "sender": sender_username,
+                "message": message or ATTACHMENT_SNIPPET,
+            }
+        )
 
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -90,26 +173,111 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 "type": "chat_message",
                 "message": message,
                 "sender": sender_username,
-                "avatar_url": avatar_url,
-                "message_id": msg_instance.id 
+                "avatar_url": context["avatar_url"],
+                "attachments": result.get("attachments", []),
+                "message_id": result["message_id"]
             }
         )
 
+    @staticmethod
+    def parse_attachment_ids(value):
+        if not isinstance(value, list):
+            return []
+        ids = []
+        for item in value[:MAX_ATTACHMENTS_PER_MESSAGE]:
+            try:
+                ids.append(int(item))
+            except (TypeError, ValueError):
+                continue
+        return ids
+
+    async def send_resume(self, since_message_id):
+        """One compact frame with everything missed since since_message_id"""
+        try:
+            since_message_id = int(since_message_id)
+        except (TypeError, ValueError):
+            return
+        batch = await self.resume_batch(self.room_id, since_message_id)
+        await self.send(json.dumps({"type": "resume", **batch}))
+
+    async def mark_read(self, message_id):
+        try:
+            message_id = int(message_id)
+        except (TypeError, ValueError):
+            return
+        if message_id <= self.last_read_id:
+            return
+        # Only ids of this room reach the cursor writer and the receipts: up to the
+        # newest frame we delivered (maybe still written behind), else one lookup
+        if message_id > self.newest_message_id and not await self.is_room_message(self.room_id, message_id):
+            return
+        self.last_read_id = message_id
+
+        read_cursors.put((int(self.room_id), self.user.id), message_id)
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                "type": "read_receipt",
+                "user_id": self.user.id,
+                "message_id": message_id,
+            }
+        )
+
+    async def group_send_many(self, groups, event):
+        # One call on layers that support it, one group_send per group otherwise
+        if hasattr(self.channel_layer, "group_send_many"):
+            await self.channel_layer.group_send_many(groups, event)
+            return
+        for group in groups:
+            await self.channel_layer.group_send(group, event)
+
     async def chat_message(self, event):
+        self.newest_message_id = max(self.newest_message_id, event.get("message_id") or 0)
         await self.send(json.dumps({
             "type": "chat",
             "message": event["message"],
             "sender": event["sender"],
             "avatar_url": event.get("avatar_url"),
+            "attachments": event.get("attachments", []),
             "message_id": event.get("message_id")
         }))
 
     async def room_deleted(self, event):
+        self.room_context = None
         await self.send(json.dumps({
             "type": "room_deleted"
         }))
         await self.close()
 
+    async def room_context_changed(self, event):
+        # Only reload when it concerns the room itself or our own profile
+        user_id = event.get("user_id")
+        if user_id is not None and user_id != self.user.id:
+            return
+
+        context = await self.load_room_context(self.room_id)
+        if context is None:
+            await self.room_deleted(event)
+            return
+        self.room_context = context
+
+    async def read_receipt(self, event):
+        # Our own cursor is news only to the other participants
+        if event["user_id"] == self.user.id:
+            return
+        await self.send(json.dumps({
+            "type": "read",
+            "user_id": event["user_id"],
+            "message_id": event["message_id"],
+        }))
+
+    async def presence_update(self, event):
+        await self.send(json.dumps({
+            "type": "presence",
+            "user_id": event["user_id"],
+            "online": event["online"],
+        }))
+
     async def message_deleted(self, event):
         await self.send(text_data=json.dumps({
         "type": "message_deleted",
@@ -121,47 +289,31 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # DATABASE HELPERS
     # =====================
 
+    @database_write_to_async
+    def ingest_message(self, room_id, user, message, participant_ids, attachment_ids=()):
+        from .services import ingest_message
+        return ingest_message(room_id, user, message, participant_ids, attachment_ids)
+
     @database_sync_to_async
-    def save_message(self, room, user, message):
-        from .models import Message
-        return Message.objects.create(
-            chatroom=room,
-            sender=user,
-            content=message
-        )
+    def is_room_message(self, room_id, message_id):
+        from .services import is_room_message
+        return is_room_message(room_id, message_id)
 
     @database_sync_to_async
-    def get_room_safe(self, room_id):
-        from .models import ChatRoom
-        try:
-            return ChatRoom.objects.get(id=room_id)
-        except ObjectDoesNotExist:
-            return None
+    def resume_batch(self, room_id, since_message_id):
+        from .services import resume_batch
+        return resume_batch(room_id, self.user, since_message_id)
 
     @database_sync_to_async
-    def room_exists(self, room_id):
-        from .models import ChatRoom
-        return ChatRoom.objects.filter(id=room_id).exists()
+    def load_room_context(self, room_id):
+        from .services import load_room_context
+        return load_room_context(room_id, self.user)
     
-    @database_sync_to_async
-    def get_participants(self, room):
-        return list(room.participants.all())
-
     @database_sync_to_async
     def get_user(self, username):
         from django.contrib.auth.models import User
         return User.objects.get(username=username)
 
-    @database_sync_to_async
-    def unhide_room_for_user(self, room, user):
-        room.hidden_for.remove(user)
-
-    @database_sync_to_async
-    def update_last_seen(self, user):
-        from django.utils import timezone
-        user.last_login = timezone.now()
-        user.save(update_fields=['last_login'])
-
 
 class DashboardConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -173,10 +325,17 @@ class DashboardConsumer(AsyncWebsocketConsumer):
         self.group_name = f"user_{self.user.id}"
         await self.channel_layer.group_add(self.group_name, self.channel_name)
         await self.accept()
+        await presence_connected(self.channel_layer, self.user.id)
 
     async def disconnect(self, close_code):
         if self.user.is_authenticated:
             await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            await presence_disconnected(self.channel_layer, self.user.id)
+
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        if data.get("type") == "heartbeat":
+            presence.heartbeat(self.user.id)
 
     async def chat_notification(self, event):
         await self.send(json.dumps({
@@ -0,0 +1,130 @@
+"""
+Database access from async code, sized to the connection pool.
+
+channels' database_sync_to_async runs thread-sensitive, so every consumer
+context can end up with a thread of its own and, with persistent
+connections, a database connection of its own too. chatix runs that work
+on one bounded executor instead (CHATIX_DB_EXECUTOR_SIZE threads). The
+PostgreSQL pool in settings is sized from the same number, so busy sockets
+wait on an executor slot or a pooled connection instead of opening more.
+"""
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CHATIX_DB_EXECUTOR_SIZE", 8),
+                thread_name_prefix="chatix-db",
+            )
+        return _executor
+
+
+def database_sync_to_async(fn):
+    """channels' database_sync_to_async, on the bounded chatix executor"""
+    return DatabaseSyncToAsync(fn, thread_sensitive=False, executor=get_executor())
+
+
+def pool_stats():
+    """Executor queue and, on PostgreSQL with pooling, psycopg_pool counters"""
+    executor = get_executor()
+    stats = {
+        "executor": {
+            "max_workers": executor._max_workers,
+            "threads": len(executor._threads),
+            "queued": executor._work_queue.qsize(),
+        },
+        "pool": None,
+    }
+
+    pool = getattr(connection, "pool", None) if connection.vendor == "postgresql" else None
+    if pool is not None:
+        # requests_waiting / requests_wait_ms are the pool waits; get_stats() resets counters
+        stats["pool"] = {"min_size": pool.min_size, "max_size": pool.max_size, **pool.get_stats()}
+    return stats
+
+
+# =========================
+# QUERY COUNTING
+# =========================
+
+_TRANSACTION_CONTROL = re.compile(r"\s*(BEGIN|COMMIT|ROLLBACK|SAVEPOINT|RELEASE)\b", re.IGNORECASE)
+
+_counters = []
+_counters_lock = threading.Lock()
+
+
+def is_transaction_control(sql):
+    """BEGIN / SAVEPOINT and friends, which some backends send as statements and others do not"""
+    return bool(_TRANSACTION_CONTROL.match(sql))
+
+
+def _count_queries(execute, sql, params, many, context):
+    if _counters and not is_transaction_control(sql):
+        with _counters_lock:
+            for counter in _counters:
+                counter.total += 1
+    return execute(sql, params, many, context)
+
+
+def _install_counting(sender=None, connection=None, **kwargs):
+    if _count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_queries)
+
+
+# On every connection from the start, so executor threads that connected
+# before a QueryCounter began are counted too; a no-op while none is active
+connection_created.connect(_install_counting)
+
+
+class QueryCounter:
+    """
+    Counts the queries run while it is active; transaction control is not
+    counted. By default on every thread, the executor threads above
+    included, which suits benchmarks and query budgets where nothing else
+    is running. With all_threads=False only the calling thread's
+    connection is watched, so it is safe next to concurrent work.
+    """
+
+    def __init__(self, all_threads=True):
+        self.total = 0
+        self.all_threads = all_threads
+        self._wrapper = None
+
+    def __enter__(self):
+        # _count_queries first: a connection opened inside the block appends it
+        # otherwise, after ours, and execute_wrapper()'s pop() would remove the wrong one
+        _install_counting(connection=connection)
+        if self.all_threads:
+            with _counters_lock:
+                _counters.append(self)
+        else:
+            self._wrapper = self._count
+            connection.execute_wrappers.append(self._wrapper)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.all_threads:
+            with _counters_lock:
+                _counters.remove(self)
+        else:
+            # By identity, whatever was added after it
+            wrappers = connection.execute_wrappers
+            del wrappers[next(i for i, w in enumerate(wrappers) if w is self._wrapper)]
+
+    def _count(self, execute, sql, params, many, context):
+        if not is_transaction_control(sql):
+            self.total += 1
+        return execute(sql, params, many, context)
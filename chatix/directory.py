@@ -0,0 +1,189 @@
+"""
+User directory: prefix search for the "find people" box and autocomplete.
+
+Lookups run against the lowercased username_key / name_key / email_key
+columns of UserInfo, in the form each backend's B-tree indexes serve:
+
+* SQLite: ``key >= prefix AND key < prefix + U+10FFFF`` ranges. Its BINARY
+  collation orders the keys bytewise, so the range is exact (its LIKE is
+  case-insensitive and would not use the index)
+* PostgreSQL and others: ``LIKE 'prefix%'``, served on PostgreSQL by the
+  varchar_pattern_ops index Django adds next to each db_index CharField.
+  Under a non-C collation a range would miss matches
+
+Accounts without a UserInfo (createsuperuser, the admin) have no keys;
+they are matched the same way on lower(User.username), which has an
+index of its own, in a second query when the first one leaves room.
+Every lookup has a hard limit.
+
+Autocomplete answers are also kept in a small in-process LRU cache keyed
+by prefix. Any UserInfo save or username change clears it
+(chatix.signals), and a TTL bounds how stale other worker processes can be.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .avatars import LIST_AVATAR_SIZE, avatar_url
+from .models import UserInfo
+
+AUTOCOMPLETE_LIMIT = 10
+SEARCH_LIMIT = 50
+
+_KEY_FIELDS = ("username_key", "name_key", "email_key")
+
+# Sorts after every other character in UTF-8 byte order
+_MAX_CHAR = "\U0010ffff"
+
+
+def normalize(prefix):
+    return prefix.strip().lower()
+
+
+def find_users(prefix, limit=SEARCH_LIMIT, exclude_user_id=None):
+    """Users whose username, name or email starts with prefix, profiles loaded"""
+    prefix = normalize(prefix)
+    if not prefix:
+        return []
+    users = [info.user for info in _profile_query(prefix, limit, exclude_user_id)]
+    if len(users) < limit:
+        users += _no_profile_query(prefix, limit - len(users), exclude_user_id)
+    return users
+
+
+async def afind_users(prefix, limit=SEARCH_LIMIT, exclude_user_id=None):
+    """find_users for async views"""
+    prefix = normalize(prefix)
+    if not prefix:
+        return []
+    users = [info.user async for info in _profile_query(prefix, limit, exclude_user_id)]
+    if len(users) < limit:
+        users += [user async for user in _no_profile_query(prefix, limit - len(users), exclude_user_id)]
+    return users
+
+
+def _prefix_match(field, prefix):
+    if connection.vendor == "sqlite":
+        return Q(**{f"{field}__gte": prefix, f"{field}__lt": prefix + _MAX_CHAR})
+    return Q(**{f"{field}__startswith": prefix})
+
+
+def _profile_query(prefix, limit, exclude_user_id):
+    match = Q()
+    for field in _KEY_FIELDS:
+        match |= _prefix_match(field, prefix)
+
+    infos = UserInfo.objects.filter(match).select_related("user").order_by("username_key")
+    if exclude_user_id is not None:
+        infos = infos.exclude(user_id=exclude_user_id)
+    return infos[:limit]
+
+
+def _no_profile_query(prefix, limit, exclude_user_id):
+    # lower(username) has an index of its own (migration 0019)
+    users = User.objects.annotate(
+        username_lower=Lower("username")
+    ).filter(
+        _prefix_match("username_lower", prefix), userinfo__isnull=True
+    ).select_related("userinfo").order_by("username_lower")
+    if exclude_user_id is not None:
+        users = users.exclude(id=exclude_user_id)
+    return users[:limit]
+
+
+# =========================
+# AUTOCOMPLETE
+# =========================
+
+class PrefixCache:
+
+    def __init__(self, size=1024, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # prefix -> (stored at, results, complete)
+        self._lock = threading.Lock()
+
+    def get(self, prefix):
+        """Cached results for prefix, narrowed from a shorter prefix when that was complete"""
+        now = time.monotonic()
+        with self._lock:
+            for end in range(len(prefix), 0, -1):
+                entry = self._entries.get(prefix[:end])
+                if entry is None or now - entry[0] > self.ttl:
+                    continue
+                _, results, complete = entry
+                if end == len(prefix):
+                    self._entries.move_to_end(prefix)
+                    return results
+                if complete:
+                    # Everything matching prefix[:end] is here, so filtering is exact
+                    return [r for r in results if _matches(r, prefix)]
+        return None
+
+    def put(self, prefix, results, complete):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[prefix] = (time.monotonic(), results, complete)
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+prefix_cache = PrefixCache(
+    size=getattr(settings, "CHATIX_USER_SEARCH_CACHE_SIZE", 1024),
+    ttl=getattr(settings, "CHATIX_USER_SEARCH_CACHE_TTL", 30),
+)
+
+
+def autocomplete_users(prefix, exclude_user_id=None, limit=AUTOCOMPLETE_LIMIT):
+    """Up to limit compact user dicts for the type-ahead list"""
+    prefix = normalize(prefix)
+    if not prefix:
+        return []
+
+    results = prefix_cache.get(prefix)
+    if results is None:
+        # One spare row so the requesting user can be dropped without refetching
+        users = find_users(prefix, limit=limit + 1)
+        results = [_serialize(user) for user in users]
+        prefix_cache.put(prefix, results, complete=len(users) <= limit)
+
+    # The match keys (email included) stay server side
+    return [
+        {k: v for k, v in r.items() if k != "_keys"}
+        for r in results if r["id"] != exclude_user_id
+    ][:limit]
+
+
+def invalidate_user_directory():
+    prefix_cache.clear()
+
+
+def _serialize(user):
+    info = getattr(user, "userinfo", None)
+    if info is None:
+        keys = (user.username.lower(),)
+    else:
+        keys = (info.username_key, info.name_key, info.email_key)
+    return {
+        "id": user.id,
+        "username": user.username,
+        "name": info.name if info else user.username,
+        "avatar_url": avatar_url(info, LIST_AVATAR_SIZE),
+        "_keys": keys,
+    }
+
+
+def _matches(result, prefix):
+    return any(key.startswith(prefix) for key in result["_keys"])
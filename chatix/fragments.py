@@ -0,0 +1,35 @@
+"""
+Rendered chat history, cached per room version.
+
+The chatroom page keeps its rendered message list in the "fragments" cache
+(settings.CACHES) under a key made of the room, the page, the room's version
+counter and the viewer's visibility version (chatix.versions). Nothing is
+ever deleted: a new or deleted message, a cleared chat or a profile change
+bumps a counter, the room simply stops matching its old keys, and the LRU /
+timeout drops those.
+"""
+from django.core.cache import caches
+
+from .versions import VERSION_CACHE, aversions, room_key, visibility_key
+
+
+def _cache():
+    return caches[VERSION_CACHE]
+
+
+async def ahistory_key(room_id, user_id, page="latest"):
+    """Cache key of a user's rendered history page from the current versions, or None"""
+    versions = await aversions([room_key(room_id), visibility_key(room_id, user_id)])
+    if versions is None:
+        return None
+
+    room_version, visibility_version = versions
+    return f"chatix:history:{room_id}:{page}:{room_version}:{user_id}.{visibility_version}"
+
+
+async def aget_fragment(key):
+    return await _cache().aget(key)
+
+
+async def aset_fragment(key, value):
+    await _cache().aset(key, value)
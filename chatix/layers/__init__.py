@@ -0,0 +1 @@
+"""Channel layer backends for CHANNEL_LAYERS"""
@@ -0,0 +1,550 @@
+"""
+Channel layer shared by several worker processes on one host.
+
+One broker process (``python manage.py run_channel_broker``) owns every
+channel queue and group. Workers use BrokerChannelLayer, which talks to the
+broker over a Unix domain socket with length-prefixed msgpack frames:
+
+    request:  [request_id, op, *args]
+    response: [request_id, ok, value]
+
+Message bodies are packed once by the sending worker and passed through
+the broker untouched, so fan-out costs the broker no (de)serialisation.
+
+A restarted broker starts empty. Each worker remembers the groups its
+channels joined and adds them again as soon as it reconnects.
+
+The broker also counts every worker's sockets per user (the "presence"
+extension, see chatix.presence), so a user is online while any worker
+holds one of their sockets. A worker's counts go away with its connection.
+"""
+import asyncio
+import fnmatch
+import itertools
+import logging
+import os
+import re
+import socket
+import struct
+import time
+import uuid
+from collections import Counter, deque
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/tmp/chatix-channels.sock"
+
+_HEADER = struct.Struct("!I")
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(_HEADER.size)
+    (size,) = _HEADER.unpack(header)
+    return msgpack.unpackb(await reader.readexactly(size), raw=False)
+
+
+def _write_frame(writer, frame):
+    data = msgpack.packb(frame, use_bin_type=True)
+    writer.write(_HEADER.pack(len(data)) + data)
+
+
+# =========================
+# BROKER (SERVER SIDE)
+# =========================
+class _Client:
+    """One connected worker process"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.alive = True
+        self.waiting = {}  # request_id -> channel of a pending receive
+        self.presence = Counter()  # user_id -> sockets this worker holds
+
+    def reply(self, request_id, ok, value=None):
+        if self.alive:
+            _write_frame(self.writer, [request_id, ok, value])
+
+
+class ChannelBroker:
+    """Holds channels and groups for every worker connected to the socket"""
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None):
+        self.path = path
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.capacity = capacity
+        self.channel_capacity = [
+            (re.compile(fnmatch.translate(pattern)), value)
+            for pattern, value in (channel_capacity or {}).items()
+        ]
+
+        self.queues = {}          # channel -> deque[(expires_at, payload)]
+        self.waiters = {}         # channel -> deque[(client, request_id)]
+        self.groups = {}          # group -> {channel: joined_at}
+        self.channel_groups = {}  # channel -> set(group), to drop dead channels fast
+        self.presence = Counter()  # user_id -> sockets across all workers
+
+    def get_capacity(self, channel):
+        for pattern, capacity in self.channel_capacity:
+            if pattern.match(channel):
+                return capacity
+        return self.capacity
+
+    # ---------- SERVER ----------
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+        os.chmod(self.path, 0o600)
+        logger.info("Channel broker listening on %s", self.path)
+
+        sweeper = asyncio.create_task(self._sweep_forever())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sweeper.cancel()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    async def _handle_client(self, reader, writer):
+        client = _Client(writer)
+        try:
+            while True:
+                frame = await _read_frame(reader)
+                self._dispatch(client, frame)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            client.alive = False
+            for request_id, channel in list(client.waiting.items()):
+                self._drop_waiter(channel, client, request_id)
+            # A worker that went away no longer holds its users' sockets
+            for user_id, count in list(client.presence.items()):
+                self.presence_change(client, user_id, -count)
+            writer.close()
+
+    def _dispatch(self, client, frame):
+        request_id, op, *args = frame
+        if op == "receive":
+            self.receive(client, request_id, args[0])
+        elif op == "cancel":
+            channel = client.waiting.get(args[0])
+            if channel is not None:
+                self._drop_waiter(channel, client, args[0])
+        elif op == "send":
+            if self.send(*args):
+                client.reply(request_id, True)
+            else:
+                client.reply(request_id, False, "full")
+        elif op == "group_add":
+            self.group_add(*args)
+            client.reply(request_id, True)
+        elif op == "group_discard":
+            self.group_discard(*args)
+            client.reply(request_id, True)
+        elif op == "group_send":
+            self.group_send(*args)
+            client.reply(request_id, True)
+        elif op == "group_send_many":
+            self.group_send_many(*args)
+            client.reply(request_id, True)
+        elif op == "presence_change":
+            client.reply(request_id, True, self.presence_change(client, *args))
+        elif op == "presence_online":
+            client.reply(request_id, True, [uid for uid in args[0] if self.presence[uid] > 0])
+        elif op == "flush":
+            self.flush()
+            client.reply(request_id, True)
+        else:
+            client.reply(request_id, False, f"unknown op {op!r}")
+
+    # ---------- CHANNELS ----------
+
+    def send(self, channel, payload):
+        """Hand payload to a waiting receiver or queue it; False if the channel is full"""
+        waiters = self.waiters.get(channel)
+        while waiters:
+            client, request_id = waiters.popleft()
+            if not waiters:
+                del self.waiters[channel]
+            if client.alive:
+                client.waiting.pop(request_id, None)
+                client.reply(request_id, True, payload)
+                return True
+
+        queue = self.queues.get(channel)
+        if queue is not None:
+            self._expire_queue(channel, queue, time.time())
+        queue = self.queues.setdefault(channel, deque())
+        if len(queue) >= self.get_capacity(channel):
+            return False
+        queue.append((time.time() + self.expiry, payload))
+        return True
+
+    def receive(self, client, request_id, channel):
+        queue = self.queues.get(channel)
+        if queue:
+            self._expire_queue(channel, queue, time.time())
+        if queue:
+            _, payload = queue.popleft()
+            if not queue:
+                del self.queues[channel]
+            client.reply(request_id, True, payload)
+            return
+
+        self.waiters.setdefault(channel, deque()).append((client, request_id))
+        client.waiting[request_id] = channel
+
+    def _drop_waiter(self, channel, client, request_id):
+        client.waiting.pop(request_id, None)
+        waiters = self.waiters.get(channel)
+        if not waiters:
+            return
+        try:
+            waiters.remove((client, request_id))
+        except ValueError:
+            pass
+        if not waiters:
+            del self.waiters[channel]
+
+    def _expire_queue(self, channel, queue, now):
+        expired = False
+        while queue and queue[0][0] < now:
+            queue.popleft()
+            expired = True
+        if expired:
+            # Nobody is reading this channel any more, stop feeding it
+            self._remove_from_groups(channel)
+        if not queue:
+            self.queues.pop(channel, None)
+
+    # ---------- GROUPS ----------
+
+    def group_add(self, group, channel):
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+    def group_discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    def group_send(self, group, payload):
+        for channel in list(self.groups.get(group, ())):
+            # Full channels are skipped, same as the other channel layers
+            self.send(channel, payload)
+
+    def group_send_many(self, groups, payload):
+        seen = set()
+        for group in groups:
+            for channel in list(self.groups.get(group, ())):
+                if channel not in seen:
+                    seen.add(channel)
+                    self.send(channel, payload)
+
+    def _remove_from_groups(self, channel):
+        for group in self.channel_groups.pop(channel, ()):
+            members = self.groups.get(group)
+            if members is not None:
+                members.pop(channel, None)
+                if not members:
+                    del self.groups[group]
+
+    # ---------- PRESENCE ----------
+
+    def presence_change(self, client, user_id, delta):
+        """Add delta to a worker's sockets of user_id; returns the user's total"""
+        client.presence[user_id] += delta
+        if client.presence[user_id] <= 0:
+            del client.presence[user_id]
+        self.presence[user_id] += delta
+        total = self.presence[user_id]
+        if total <= 0:
+            del self.presence[user_id]
+        return max(total, 0)
+
+    def flush(self):
+        self.queues.clear()
+        self.groups.clear()
+        self.channel_groups.clear()
+
+    # ---------- EXPIRY ----------
+
+    async def _sweep_forever(self):
+        interval = max(1.0, self.expiry / 4)
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def sweep(self):
+        now = time.time()
+        for channel, queue in list(self.queues.items()):
+            self._expire_queue(channel, queue, now)
+
+        cutoff = now - self.group_expiry
+        for group, members in list(self.groups.items()):
+            for channel, joined_at in list(members.items()):
+                if joined_at < cutoff:
+                    self.group_discard(group, channel)
+
+
+# =========================
+# CHANNEL LAYER (WORKER SIDE)
+# =========================
+async def _open_connection(path):
+    # Our own socket, so it can still be closed after its event loop is gone
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, path)
+        reader, writer = await asyncio.open_unix_connection(sock=sock)
+    except BaseException:
+        sock.close()
+        raise
+    return _BrokerConnection(reader, writer, sock)
+
+
+class _BrokerConnection:
+    """One socket to the broker, owned by a single event loop"""
+
+    def __init__(self, reader, writer, sock):
+        self.reader = reader
+        self.writer = writer
+        self.sock = sock
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._reader_task = asyncio.create_task(self._read_forever())
+
+    async def _read_forever(self):
+        try:
+            while True:
+                request_id, ok, value = await _read_frame(self.reader)
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(_BrokerError(value))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("channel broker connection lost"))
+            self._pending.clear()
+
+    async def call(self, op, *args):
+        if self.closed:
+            raise ConnectionError("channel broker connection lost")
+
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        _write_frame(self.writer, [request_id, op, *args])
+        try:
+            await self.writer.drain()
+            return await future
+        except ConnectionError:
+            # Noticed while writing, maybe before the reader did: retry on a new connection
+            self.closed = True
+            self._pending.pop(request_id, None)
+            raise
+        except asyncio.CancelledError:
+            self._pending.pop(request_id, None)
+            if op == "receive" and not self.closed:
+                # Free the broker-side waiter so the next message is not lost on us
+                _write_frame(self.writer, [0, "cancel", request_id])
+            raise
+
+    def close(self):
+        self.closed = True
+        if self._reader_task.get_loop().is_closed():
+            # async_to_sync's loop has finished: the transport cannot close itself any more
+            self.sock.close()
+            return
+        self._reader_task.cancel()
+        self.writer.close()
+
+
+class _BrokerError(Exception):
+    pass
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer backed by a ChannelBroker on a Unix domain socket.
+
+    expiry, group_expiry and capacity are enforced by the broker; the
+    management command reads them from the same CHANNEL_LAYERS CONFIG.
+    """
+
+    extensions = ["groups", "flush", "presence"]
+
+    def __init__(self, path=DEFAULT_SOCKET_PATH, expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None, connect_timeout=10):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        self.group_expiry = group_expiry
+        self.connect_timeout = connect_timeout
+        self.client_prefix = uuid.uuid4().hex[:12]
+        self._connections = {}  # event loop -> _BrokerConnection
+        self._connect_locks = {}  # event loop -> asyncio.Lock
+        self._memberships = set()  # (group, channel) of our channels, replayed on reconnect
+        self._presence = Counter()  # user_id -> our sockets, replayed on reconnect
+
+    # ---------- CONNECTION ----------
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        conn = self._connections.get(loop)
+        if conn is not None and not conn.closed:
+            return conn
+
+        # Every consumer notices a lost broker at once; only one of them reconnects
+        lock = self._connect_locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            conn = self._connections.get(loop)
+            if conn is not None and not conn.closed:
+                return conn
+
+            # Close connections of event loops that have gone away
+            for old_loop in [l for l in self._connections if l.is_closed()]:
+                self._connections.pop(old_loop).close()
+                self._connect_locks.pop(old_loop, None)
+
+            deadline = time.monotonic() + self.connect_timeout
+            delay = 0.05
+            while True:
+                try:
+                    conn = await _open_connection(self.path)
+                    break
+                except (FileNotFoundError, ConnectionError):
+                    # Broker still starting (or restarting) next to the workers
+                    if time.monotonic() > deadline:
+                        raise
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 1.0)
+
+            if loop in self._connections:
+                await self._replay(conn)
+            self._connections[loop] = conn
+            return conn
+
+    async def _replay(self, conn):
+        """Join our groups and count our sockets again on a broker that may have restarted empty"""
+        memberships = list(self._memberships)
+        if memberships:
+            logger.info("Reconnected to channel broker at %s, rejoining %d groups", self.path, len(memberships))
+        await asyncio.gather(
+            *(conn.call("group_add", group, channel) for group, channel in memberships),
+            *(conn.call("presence_change", user_id, count) for user_id, count in list(self._presence.items())),
+        )
+
+    async def _call(self, op, *args):
+        for attempt in range(2):
+            conn = await self._connection()
+            try:
+                return await conn.call(op, *args)
+            except ConnectionError:
+                if attempt:
+                    raise
+
+    # ---------- CHANNEL LAYER API ----------
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        try:
+            await self._call("send", channel, msgpack.packb(message, use_bin_type=True))
+        except _BrokerError as e:
+            if str(e) == "full":
+                raise ChannelFull(channel)
+            raise
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        while True:
+            try:
+                payload = await self._call("receive", channel)
+                return msgpack.unpackb(payload, raw=False)
+            except ConnectionError:
+                # Broker restarted: keep the consumer alive and wait for it
+                logger.warning("Lost channel broker at %s, reconnecting", self.path)
+                await asyncio.sleep(0.5)
+
+    async def new_channel(self, prefix="specific."):
+        return f"{prefix}{self.client_prefix}!{uuid.uuid4().hex[:12]}"
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self._memberships.add((group, channel))
+        await self._call("group_add", group, channel)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._memberships.discard((group, channel))
+        await self._call("group_discard", group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._call("group_send", group, msgpack.packb(message, use_bin_type=True))
+
+    async def group_send_many(self, groups, message):
+        """Send one message to several groups, each channel at most once"""
+        assert isinstance(message, dict), "Message is not a dict"
+        for group in groups:
+            self.require_valid_group_name(group)
+        await self._call(
+            "group_send_many", list(groups), msgpack.packb(message, use_bin_type=True)
+        )
+
+    # ---------- PRESENCE ----------
+
+    async def presence_add(self, user_id):
+        """Count one more socket of user_id; returns their sockets across all workers"""
+        self._presence[user_id] += 1
+        return await self._call("presence_change", user_id, 1)
+
+    async def presence_discard(self, user_id):
+        """Count one socket of user_id less; returns how many are left across all workers"""
+        if self._presence[user_id] <= 1:
+            del self._presence[user_id]
+        else:
+            self._presence[user_id] -= 1
+        return await self._call("presence_change", user_id, -1)
+
+    async def presence_online(self, user_ids):
+        """The user_ids with a socket on any worker"""
+        return await self._call("presence_online", list(user_ids))
+
+    async def flush(self):
+        self._memberships.clear()
+        await self._call("flush")
+
+    async def close(self):
+        conn = self._connections.pop(asyncio.get_running_loop(), None)
+        if conn is not None:
+            conn.close()
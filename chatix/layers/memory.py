@@ -0,0 +1,259 @@
+"""
+Single-process channel layer, a drop-in replacement for
+channels.layers.InMemoryChannelLayer built for fan-out heavy rooms:
+
+* group membership is indexed both ways (group -> channels, channel -> groups)
+  so joining, leaving and dropping a dead channel never scan all groups
+* expiry is lazy: a queue only drops stale messages when it is touched, and
+  a stale group membership is dropped when a group_send reaches it
+* per-channel queues are bounded; ``overflow`` decides what happens when
+  one is full: "error" (raise ChannelFull, the channels default),
+  "drop_oldest" or "drop_newest"
+* group_send_many delivers one message to several groups in one call,
+  each channel at most once
+* stats() exposes counters to tell when a worker is saturated
+"""
+import asyncio
+import random
+import string
+import time
+from collections import deque
+from copy import deepcopy
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+OVERFLOW_POLICIES = ("error", "drop_oldest", "drop_newest")
+
+
+class _Channel:
+    __slots__ = ("queue", "waiters")
+
+    def __init__(self):
+        self.queue = deque()    # (expires_at, message)
+        self.waiters = deque()  # futures of pending receive() calls
+
+
+class FastInMemoryChannelLayer(BaseChannelLayer):
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, overflow="error", **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"overflow must be one of {OVERFLOW_POLICIES}, not {overflow!r}")
+        self.group_expiry = group_expiry
+        self.overflow = overflow
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+
+        self.channels = {}        # channel -> _Channel
+        self.groups = {}          # group -> {channel: joined_at}
+        self.channel_groups = {}  # channel -> set(group)
+        self._last_sweep = time.time()
+        self._reset_stats()
+
+    # ---------- STATS ----------
+
+    def _reset_stats(self):
+        self._stats = {
+            "sent": 0,
+            "received": 0,
+            "expired": 0,
+            "dropped": 0,
+            "channel_full": 0,
+            "group_sends": 0,
+            "fanout_deliveries": 0,
+            "fanout_seconds_total": 0.0,
+            "fanout_seconds_max": 0.0,
+        }
+
+    def stats(self):
+        """Counters since start plus current queue depth"""
+        depths = [len(ch.queue) for ch in self.channels.values()]
+        stats = dict(self._stats)
+        stats.update({
+            "channels": len(self.channels),
+            "groups": len(self.groups),
+            "queued": sum(depths),
+            "max_queue_depth": max(depths, default=0),
+            "waiting_receivers": sum(len(ch.waiters) for ch in self.channels.values()),
+        })
+        return stats
+
+    # ---------- CHANNELS ----------
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+
+        now = time.time()
+        self._maybe_sweep(now)
+        if not self._deliver(channel, deepcopy(message), now):
+            raise ChannelFull(channel)
+
+    def _deliver(self, channel, message, now):
+        """Put message on channel; False only when full under the "error" policy"""
+        ch = self.channels.get(channel)
+        if ch is None:
+            ch = self.channels[channel] = _Channel()
+
+        # Hand it straight to a waiting receiver when there is one
+        while ch.waiters:
+            waiter = ch.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(message)
+                self._stats["sent"] += 1
+                return True
+
+        self._expire(channel, ch, now)
+        if len(ch.queue) >= self.get_capacity(channel):
+            if self.overflow == "error":
+                self._stats["channel_full"] += 1
+                return False
+            self._stats["dropped"] += 1
+            if self.overflow == "drop_newest":
+                return True
+            ch.queue.popleft()
+
+        ch.queue.append((now + self.expiry, message))
+        self._stats["sent"] += 1
+        return True
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+
+        ch = self.channels.get(channel)
+        if ch is None:
+            ch = self.channels[channel] = _Channel()
+
+        self._expire(channel, ch, time.time())
+        if ch.queue:
+            _, message = ch.queue.popleft()
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            ch.waiters.append(waiter)
+            try:
+                message = await waiter
+            finally:
+                if waiter.cancelled() and waiter in ch.waiters:
+                    ch.waiters.remove(waiter)
+
+        if not ch.queue and not ch.waiters:
+            self.channels.pop(channel, None)
+        self._stats["received"] += 1
+        return message
+
+    async def new_channel(self, prefix="specific."):
+        return "%s.inmemory!%s" % (
+            prefix,
+            "".join(random.choice(string.ascii_letters) for i in range(12)),
+        )
+
+    def _expire(self, channel, ch, now):
+        queue = ch.queue
+        expired = 0
+        while queue and queue[0][0] < now:
+            queue.popleft()
+            expired += 1
+        if expired:
+            self._stats["expired"] += expired
+            # A channel that lets messages expire has no reader, stop feeding it
+            self._remove_from_groups(channel)
+
+    def _maybe_sweep(self, now):
+        """
+        Full pass over idle channels at most once per expiry period, so
+        channels that are never touched again still get freed
+        """
+        if now - self._last_sweep < self.expiry:
+            return
+        self._last_sweep = now
+        for channel, ch in list(self.channels.items()):
+            self._expire(channel, ch, now)
+            if not ch.queue and not ch.waiters:
+                del self.channels[channel]
+
+    # ---------- GROUPS ----------
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._discard(group, channel)
+
+    def _discard(self, group, channel):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del self.channel_groups[channel]
+
+    def _remove_from_groups(self, channel):
+        for group in list(self.channel_groups.get(channel, ())):
+            self._discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._fan_out([group], message)
+
+    async def group_send_many(self, groups, message):
+        """Send one message to several groups, each channel at most once"""
+        assert isinstance(message, dict), "Message is not a dict"
+        for group in groups:
+            self.require_valid_group_name(group)
+        self._fan_out(groups, message)
+
+    def _fan_out(self, groups, message):
+        started = time.perf_counter()
+        now = time.time()
+        cutoff = now - self.group_expiry
+        self._maybe_sweep(now)
+
+        # Copied once for the whole fan-out; receivers get their own top-level dict
+        message = deepcopy(message)
+        seen = set()
+        for group in groups:
+            members = self.groups.get(group)
+            if not members:
+                continue
+            for channel, joined_at in list(members.items()):
+                if channel in seen:
+                    continue
+                if joined_at < cutoff:
+                    # Only this membership is stale, another group may still reach the channel
+                    self._discard(group, channel)
+                    continue
+                seen.add(channel)
+                # Full channels are skipped, same as InMemoryChannelLayer
+                if self._deliver(channel, dict(message), now):
+                    self._stats["fanout_deliveries"] += 1
+
+        elapsed = time.perf_counter() - started
+        self._stats["group_sends"] += 1
+        self._stats["fanout_seconds_total"] += elapsed
+        if elapsed > self._stats["fanout_seconds_max"]:
+            self._stats["fanout_seconds_max"] = elapsed
+
+    # ---------- FLUSH ----------
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        self.channel_groups = {}
+        self._reset_stats()
+
+    async def close(self):
+        pass
@@ -0,0 +1,108 @@
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from chatix.models import ChatRoom
+from chatix.services import ingest_message, message_page
+from chatix.writelane import lane_enabled, run_write
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure message write throughput with concurrent writers (and optional readers) "
+        "against the configured database. Run once as is and once with "
+        "CHATIX_SQLITE_TUNED=True to compare."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=16, help="Concurrent writer threads")
+        parser.add_argument("--messages", type=int, default=100, help="Messages per writer")
+        parser.add_argument("--readers", type=int, default=4, help="Threads reading history meanwhile")
+
+    def handle(self, *args, **options):
+        token = uuid.uuid4().hex[:8]
+        users = [User.objects.create_user(f"bench_{token}_{i}") for i in range(2)]
+        room = ChatRoom.objects.create(name=f"bench {token}")
+        room.participants.add(*users)
+        participant_ids = [u.id for u in users]
+
+        try:
+            result = self.run(room.id, users, participant_ids, options)
+        finally:
+            room.delete()
+            User.objects.filter(id__in=participant_ids).delete()
+
+        journal = "-"
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA journal_mode")
+                journal = cursor.fetchone()[0]
+
+        self.stdout.write(f"database        {connection.vendor} (journal_mode={journal})")
+        self.stdout.write(f"sqlite tuned    {getattr(settings, 'CHATIX_SQLITE_TUNED', False)}")
+        self.stdout.write(f"write lane      {lane_enabled()}")
+        self.stdout.write(f"writers         {options['writers']} x {options['messages']} messages")
+        self.stdout.write(f"throughput      {result['throughput']:.0f} messages/s")
+        self.stdout.write(f"latency p50/p99 {result['p50']:.1f} / {result['p99']:.1f} ms")
+        self.stdout.write(f"locked errors   {result['errors']}")
+        self.stdout.write(f"history reads   {result['reads_per_sec']:.0f} pages/s ({options['readers']} readers)")
+
+    def run(self, room_id, users, participant_ids, options):
+        latencies = []
+        errors = 0
+        reads = 0
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def writer(n):
+            nonlocal errors
+            user = users[n % len(users)]
+            try:
+                for i in range(options["messages"]):
+                    started = time.perf_counter()
+                    try:
+                        run_write(ingest_message, room_id, user, f"bench {n}-{i}", participant_ids)
+                    except OperationalError:
+                        with lock:
+                            errors += 1
+                        continue
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+            finally:
+                connection.close()
+
+        def reader():
+            nonlocal reads
+            try:
+                while not done.is_set():
+                    message_page(room_id, users[0])
+                    with lock:
+                        reads += 1
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(options["writers"] + options["readers"]) as pool:
+            for _ in range(options["readers"]):
+                pool.submit(reader)
+            started = time.perf_counter()
+            writers = [pool.submit(writer, n) for n in range(options["writers"])]
+            for future in writers:
+                future.result()
+            elapsed = time.perf_counter() - started
+            done.set()
+
+        latencies.sort()
+        return {
+            "throughput": len(latencies) / elapsed,
+            "p50": statistics.median(latencies) if latencies else 0,
+            "p99": latencies[int(len(latencies) * 0.99) - 1] if latencies else 0,
+            "errors": errors,
+            "reads_per_sec": reads / elapsed,
+        }
@@ -0,0 +1,262 @@
+import asyncio
+import json
+import platform
+import statistics
+import time
+import uuid
+from importlib import import_module
+
+import django
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from chatix.db import QueryCounter
+from chatix.models import ChatRoom
+from chatix.writebehind import write_behind_enabled
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0
+    rank = max(int(round(p / 100 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the real ASGI application in-process: open ChatConsumer (and "
+        "DashboardConsumer) sockets for simulated users and rooms, send messages at a "
+        "given rate, and report throughput, send-to-receive fan-out latency and DB "
+        "queries per message. Results go to a JSON file so runs can be compared."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10, help="Rooms to simulate")
+        parser.add_argument("--users-per-room", type=int, default=2, help="Participants (and senders) per room")
+        parser.add_argument("--messages", type=int, default=50, help="Messages each participant sends")
+        parser.add_argument(
+            "--rate", type=float, default=5,
+            help="Messages per second per sender (0 sends as fast as the server takes them)"
+        )
+        parser.add_argument("--no-dashboards", action="store_true", help="Skip the dashboard sockets")
+        parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for every delivery")
+        parser.add_argument(
+            "--output", default=None,
+            help="JSON file for the results (default bench-websockets-<timestamp>.json)"
+        )
+
+    def handle(self, *args, **options):
+        from DjangoChat.asgi import application
+
+        token = uuid.uuid4().hex[:8]
+        rooms, users = self.create_fixtures(token, options)
+        cookies = {user.id: self.session_cookie(user) for user in users}
+
+        try:
+            with QueryCounter() as counter:
+                result = asyncio.run(self.run(application, rooms, cookies, counter, options))
+        finally:
+            self.delete_fixtures(rooms, users)
+
+        report = {
+            "started_at": timezone.now().isoformat(),
+            "config": {
+                key: options[key]
+                for key in ("rooms", "users_per_room", "messages", "rate", "no_dashboards", "timeout")
+            },
+            "environment": {
+                "database": connection.vendor,
+                "channel_layer": settings.CHANNEL_LAYERS["default"]["BACKEND"],
+                "write_behind": write_behind_enabled(),
+                "sqlite_tuned": getattr(settings, "CHATIX_SQLITE_TUNED", False),
+                "python": platform.python_version(),
+                "django": django.get_version(),
+            },
+            "results": result,
+        }
+
+        output = options["output"] or f"bench-websockets-{time.strftime('%Y%m%d-%H%M%S')}.json"
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+        chat = result["chat_latency_ms"]
+        self.stdout.write(f"sockets           {result['sockets']} ({options['rooms']} rooms x {options['users_per_room']} users)")
+        self.stdout.write(f"messages sent     {result['messages_sent']} in {result['elapsed_s']:.2f} s")
+        self.stdout.write(f"throughput        {result['messages_per_s']:.0f} messages/s, {result['deliveries_per_s']:.0f} deliveries/s")
+        self.stdout.write(f"delivered         {result['deliveries']} of {result['expected_deliveries']} chat frames")
+        self.stdout.write(f"fan-out p50/95/99 {chat['p50']:.1f} / {chat['p95']:.1f} / {chat['p99']:.1f} ms")
+        if result["dashboard_latency_ms"] is not None:
+            dash = result["dashboard_latency_ms"]
+            self.stdout.write(f"dashboard p50/99  {dash['p50']:.1f} / {dash['p99']:.1f} ms")
+        self.stdout.write(f"queries/message   {result['queries_per_message']:.2f} ({result['connect_queries']} to connect)")
+        self.stdout.write(f"results           {output}")
+
+    # ---------- FIXTURES ----------
+
+    def create_fixtures(self, token, options):
+        users, rooms = [], []
+        for r in range(options["rooms"]):
+            members = [
+                User.objects.create_user(f"bench_{token}_{r}_{i}")
+                for i in range(options["users_per_room"])
+            ]
+            room = ChatRoom.objects.create(name=f"bench {token} {r}")
+            room.participants.add(*members)
+            rooms.append((room.id, [u.id for u in members]))
+            users.extend(members)
+        return rooms, users
+
+    def delete_fixtures(self, rooms, users):
+        ChatRoom.objects.filter(id__in=[room_id for room_id, _ in rooms]).delete()
+        User.objects.filter(id__in=[u.id for u in users]).delete()
+
+    def session_cookie(self, user):
+        # What login() stores, without a request
+        store = import_module(settings.SESSION_ENGINE).SessionStore()
+        store[SESSION_KEY] = str(user.pk)
+        store[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        store[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        store.save()
+        return f"{settings.SESSION_COOKIE_NAME}={store.session_key}"
+
+    # ---------- RUN ----------
+
+    async def run(self, application, rooms, cookies, counter, options):
+        host = self.allowed_host()
+        sent_at = {}
+        chat_latencies, dashboard_latencies = [], []
+
+        def communicator(cookie, path):
+            return WebsocketCommunicator(application, path, headers=[
+                (b"cookie", cookie.encode()),
+                (b"origin", f"http://{host}".encode()),
+                (b"host", host.encode()),
+            ])
+
+        # Connect everything first, so connecting is not counted as messaging
+        chat_sockets = []  # (room index, user id, communicator)
+        for index, (room_id, member_ids) in enumerate(rooms):
+            for user_id in member_ids:
+                comm = communicator(cookies[user_id], f"/ws/chat/{room_id}/")
+                connected, _ = await comm.connect()
+                if not connected:
+                    raise RuntimeError(f"Chat socket for room {room_id} was refused")
+                chat_sockets.append((index, user_id, comm))
+
+        dashboard_sockets = []  # (room index, user id, communicator)
+        if not options["no_dashboards"]:
+            for index, (_, member_ids) in enumerate(rooms):
+                for user_id in member_ids:
+                    comm = communicator(cookies[user_id], "/ws/notify/")
+                    connected, _ = await comm.connect()
+                    if not connected:
+                        raise RuntimeError("Dashboard socket was refused")
+                    dashboard_sockets.append((index, user_id, comm))
+
+        connect_queries = counter.total
+        per_room = options["users_per_room"] * options["messages"]
+        deadline = time.perf_counter() + options["timeout"]
+
+        async def receive(comm, frame_type, expected, latencies):
+            got = 0
+            while got < expected:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    data = json.loads(await comm.receive_from(timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+                if data.get("type") != frame_type:
+                    continue
+                key = data.get("message", "")
+                if key in sent_at:
+                    latencies.append((time.perf_counter() - sent_at[key]) * 1000)
+                    got += 1
+            return got
+
+        async def send(index, user_id, comm):
+            interval = 1 / options["rate"] if options["rate"] > 0 else 0
+            next_at = time.perf_counter()
+            for seq in range(options["messages"]):
+                if interval:
+                    await asyncio.sleep(max(next_at - time.perf_counter(), 0))
+                    next_at += interval
+                key = f"bench {index}:{user_id}:{seq}"
+                sent_at[key] = time.perf_counter()
+                await comm.send_to(text_data=json.dumps({"message": key}))
+                if not interval:
+                    await asyncio.sleep(0)
+
+        # Every participant sees every chat frame of its room, the sender included;
+        # a dashboard gets a notification for each message from the others
+        receivers = [
+            asyncio.create_task(receive(comm, "chat", per_room, chat_latencies))
+            for _, _, comm in chat_sockets
+        ] + [
+            asyncio.create_task(
+                receive(comm, "notification", per_room - options["messages"], dashboard_latencies)
+            )
+            for _, _, comm in dashboard_sockets
+        ]
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send(index, user_id, comm) for index, user_id, comm in chat_sockets))
+        received = await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - started
+
+        # Write-behind stores after the broadcast; let its last batch land
+        if write_behind_enabled():
+            await asyncio.sleep(getattr(settings, "CHATIX_WRITE_BEHIND_INTERVAL", 0.25) * 4)
+        message_queries = counter.total - connect_queries
+
+        for _, _, comm in chat_sockets + dashboard_sockets:
+            await comm.disconnect()
+
+        messages_sent = len(sent_at)
+        deliveries = sum(received[:len(chat_sockets)])
+        channel_layer = get_channel_layer()
+
+        return {
+            "sockets": len(chat_sockets) + len(dashboard_sockets),
+            "messages_sent": messages_sent,
+            "elapsed_s": elapsed,
+            "messages_per_s": messages_sent / elapsed,
+            "deliveries": deliveries,
+            "expected_deliveries": len(chat_sockets) * per_room,
+            "deliveries_per_s": deliveries / elapsed,
+            "chat_latency_ms": self.summary(chat_latencies),
+            "dashboard_latency_ms": self.summary(dashboard_latencies) if dashboard_sockets else None,
+            "connect_queries": connect_queries,
+            "message_queries": message_queries,
+            "queries_per_message": message_queries / messages_sent if messages_sent else 0,
+            "channel_layer_stats": channel_layer.stats() if hasattr(channel_layer, "stats") else None,
+        }
+
+    def summary(self, latencies):
+        ordered = sorted(latencies)
+        return {
+            "count": len(ordered),
+            "mean": statistics.fmean(ordered) if ordered else 0,
+            "p50": percentile(ordered, 50),
+            "p95": percentile(ordered, 95),
+            "p99": percentile(ordered, 99),
+            "max": ordered[-1] if ordered else 0,
+        }
+
+    def allowed_host(self):
+        # The sockets have to pass AllowedHostsOriginValidator
+        for host in settings.ALLOWED_HOSTS:
+            if host == "*":
+                return "localhost"
+            if host.startswith("."):
+                return "bench" + host
+            return host
+        return "localhost"
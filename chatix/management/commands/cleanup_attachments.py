@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatix.attachments import purge_stale_attachments
+
+
+class Command(BaseCommand):
+    help = (
+        "Drop uploads that were never finished, uploaded files that were never sent "
+        "and stored blobs no message uses any more (run it from cron)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours", type=int, default=getattr(settings, "CHATIX_UPLOAD_EXPIRY_HOURS", 24),
+            help="Only touch what is older than this (default CHATIX_UPLOAD_EXPIRY_HOURS)"
+        )
+
+    def handle(self, *args, **options):
+        uploads, unsent, blobs = purge_stale_attachments(timedelta(hours=options["hours"]))
+        self.stdout.write(
+            f"Removed {uploads} unfinished uploads, {unsent} unsent attachments and {blobs} unused blobs"
+        )
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from chatix.avatars import AVATAR_SIZES, generate_thumbnails
+from chatix.models import UserInfo
+
+
+class Command(BaseCommand):
+    help = (
+        f"Render the {'/'.join(map(str, AVATAR_SIZES))} px avatar thumbnails for profile "
+        "pictures that do not have them yet (uploads made before thumbnails existed)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Re-render avatars that already have thumbnails")
+
+    def handle(self, *args, **options):
+        infos = UserInfo.objects.exclude(image="").exclude(image__isnull=True)
+        if not options["all"]:
+            infos = infos.filter(thumbnails={})
+
+        done = failed = 0
+        for info_id, name in infos.values_list("id", "image").iterator():
+            try:
+                if generate_thumbnails(info_id, name):
+                    done += 1
+            except OSError as exc:
+                failed += 1
+                self.stderr.write(f"{name}: {exc}")
+        self.stdout.write(f"Rendered thumbnails for {done} avatars ({failed} failed)")
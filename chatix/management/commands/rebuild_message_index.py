@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chatix.search import SEARCH_TABLE, rebuild_index, search_backend
+
+
+class Command(BaseCommand):
+    help = f"Rebuild the full-text message index ({SEARCH_TABLE}) from chatix_message"
+
+    def handle(self, *args, **options):
+        if search_backend() is None:
+            self.stderr.write("This database has no full-text index, search falls back to icontains")
+            return
+
+        with transaction.atomic():
+            count = rebuild_index()
+        self.stdout.write(f"Indexed {count} messages")
@@ -0,0 +1,31 @@
+import asyncio
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatix.layers.broker import DEFAULT_SOCKET_PATH, ChannelBroker
+
+
+class Command(BaseCommand):
+    help = "Run the Unix socket broker used by chatix.layers.broker.BrokerChannelLayer"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            help="Socket path (defaults to CHANNEL_LAYERS['default']['CONFIG']['path'])",
+        )
+
+    def handle(self, *args, **options):
+        config = settings.CHANNEL_LAYERS.get("default", {}).get("CONFIG", {})
+        broker = ChannelBroker(
+            path=options["path"] or config.get("path", DEFAULT_SOCKET_PATH),
+            expiry=config.get("expiry", 60),
+            group_expiry=config.get("group_expiry", 86400),
+            capacity=config.get("capacity", 100),
+            channel_capacity=config.get("channel_capacity"),
+        )
+        self.stdout.write(f"Channel broker listening on {broker.path}")
+        try:
+            asyncio.run(broker.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,189 @@
+"""
+Serving /media/ (avatars and other uploads).
+
+An async view on purpose: file reads run on a small thread pool of their
+own (CHATIX_MEDIA_IO_THREADS) and stream back chunk by chunk, so a burst
+of avatar requests neither holds a worker per file nor queues behind the
+database threads the chat sockets use.
+
+- content-hashed names (chatix.storage) get their hash as a strong ETag
+  and "immutable" with a one year max-age; anything else gets a size/mtime
+  ETag and a short max-age
+- If-None-Match / If-Modified-Since answer 304, a single "bytes=" Range
+  (honouring If-Range) answers 206, an unsatisfiable one 416
+- with CHATIX_MEDIA_ACCEL_REDIRECT set (e.g. "/protected-media/") the body
+  is left to the front proxy via X-Accel-Redirect, which sends the file
+  with sendfile(2) and handles Range itself
+"""
+import asyncio
+import mimetypes
+import os
+import re
+import stat
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+
+from .storage import content_hash
+
+CHUNK_SIZE = 64 * 1024
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=3600"
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Compressed files are served as they are, never with Content-Encoding (as FileResponse does)
+_ENCODING_TYPES = {
+    "br": "application/x-brotli",
+    "bzip2": "application/x-bzip",
+    "compress": "application/x-compress",
+    "gzip": "application/gzip",
+    "xz": "application/x-xz",
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "CHATIX_MEDIA_IO_THREADS", 4),
+                thread_name_prefix="chatix-media",
+            )
+        return _executor
+
+
+async def _run(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_get_executor(), fn, *args)
+
+
+async def serve_media(request, path):
+    digest = content_hash(path)
+    return await serve_file(
+        request, settings.MEDIA_ROOT, path,
+        digest=digest,
+        cache_control=IMMUTABLE_CACHE_CONTROL if digest else MUTABLE_CACHE_CONTROL,
+        accel=getattr(settings, "CHATIX_MEDIA_ACCEL_REDIRECT", ""),
+    )
+
+
+async def serve_file(request, root, path, *, digest=None, cache_control=MUTABLE_CACHE_CONTROL,
+                     accel="", content_type=None, extra_headers=None):
+    """
+    Conditional, range-aware streaming of root/path. ``digest`` (a hash of
+    the content) becomes the ETag, ``accel`` is the X-Accel-Redirect prefix
+    root is aliased to, ``content_type`` overrides the guess from the name.
+    """
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponse(status=405, headers={"Allow": "GET, HEAD"})
+
+    try:
+        full_path = safe_join(root, path)
+        file_stat = await _run(os.stat, full_path)
+    except (SuspiciousFileOperation, FileNotFoundError, NotADirectoryError):
+        raise Http404("No such file")
+    if not stat.S_ISREG(file_stat.st_mode):
+        raise Http404("No such file")
+
+    etag = f'"{digest}"' if digest else f'"{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(file_stat.st_mtime),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        **(extra_headers or {}),
+    }
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(file_stat.st_mtime))
+    if response is not None:
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    if content_type is None:
+        guessed_type, encoding = mimetypes.guess_type(full_path)
+        # foo.tar.gz is a gzip file to download, not a tarball for the browser to unpack
+        content_type = _ENCODING_TYPES.get(encoding, guessed_type) or "application/octet-stream"
+
+    if accel:
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response["X-Accel-Redirect"] = accel.rstrip("/") + "/" + path.lstrip("/")
+        return response
+
+    start, end = 0, file_stat.st_size - 1
+    status = 200
+    byte_range = _requested_range(request, etag, file_stat.st_size)
+    if byte_range == "unsatisfiable":
+        return HttpResponse(status=416, headers={**headers, "Content-Range": f"bytes */{file_stat.st_size}"})
+    if byte_range is not None:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_stat.st_size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+
+    if request.method == "HEAD":
+        return HttpResponse(status=status, content_type=content_type, headers=headers)
+
+    return StreamingHttpResponse(
+        _read(full_path, start, end - start + 1),
+        status=status,
+        content_type=content_type,
+        headers=headers,
+    )
+
+
+def _requested_range(request, etag, size):
+    """(first, last) byte for a single satisfiable Range, "unsatisfiable", or None for all"""
+    header = request.headers.get("Range")
+    if not header or size == 0:
+        return None
+
+    # If-Range: only a range of the version the client already has
+    if_range = request.headers.get("If-Range")
+    if if_range and etag not in parse_etags(if_range):
+        return None
+
+    match = _RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None  # several ranges or malformed: ignoring Range is allowed
+
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return "unsatisfiable"
+        return max(size - length, 0), size - 1
+
+    first = int(first)
+    if last != "" and int(last) < first:
+        return None  # invalid, and RFC 9110 says to ignore an invalid Range
+    if first >= size:
+        return "unsatisfiable"
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    return first, last
+
+
+async def _read(path, offset, length):
+    handle = await _run(open, path, "rb")
+    try:
+        await _run(handle.seek, offset)
+        while length > 0:
+            chunk = await _run(handle.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        await _run(handle.close)
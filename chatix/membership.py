@@ -0,0 +1,147 @@
+"""
+Membership and favorite checks for views and consumers.
+
+"Is user U in room R" and "is R a favorite of U" are each one indexed
+EXISTS on the m2m through table, and the answers (yes and no) are kept in
+a small in-process LRU cache with a TTL. Participant and favorite changes
+drop the affected entries when they commit (chatix.signals); the TTL bounds
+how long other worker processes can go on using an old answer. Checks whose
+answer lasts longer than a request (opening a socket) pass fresh=True and
+always ask the database.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import ChatRoom
+
+MEMBER = "member"
+FAVORITE = "favorite"
+
+_THROUGH = {
+    MEMBER: ChatRoom.participants.through,
+    FAVORITE: ChatRoom.favorited_by.through,
+}
+
+
+class MembershipCache:
+
+    def __init__(self, size=10000, ttl=30):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (kind, room id, user id) -> (stored at, answer)
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so a lookup that raced one is not stored
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, answer, generation):
+        if self.size <= 0:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic(), answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, kind, room_ids=None, user_ids=None):
+        """Drop answers of one kind for the given rooms and/or users (None matches all)"""
+        room_ids = None if room_ids is None else {int(r) for r in room_ids}
+        user_ids = None if user_ids is None else {int(u) for u in user_ids}
+        with self._lock:
+            self.generation += 1
+            stale = [
+                key for key in self._entries
+                if key[0] == kind
+                and (room_ids is None or key[1] in room_ids)
+                and (user_ids is None or key[2] in user_ids)
+            ]
+            for key in stale:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+membership_cache = MembershipCache(
+    size=getattr(settings, "CHATIX_MEMBERSHIP_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "CHATIX_MEMBERSHIP_CACHE_TTL", 30),
+)
+
+
+def _query(kind, room_id, user_id):
+    return _THROUGH[kind].objects.filter(chatroom_id=room_id, user_id=user_id)
+
+
+def _key(kind, room_id, user_id):
+    try:
+        return (kind, int(room_id), int(user_id))
+    except (TypeError, ValueError):
+        return None  # not an id at all, e.g. from a URL
+
+
+def _check(kind, room_id, user_id):
+    key = _key(kind, room_id, user_id)
+    if key is None:
+        return False
+    answer = membership_cache.get(key)
+    if answer is None:
+        generation = membership_cache.generation
+        answer = _query(kind, room_id, user_id).exists()
+        membership_cache.put(key, answer, generation)
+    return answer
+
+
+async def _acheck(kind, room_id, user_id, fresh=False):
+    # A cache hit never leaves the event loop
+    key = _key(kind, room_id, user_id)
+    if key is None:
+        return False
+    answer = None if fresh else membership_cache.get(key)
+    if answer is None:
+        generation = membership_cache.generation
+        answer = await _query(kind, room_id, user_id).aexists()
+        membership_cache.put(key, answer, generation)
+    return answer
+
+
+def is_member(room_id, user_id):
+    return _check(MEMBER, room_id, user_id)
+
+
+async def ais_member(room_id, user_id, fresh=False):
+    return await _acheck(MEMBER, room_id, user_id, fresh)
+
+
+def is_favorite(room_id, user_id):
+    return _check(FAVORITE, room_id, user_id)
+
+
+async def ais_favorite(room_id, user_id):
+    return await _acheck(FAVORITE, room_id, user_id)
+
+
+def invalidate_membership(kind, room_ids=None, user_ids=None):
+    """Forget answers once the change that made them wrong is committed"""
+    room_ids = None if room_ids is None else list(room_ids)
+    user_ids = None if user_ids is None else list(user_ids)
+    transaction.on_commit(
+        lambda: membership_cache.invalidate(kind, room_ids=room_ids, user_ids=user_ids)
+    )
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0005_chatroom_favorited_by'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'created_at', 'id'], name='message_room_history_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0006_message_room_history_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='chatix.chatroom')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['chatroom', 'deleted_at'], name='tombstone_room_deleted_idx')],
+            },
+        ),
+    ]
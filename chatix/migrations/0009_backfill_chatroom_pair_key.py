@@ -0,0 +1,79 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def is_self_chat_name(name):
+    """
+    Rooms were named "<sender> & <receiver>", so a chat with yourself
+    repeats the username. A room left with one member because the other
+    user was deleted keeps two different names and is not one.
+    """
+    left, separator, right = name.partition(' & ')
+    return bool(separator) and left == right
+
+
+def backfill_pair_keys(apps, schema_editor):
+    """
+    Give every 1:1 room its pair_key. When two users already have several
+    rooms, keep the oldest one and fold the others into it. Rooms with one
+    member that were not a chat with yourself keep pair_key NULL.
+    """
+    ChatRoom = apps.get_model('chatix', 'ChatRoom')
+    Message = apps.get_model('chatix', 'Message')
+    MessageTombstone = apps.get_model('chatix', 'MessageTombstone')
+    Participants = ChatRoom.participants.through
+
+    members = defaultdict(list)
+    for room_id, user_id in Participants.objects.values_list('chatroom_id', 'user_id'):
+        members[room_id].append(user_id)
+
+    single_ids = [room_id for room_id, user_ids in members.items() if len(user_ids) == 1]
+    self_chat_ids = {
+        room_id
+        for room_id, name in ChatRoom.objects.filter(id__in=single_ids).values_list('id', 'name')
+        if is_self_chat_name(name)
+    }
+
+    rooms_by_key = defaultdict(list)
+    for room_id, user_ids in members.items():
+        if len(user_ids) == 1:
+            if room_id not in self_chat_ids:
+                continue  # orphaned: the other participant is gone
+            user_ids = user_ids * 2  # a chat with yourself
+        if len(user_ids) != 2:
+            continue
+        low, high = sorted(user_ids)
+        rooms_by_key[f"{low}:{high}"].append(room_id)
+
+    for pair_key, room_ids in rooms_by_key.items():
+        keeper_id, *duplicate_ids = sorted(room_ids)
+
+        if duplicate_ids:
+            keeper = ChatRoom.objects.get(id=keeper_id)
+            duplicates = ChatRoom.objects.filter(id__in=duplicate_ids)
+
+            Message.objects.filter(chatroom_id__in=duplicate_ids).update(chatroom_id=keeper_id)
+            MessageTombstone.objects.filter(chatroom_id__in=duplicate_ids).update(chatroom_id=keeper_id)
+
+            # Favorite if any copy was; hidden only if every copy was
+            for room in duplicates:
+                keeper.favorited_by.add(*room.favorited_by.all())
+                keeper.hidden_for.set(
+                    keeper.hidden_for.filter(id__in=room.hidden_for.values('id'))
+                )
+
+            duplicates.delete()
+
+        ChatRoom.objects.filter(id=keeper_id).update(pair_key=pair_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0008_chatroom_pair_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_pair_keys, migrations.RunPython.noop),
+    ]
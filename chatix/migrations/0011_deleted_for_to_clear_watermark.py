@@ -0,0 +1,80 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def deleted_for_to_watermarks(apps, schema_editor):
+    """
+    Turn the rows left behind by the old "clear chat" into watermarks.
+
+    For every (user, room), the leading run of messages the user deleted
+    becomes one ClearWatermark; those deleted_for rows are dropped. Deletes
+    after the first message still visible to the user stay selective.
+    """
+    Message = apps.get_model('chatix', 'Message')
+    ClearWatermark = apps.get_model('chatix', 'ClearWatermark')
+    DeletedFor = Message.deleted_for.through
+
+    deleted = defaultdict(set)  # room_id -> {(user_id, message_id)}
+    rows = DeletedFor.objects.values_list('message__chatroom_id', 'user_id', 'message_id')
+    for room_id, user_id, message_id in rows.iterator():
+        deleted[room_id].add((user_id, message_id))
+
+    for room_id, pairs in deleted.items():
+        messages = list(
+            Message.objects.filter(chatroom_id=room_id)
+            .order_by('created_at', 'id')
+            .values_list('id', 'created_at')
+        )
+
+        by_user = defaultdict(set)
+        for user_id, message_id in pairs:
+            by_user[user_id].add(message_id)
+
+        for user_id, message_ids in by_user.items():
+            first_visible = next(
+                (created_at for msg_id, created_at in messages if msg_id not in message_ids),
+                None,
+            )
+            # Strictly before the first visible message, so ties stay visible
+            prefix = [
+                (msg_id, created_at) for msg_id, created_at in messages
+                if first_visible is None or created_at < first_visible
+            ]
+            if not prefix:
+                continue
+
+            ClearWatermark.objects.update_or_create(
+                user_id=user_id, chatroom_id=room_id,
+                defaults={'cleared_at': prefix[-1][1]},
+            )
+            DeletedFor.objects.filter(
+                user_id=user_id, message_id__in=[msg_id for msg_id, _ in prefix]
+            ).delete()
+
+
+def watermarks_to_deleted_for(apps, schema_editor):
+    Message = apps.get_model('chatix', 'Message')
+    ClearWatermark = apps.get_model('chatix', 'ClearWatermark')
+    DeletedFor = Message.deleted_for.through
+
+    for mark in ClearWatermark.objects.iterator():
+        message_ids = Message.objects.filter(
+            chatroom_id=mark.chatroom_id, created_at__lte=mark.cleared_at
+        ).values_list('id', flat=True)
+        DeletedFor.objects.bulk_create(
+            [DeletedFor(user_id=mark.user_id, message_id=msg_id) for msg_id in message_ids],
+            ignore_conflicts=True,
+        )
+    ClearWatermark.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0010_clearwatermark'),
+    ]
+
+    operations = [
+        migrations.RunPython(deleted_for_to_watermarks, watermarks_to_deleted_for),
+    ]
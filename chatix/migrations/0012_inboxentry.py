@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0011_deleted_for_to_clear_watermark'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_sender_id', models.IntegerField(blank=True, null=True)),
+                ('snippet', models.CharField(blank=True, max_length=120)),
+                ('last_activity_at', models.DateTimeField()),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('is_hidden', models.BooleanField(default=False)),
+                ('is_favorite', models.BooleanField(default=False)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chatix.chatroom')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'is_hidden', '-last_activity_at'], name='inbox_user_activity_idx'), models.Index(fields=['user', 'is_favorite', '-last_activity_at'], name='inbox_user_favorite_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'chatroom'), name='unique_inbox_entry')],
+            },
+        ),
+    ]
@@ -0,0 +1,66 @@
+from collections import defaultdict
+
+from django.db import migrations
+
+
+def backfill_inbox(apps, schema_editor):
+    """
+    One inbox row per participant per room, seeded from the newest message.
+    Unread counts start at zero: nothing tracked reads before this.
+    """
+    ChatRoom = apps.get_model('chatix', 'ChatRoom')
+    Message = apps.get_model('chatix', 'Message')
+    InboxEntry = apps.get_model('chatix', 'InboxEntry')
+
+    members = defaultdict(list)
+    for room_id, user_id in ChatRoom.participants.through.objects.values_list('chatroom_id', 'user_id'):
+        members[room_id].append(user_id)
+
+    hidden = set(ChatRoom.hidden_for.through.objects.values_list('chatroom_id', 'user_id'))
+    favorite = set(ChatRoom.favorited_by.through.objects.values_list('chatroom_id', 'user_id'))
+
+    entries = []
+    for room in ChatRoom.objects.only('id', 'created_at').iterator():
+        participant_ids = members.get(room.id, [])
+        if not participant_ids:
+            continue
+
+        last = Message.objects.filter(chatroom_id=room.id).order_by('-created_at', '-id').first()
+
+        for user_id in participant_ids:
+            others = [pid for pid in participant_ids if pid != user_id]
+            if not others:
+                peer_id = user_id
+            elif len(others) == 1:
+                peer_id = others[0]
+            else:
+                peer_id = None
+
+            entries.append(InboxEntry(
+                user_id=user_id,
+                chatroom_id=room.id,
+                peer_id=peer_id,
+                last_message_id=last.id if last else None,
+                last_sender_id=last.sender_id if last else None,
+                snippet=last.content[:120] if last else '',
+                last_activity_at=last.created_at if last else room.created_at,
+                is_hidden=(room.id, user_id) in hidden,
+                is_favorite=(room.id, user_id) in favorite,
+            ))
+
+    InboxEntry.objects.bulk_create(entries, batch_size=500, ignore_conflicts=True)
+
+
+def drop_inbox(apps, schema_editor):
+    apps.get_model('chatix', 'InboxEntry').objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0012_inboxentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_inbox, drop_inbox),
+    ]
@@ -0,0 +1,57 @@
+from django.db import migrations
+
+# Frozen copies of the schema and backfill in chatix.search at the time of
+# this migration, so replaying it never depends on how that module changes.
+SEARCH_TABLE = 'chatix_message_search'
+
+SQLITE_CREATE = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+    "content, chatroom_id UNINDEXED, tokenize='unicode61 remove_diacritics 2')",
+]
+SQLITE_BACKFILL = (
+    f"INSERT INTO {SEARCH_TABLE} (rowid, chatroom_id, content) "
+    "SELECT id, chatroom_id, content FROM chatix_message"
+)
+
+POSTGRESQL_CREATE = [
+    f"CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} ("
+    "message_id bigint PRIMARY KEY, chatroom_id bigint NOT NULL, document tsvector NOT NULL)",
+    f"CREATE INDEX IF NOT EXISTS {SEARCH_TABLE}_document_idx "
+    f"ON {SEARCH_TABLE} USING GIN (document)",
+]
+POSTGRESQL_BACKFILL = (
+    f"INSERT INTO {SEARCH_TABLE} (message_id, chatroom_id, document) "
+    "SELECT id, chatroom_id, to_tsvector('simple', content) FROM chatix_message"
+)
+
+
+def create_index(apps, schema_editor):
+    """FTS5 on SQLite, tsvector + GIN on PostgreSQL, nothing elsewhere"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements, backfill = SQLITE_CREATE, SQLITE_BACKFILL
+    elif vendor == 'postgresql':
+        statements, backfill = POSTGRESQL_CREATE, POSTGRESQL_BACKFILL
+    else:
+        return
+
+    for sql in statements:
+        schema_editor.execute(sql)
+    schema_editor.execute(f"DELETE FROM {SEARCH_TABLE}")
+    schema_editor.execute(backfill)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('sqlite', 'postgresql'):
+        schema_editor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0014_inboxentry_last_read_message_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
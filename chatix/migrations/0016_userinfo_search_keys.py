@@ -0,0 +1,39 @@
+# Generated by Django 5.2.8 on 2026-10-17 14:47
+
+from django.db import migrations, models
+
+
+def fill_search_keys(apps, schema_editor):
+    UserInfo = apps.get_model('chatix', 'UserInfo')
+    infos = list(UserInfo.objects.select_related('user'))
+    for info in infos:
+        info.username_key = info.user.username.lower()
+        info.name_key = info.name.strip().lower()[:30]
+        info.email_key = info.email.strip().lower()
+    UserInfo.objects.bulk_update(infos, ['username_key', 'name_key', 'email_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0015_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userinfo',
+            name='email_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=254),
+        ),
+        migrations.AddField(
+            model_name='userinfo',
+            name='name_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=30),
+        ),
+        migrations.AddField(
+            model_name='userinfo',
+            name='username_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=150),
+        ),
+        migrations.RunPython(fill_search_keys, migrations.RunPython.noop),
+    ]
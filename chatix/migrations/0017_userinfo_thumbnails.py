@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0016_userinfo_search_keys'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userinfo',
+            name='thumbnails',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
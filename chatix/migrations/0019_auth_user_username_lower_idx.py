@@ -0,0 +1,36 @@
+from django.db import migrations
+
+# Accounts without a UserInfo have no username_key; chatix.directory matches
+# them on lower(username) instead. auth_user belongs to django.contrib.auth,
+# so the index is plain SQL rather than a Meta.indexes entry.
+INDEX = 'chatix_auth_user_username_lower_idx'
+
+CREATE = {
+    # Served by key >= prefix AND key < prefix || U+10FFFF ranges
+    'sqlite': f"CREATE INDEX IF NOT EXISTS {INDEX} ON auth_user (lower(username))",
+    # text_pattern_ops serves LIKE 'prefix%' under any collation
+    'postgresql': f"CREATE INDEX IF NOT EXISTS {INDEX} ON auth_user (lower(username) text_pattern_ops)",
+}
+
+
+def create_index(apps, schema_editor):
+    sql = CREATE.get(schema_editor.connection.vendor)
+    if sql:
+        schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor in CREATE:
+        schema_editor.execute(f"DROP INDEX IF EXISTS {INDEX}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatix', '0018_blob_attachment_upload'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
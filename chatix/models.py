@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 
@@ -11,6 +13,21 @@ class UserInfo(models.Model):
     email = models.EmailField(unique=True)
     phone = models.CharField(max_length=10, unique=True)
     image = models.ImageField(upload_to="profile_images/", blank=True, null=True)
+    # 🖼️ Size ("48", "96", "256") -> stored thumbnail name, filled in by chatix.avatars
+    thumbnails = models.JSONField(default=dict, blank=True, editable=False)
+
+    # 🔎 Lowercased copies for indexed prefix search (see chatix.directory)
+    username_key = models.CharField(max_length=150, blank=True, db_index=True, editable=False)
+    name_key = models.CharField(max_length=30, blank=True, db_index=True, editable=False)
+    email_key = models.CharField(max_length=254, blank=True, db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.username_key = self.user.username.lower()
+        self.name_key = self.name.strip().lower()[:30]
+        self.email_key = self.email.strip().lower()
+        if kwargs.get("update_fields") is not None:
+            kwargs["update_fields"] = {*kwargs["update_fields"], "username_key", "name_key", "email_key"}
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return self.name
@@ -22,6 +39,14 @@ class UserInfo(models.Model):
 class ChatRoom(models.Model):
     name = models.CharField(max_length=100)
 
+    # "<lower user id>:<higher user id>" for 1:1 chats, NULL for anything else
+    pair_key = models.CharField(
+        max_length=41,
+        unique=True,
+        null=True,
+        blank=True
+    )
+
     participants = models.ManyToManyField(
         User,
         related_name="chatrooms"
@@ -43,6 +68,12 @@ class ChatRoom(models.Model):
         blank=True
     )
 
+    @staticmethod
+    def direct_pair_key(user_id, other_user_id):
+        """Canonical key of the 1:1 chat between two users (order independent)"""
+        low, high = sorted((user_id, other_user_id))
+        return f"{low}:{high}"
+
     def is_visible_for(self, user):
         """Check if room is visible for a user"""
         return user not in self.hidden_for.all()
@@ -84,11 +115,17 @@ class Message(models.Model):
 
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            # Keyset pagination of a room's history on (created_at, id)
+            models.Index(fields=["chatroom", "created_at", "id"], name="message_room_history_idx"),
+        ]
 
     # ---------- HELPERS ----------
 
     def is_visible_for(self, user):
         """Check if message is visible for a user"""
+        if self.chatroom.clear_watermarks.filter(user=user, cleared_at__gte=self.created_at).exists():
+            return False
         return user not in self.deleted_for.all()
 
     def delete_for_user(self, user):
@@ -101,3 +138,197 @@ class Message(models.Model):
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:30]}"
+
+
+# =========================
+# CLEAR CHAT (per user)
+# =========================
+class ClearWatermark(models.Model):
+    """Everything in the room up to cleared_at is hidden for this user"""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="clear_watermarks"
+    )
+
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name="clear_watermarks"
+    )
+
+    cleared_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "chatroom"], name="unique_clear_watermark"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} cleared {self.chatroom} at {self.cleared_at}"
+
+
+# =========================
+# INBOX (one row per user per room)
+# =========================
+class InboxEntry(models.Model):
+    """
+    Denormalized dashboard row so the chat list is a single indexed scan.
+    Messages update it in chatix.services, membership, hide and favorite
+    changes through the m2m signals in chatix.signals.
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="inbox"
+    )
+
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name="inbox_entries"
+    )
+
+    # Who the card shows: the other person of a 1:1 chat, yourself for a self chat
+    peer = models.ForeignKey(
+        User,
+        on_delete=models.SET_NULL,
+        related_name="+",
+        null=True,
+        blank=True
+    )
+
+    # Plain ids: the message may be gone or (write-behind) not stored yet
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_sender_id = models.IntegerField(null=True, blank=True)
+    snippet = models.CharField(max_length=120, blank=True)
+    last_activity_at = models.DateTimeField()
+
+    unread_count = models.PositiveIntegerField(default=0)
+    # Read cursor: everything up to this message id has been seen
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+
+    is_hidden = models.BooleanField(default=False)
+    is_favorite = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "chatroom"], name="unique_inbox_entry"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "is_hidden", "-last_activity_at"], name="inbox_user_activity_idx"),
+            models.Index(fields=["user", "is_favorite", "-last_activity_at"], name="inbox_user_favorite_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username}: {self.chatroom}"
+
+
+# =========================
+# DELETED MESSAGE LOG
+# =========================
+class MessageTombstone(models.Model):
+    """Remembers deleted messages so reconnecting clients can drop them too"""
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name="tombstones"
+    )
+
+    message_id = models.BigIntegerField()
+
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["chatroom", "deleted_at"], name="tombstone_room_deleted_idx"),
+        ]
+
+    def __str__(self):
+        return f"message {self.message_id} deleted at {self.deleted_at}"
+
+
+# =========================
+# ATTACHMENTS
+# =========================
+class Blob(models.Model):
+    """
+    One stored file, named after its sha256 (see chatix.attachments).
+    Every attachment with the same bytes shares it.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.size} bytes)"
+
+
+class Attachment(models.Model):
+    """A file as sent in a room: uploaded first, then linked to its message"""
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name="attachments"
+    )
+
+    uploader = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="attachments"
+    )
+
+    # NULL until the message carrying it is sent
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name="attachments",
+        null=True,
+        blank=True
+    )
+
+    blob = models.ForeignKey(
+        Blob,
+        on_delete=models.PROTECT,
+        related_name="attachments"
+    )
+
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    # Copy of blob.size, so listing attachments needs no join
+    size = models.BigIntegerField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename
+
+
+class Upload(models.Model):
+    """A chunked upload in progress; offset is how many bytes have arrived"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name="uploads"
+    )
+
+    chatroom = models.ForeignKey(
+        ChatRoom,
+        on_delete=models.CASCADE,
+        related_name="uploads"
+    )
+
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    # What the client says the file hashes to, checked on the last chunk
+    sha256 = models.CharField(max_length=64, blank=True)
+    offset = models.BigIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size})"
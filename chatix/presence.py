@@ -0,0 +1,132 @@
+"""
+Who is online, driven by the WebSocket consumers.
+
+Every ChatConsumer and DashboardConsumer connection counts towards its
+user being online; heartbeats and sent messages keep that fresh. Online/
+offline transitions are pushed to the ``presence_<user_id>`` group, which
+ChatConsumer joins for the other participants of its room.
+
+last_login doubles as "last seen". It is no longer written per message:
+the tracker coalesces it to one batched UPDATE per
+CHATIX_PRESENCE_WRITE_INTERVAL seconds.
+
+The tracker only sees this process's sockets. With several workers the
+channel broker keeps the counts for all of them (the layer's "presence"
+extension): a user comes online with their first socket on any worker and
+goes offline with their last. Heartbeats, last seen and the single-process
+in-memory layer stay with the tracker.
+"""
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .coalesce import CoalescingWriter
+
+
+def presence_group(user_id):
+    return f"presence_{user_id}"
+
+
+def _write_last_seen(batch):
+    from django.contrib.auth.models import User
+    from django.db.models import Case, DateTimeField, Value, When
+
+    User.objects.filter(id__in=batch.keys()).update(
+        last_login=Case(
+            *[When(id=user_id, then=Value(seen)) for user_id, seen in batch.items()],
+            output_field=DateTimeField(),
+        )
+    )
+
+
+class PresenceTracker:
+
+    def __init__(self, timeout=90, write_interval=60):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._connections = {}  # user_id -> open sockets
+        self._heartbeats = {}   # user_id -> time.monotonic() of last activity
+        self.last_seen = CoalescingWriter(
+            "presence last_seen", _write_last_seen, write_interval, merge=max
+        )
+
+    def connect(self, user_id):
+        """Count one more socket; True if the user just came online"""
+        with self._lock:
+            count = self._connections.get(user_id, 0)
+            self._connections[user_id] = count + 1
+            self._heartbeats[user_id] = time.monotonic()
+        self.last_seen.put(user_id, timezone.now())
+        return count == 0
+
+    def disconnect(self, user_id):
+        """Count one socket less; True if the user just went offline"""
+        with self._lock:
+            count = self._connections.get(user_id, 0) - 1
+            if count > 0:
+                self._connections[user_id] = count
+            else:
+                self._connections.pop(user_id, None)
+                self._heartbeats.pop(user_id, None)
+        self.last_seen.put(user_id, timezone.now())
+        return count <= 0
+
+    def heartbeat(self, user_id):
+        with self._lock:
+            if user_id in self._connections:
+                self._heartbeats[user_id] = time.monotonic()
+        self.last_seen.put(user_id, timezone.now())
+
+    def is_online(self, user_id):
+        with self._lock:
+            beat = self._heartbeats.get(user_id)
+        return beat is not None and time.monotonic() - beat < self.timeout
+
+    def online_user_ids(self, user_ids):
+        return [uid for uid in user_ids if self.is_online(uid)]
+
+
+presence = PresenceTracker(
+    timeout=getattr(settings, "CHATIX_PRESENCE_TIMEOUT", 90),
+    write_interval=getattr(settings, "CHATIX_PRESENCE_WRITE_INTERVAL", 60),
+)
+
+
+# =========================
+# ACROSS WORKERS
+# =========================
+
+def shared_presence(channel_layer):
+    return "presence" in getattr(channel_layer, "extensions", ())
+
+
+async def apresence_connect(channel_layer, user_id):
+    """Count a new socket; True if the user just came online (on any worker)"""
+    came_online = presence.connect(user_id)
+    if shared_presence(channel_layer):
+        came_online = await channel_layer.presence_add(user_id) == 1
+    return came_online
+
+
+async def apresence_disconnect(channel_layer, user_id):
+    """Count a closed socket; True if the user just went offline (on every worker)"""
+    went_offline = presence.disconnect(user_id)
+    if shared_presence(channel_layer):
+        went_offline = await channel_layer.presence_discard(user_id) == 0
+    return went_offline
+
+
+async def aonline_user_ids(channel_layer, user_ids):
+    if shared_presence(channel_layer):
+        return set(await channel_layer.presence_online(user_ids))
+    return set(presence.online_user_ids(user_ids))
+
+
+async def ais_active(channel_layer, user, window=timedelta(minutes=5)):
+    """Online on any worker, or seen recently according to the (coalesced) last_login"""
+    if user.id in await aonline_user_ids(channel_layer, [user.id]):
+        return True
+    return bool(user.last_login) and timezone.now() - user.last_login < window
@@ -0,0 +1,43 @@
+"""
+Read cursors, driven by ``{"type": "read"}`` frames on the ChatConsumer.
+
+The browser reports the newest message it has shown while the tab is
+visible. The consumer checks the id belongs to the room, then the receipt
+goes to the room group straight away; the cursor itself only lands in
+InboxEntry.last_read_message_id once per CHATIX_READ_WRITE_INTERVAL
+seconds, with every (room, user) that moved written in one transaction.
+Unread counts are recounted from the cursor in the same UPDATE.
+"""
+import logging
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, transaction
+
+from .coalesce import CoalescingWriter
+
+logger = logging.getLogger(__name__)
+
+
+def _write_read_cursors(batch):
+    from .services import mark_inbox_read
+
+    with transaction.atomic():
+        for (room_id, user_id), message_id in batch.items():
+            # A savepoint per cursor: one bad key is dropped, not retried with
+            # the whole batch forever. Connection errors still fail the batch.
+            try:
+                with transaction.atomic():
+                    mark_inbox_read(room_id, user_id, message_id)
+            except (DataError, IntegrityError, OverflowError) as exc:
+                logger.warning(
+                    "Dropped read cursor %s of user %s in room %s: %s", message_id, user_id, room_id, exc
+                )
+
+
+# (room_id, user_id) -> newest message id read; cursors only move forward
+read_cursors = CoalescingWriter(
+    "read cursors",
+    _write_read_cursors,
+    getattr(settings, "CHATIX_READ_WRITE_INTERVAL", 2),
+    merge=max,
+)
@@ -0,0 +1,182 @@
+"""
+Full-text search over message content.
+
+Messages are indexed into a side table as they are stored, so searching
+never scans chatix_message:
+
+* SQLite: an FTS5 virtual table, rowid = message id, ranked with bm25()
+* PostgreSQL: a tsvector table with a GIN index, ranked with ts_rank()
+
+The table is created by migration 0015 for whichever backend is in use
+and can be refilled from scratch with ``manage.py rebuild_message_index``.
+Other backends fall back to a scoped icontains.
+"""
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connection
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import ChatRoom, ClearWatermark, Message
+
+SEARCH_TABLE = "chatix_message_search"
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def search_backend(conn=None):
+    vendor = (conn or connection).vendor
+    return vendor if vendor in ("sqlite", "postgresql") else None
+
+
+# =========================
+# INDEX MAINTENANCE
+# =========================
+
+def index_messages(messages):
+    """Add (or refresh) messages in the search index, one statement per batch"""
+    backend = search_backend()
+    if backend is None or not messages:
+        return
+
+    rows = [(msg.id, msg.chatroom_id, msg.content) for msg in messages]
+    with connection.cursor() as cursor:
+        if backend == "sqlite":
+            # FTS5 has no upsert; INSERT OR REPLACE keys on rowid
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO {SEARCH_TABLE} (rowid, chatroom_id, content) VALUES (%s, %s, %s)",
+                rows
+            )
+        else:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (message_id, chatroom_id, document) "
+                "VALUES (%s, %s, to_tsvector('simple', %s)) "
+                "ON CONFLICT (message_id) DO UPDATE SET document = EXCLUDED.document",
+                rows
+            )
+
+
+def unindex_messages(message_ids):
+    backend = search_backend()
+    if backend is None or not message_ids:
+        return
+
+    key = "rowid" if backend == "sqlite" else "message_id"
+    placeholders = ", ".join(["%s"] * len(message_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE {key} IN ({placeholders})", list(message_ids))
+
+
+def unindex_room(room_id):
+    if search_backend() is None:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE chatroom_id = %s", [room_id])
+
+
+def rebuild_index(conn=None):
+    """Empty the index and refill it from chatix_message in one statement"""
+    conn = conn or connection
+    backend = search_backend(conn)
+    if backend is None:
+        return 0
+
+    document = "content" if backend == "sqlite" else "to_tsvector('simple', content)"
+    key = "rowid" if backend == "sqlite" else "message_id"
+    column = "content" if backend == "sqlite" else "document"
+    with conn.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE}")
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({key}, chatroom_id, {column}) "
+            f"SELECT id, chatroom_id, {document} FROM {Message._meta.db_table}"
+        )
+        return cursor.rowcount
+
+
+# =========================
+# QUERYING
+# =========================
+
+def search_messages(user, query, page=1, page_size=SEARCH_PAGE_SIZE):
+    """
+    Best matches first among messages the user can see: rooms they are in,
+    after their clear watermark, minus their deleted_for messages.
+    Returns (messages, has_next).
+    """
+    tokens = _TOKEN_RE.findall(query.lower())
+    if not tokens:
+        return [], False
+
+    offset = (page - 1) * page_size
+    backend = search_backend()
+    if backend is None:
+        ids = _fallback_ids(user, tokens, page_size + 1, offset)
+    else:
+        ids = _ranked_ids(backend, user, tokens, page_size + 1, offset)
+
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+
+    by_id = Message.objects.select_related("sender__userinfo", "chatroom").in_bulk(ids)
+    return [by_id[i] for i in ids if i in by_id], has_next
+
+
+def _ranked_ids(backend, user, tokens, limit, offset):
+    participants = ChatRoom.participants.through._meta.db_table
+    deleted_for = Message.deleted_for.through._meta.db_table
+    watermarks = ClearWatermark._meta.db_table
+    messages = Message._meta.db_table
+
+    if backend == "sqlite":
+        # Every token as a quoted prefix term, implicitly AND-ed
+        match = " ".join(f'"{token}"*' for token in tokens)
+        # FTS5 wants MATCH and bm25() on the table name itself, not an alias
+        source = f"{SEARCH_TABLE} JOIN {messages} m ON m.id = {SEARCH_TABLE}.rowid"
+        where = f"{SEARCH_TABLE} MATCH %s"
+        rank = f"bm25({SEARCH_TABLE})"  # lower is better
+    else:
+        match = " & ".join(f"{token}:*" for token in tokens)
+        source = (
+            f"{SEARCH_TABLE} s JOIN {messages} m ON m.id = s.message_id "
+            "CROSS JOIN to_tsquery('simple', %s) q"
+        )
+        where = "s.document @@ q"
+        rank = "-ts_rank(s.document, q)"
+
+    sql = (
+        f"SELECT m.id FROM {source} "
+        f"JOIN {participants} p ON p.chatroom_id = m.chatroom_id AND p.user_id = %s "
+        f"LEFT JOIN {watermarks} w ON w.chatroom_id = m.chatroom_id AND w.user_id = %s "
+        f"WHERE {where} "
+        "AND (w.cleared_at IS NULL OR m.created_at > w.cleared_at) "
+        f"AND NOT EXISTS (SELECT 1 FROM {deleted_for} d WHERE d.message_id = m.id AND d.user_id = %s) "
+        f"ORDER BY {rank}, m.id DESC LIMIT %s OFFSET %s"
+    )
+    # The tsquery sits in FROM on PostgreSQL, the MATCH in WHERE on SQLite
+    if backend == "sqlite":
+        params = [user.id, user.id, match, user.id, limit, offset]
+    else:
+        params = [match, user.id, user.id, user.id, limit, offset]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _fallback_ids(user, tokens, limit, offset):
+    # No full-text engine: same scoping, newest first, one icontains per token
+    cleared_at = ClearWatermark.objects.filter(
+        user_id=user.id, chatroom_id=OuterRef("chatroom_id")
+    ).values("cleared_at")[:1]
+
+    qs = Message.objects.filter(
+        chatroom__participants=user,
+        created_at__gt=Coalesce(Subquery(cleared_at), Value(_EPOCH)),
+    ).exclude(deleted_for=user)
+    for token in tokens:
+        qs = qs.filter(content__icontains=token)
+    return list(qs.order_by("-created_at", "-id").values_list("id", flat=True)[offset:offset + limit])
@@ -0,0 +1,559 @@
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.core.exceptions import ObjectDoesNotExist
+from django.contrib.auth.models import User
+from django.db.models import Case, Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed
+from django.utils import dateformat, timezone
+from django.utils.timezone import localtime
+
+from .models import ChatRoom, ClearWatermark, InboxEntry, Message, MessageTombstone, UserInfo
+from .attachments import ATTACHMENT_SNIPPET, link_attachments, serialize_attachment
+from .avatars import BUBBLE_AVATAR_SIZE, avatar_url
+from .db import QueryCounter
+from .search import index_messages, unindex_messages
+from .versions import bump_inbox_versions, bump_room_versions, bump_visibility
+from .writebehind import next_message_id
+
+logger = logging.getLogger(__name__)
+
+
+# =========================
+# ROOM CONTEXT
+# =========================
+
+def load_room_context(room_id, user):
+    """
+    Everything a ChatConsumer needs about its room, loaded once at connect
+    and again only when a room_context_changed event arrives.
+    """
+    room = ChatRoom.objects.filter(id=room_id).only("id", "name").first()
+    if room is None:
+        return None
+
+    return {
+        "room_name": room.name,
+        "participant_ids": list(room.participants.values_list("id", flat=True)),
+        "avatar_url": _avatar_url_for(user.id),
+    }
+
+
+def publish_room_changed(room_ids, user_id=None):
+    """Tell connected ChatConsumers to reload their room context"""
+    channel_layer = get_channel_layer()
+    for room_id in room_ids:
+        async_to_sync(channel_layer.group_send)(
+            f"chat_{room_id}",
+            {
+                "type": "room_context_changed",
+                "user_id": user_id,
+            }
+        )
+
+
+# =========================
+# MESSAGE HISTORY
+# =========================
+
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 200
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def visible_messages(room_id, user):
+    """Messages of a room after user's clear watermark, minus single deletes"""
+    return _visible_to(room_id, user.id).select_related("sender__userinfo").prefetch_related("attachments")
+
+
+def _visible_to(room_id, user_id):
+    cleared_at = ClearWatermark.objects.filter(
+        user_id=user_id, chatroom_id=room_id
+    ).values("cleared_at")[:1]
+
+    # One range predicate on the (chatroom, created_at, id) index
+    return Message.objects.filter(
+        chatroom_id=room_id,
+        created_at__gt=Coalesce(Subquery(cleared_at), Value(_EPOCH)),
+    ).exclude(
+        deleted_for=user_id
+    )
+
+
+def clear_history(room_id, user):
+    """Hide everything currently in the room for user ("clear chat")"""
+    ClearWatermark.objects.update_or_create(
+        user_id=user.id, chatroom_id=room_id,
+        defaults={"cleared_at": timezone.now()},
+    )
+    bump_visibility(room_id, [user.id])
+
+
+def encode_cursor(msg):
+    """Opaque keyset cursor for (created_at, id)"""
+    micros = (msg.created_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}_{msg.id}"
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; ValueError on anything malformed"""
+    micros, _, msg_id = cursor.partition("_")
+    created_at = _EPOCH + timedelta(microseconds=int(micros))
+    return created_at, int(msg_id)
+
+
+def message_page(room_id, user, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    One page of history older than the ``before`` cursor (newest page when
+    None), oldest first, plus the cursor of the next older page or None.
+    """
+    return _finish_page(list(_page_query(room_id, user, before, limit)), limit)
+
+
+async def amessage_page(room_id, user, before=None, limit=HISTORY_PAGE_SIZE):
+    """message_page for async views"""
+    return _finish_page([msg async for msg in _page_query(room_id, user, before, limit)], limit)
+
+
+def _page_query(room_id, user, before, limit):
+    qs = visible_messages(room_id, user)
+    if before:
+        created_at, msg_id = decode_cursor(before)
+        qs = qs.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=msg_id)
+        )
+    # One extra row tells whether an older page exists
+    return qs.order_by("-created_at", "-id")[:limit + 1]
+
+
+def _finish_page(page, limit):
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    next_cursor = encode_cursor(page[0]) if has_more else None
+    return page, next_cursor
+
+
+def serialize_message(msg):
+    """JSON shape of a message, same fields as the live chat frames"""
+    try:
+        info = msg.sender.userinfo
+    except ObjectDoesNotExist:
+        info = None
+
+    return {
+        "message_id": msg.id,
+        "sender": msg.sender.username,
+        "message": msg.content,
+        "avatar_url": avatar_url(info, BUBBLE_AVATAR_SIZE),
+        "attachments": [serialize_attachment(a) for a in msg.attachments.all()],
+        "created_at": msg.created_at.isoformat(),
+        "time": dateformat.format(localtime(msg.created_at), "h:i A"),
+    }
+
+
+# =========================
+# RECONNECT RESUME
+# =========================
+
+RESUME_MAX_MESSAGES = 200
+TOMBSTONE_TTL = timedelta(days=7)
+
+
+def record_tombstone(room_id, message_id):
+    """Log a deletion for resume_batch and forget ones older than TOMBSTONE_TTL"""
+    now = timezone.now()
+    MessageTombstone.objects.filter(
+        chatroom_id=room_id, deleted_at__lt=now - TOMBSTONE_TTL
+    ).delete()
+    MessageTombstone.objects.create(chatroom_id=room_id, message_id=message_id)
+
+
+def remove_message(msg):
+    """Delete a message for everyone: inbox rows, history, resume log, search index"""
+    msg_id, room_id = msg.id, msg.chatroom_id
+    with transaction.atomic():
+        inbox_message_deleted(msg)  # before delete() clears msg.id
+        msg.delete()
+        record_tombstone(room_id, msg_id)
+        unindex_messages([msg_id])
+        bump_room_versions([room_id])
+
+
+def resume_batch(room_id, user, since_message_id):
+    """
+    What a reconnecting client missed after since_message_id: new visible
+    messages (oldest first) and ids deleted meanwhile. ``truncated`` means
+    more than RESUME_MAX_MESSAGES arrived and the client should reload.
+    """
+    anchor = Message.objects.filter(
+        chatroom_id=room_id, id=since_message_id
+    ).values("created_at").first()
+
+    qs = visible_messages(room_id, user)
+    tombstones = MessageTombstone.objects.filter(chatroom_id=room_id)
+    if anchor is not None:
+        created_at = anchor["created_at"]
+        qs = qs.filter(
+            Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=since_message_id)
+        )
+        # Anything deleted after the client's newest message was written may be on its screen
+        tombstones = tombstones.filter(deleted_at__gte=created_at)
+    else:
+        # The anchor itself was deleted; ids grow with time, so fall back to them
+        qs = qs.filter(id__gt=since_message_id)
+
+    page = list(qs.order_by("created_at", "id")[:RESUME_MAX_MESSAGES + 1])
+    deleted = list(
+        tombstones.order_by("-deleted_at").values_list("message_id", flat=True)[:RESUME_MAX_MESSAGES]
+    )
+
+    return {
+        "messages": [serialize_message(msg) for msg in page[:RESUME_MAX_MESSAGES]],
+        "deleted": deleted,
+        "truncated": len(page) > RESUME_MAX_MESSAGES,
+    }
+
+
+# =========================
+# MESSAGE INGEST
+# =========================
+
+# Queries one message is allowed to cost: INSERT, hidden_for DELETE, inbox UPDATE
+# and the search index INSERT.
+# Room name, participants and avatar come from the consumer's room context;
+# last seen is written by the presence tracker in coalesced batches.
+INGEST_QUERY_BUDGET = 4
+# Linking attachments: their UPDATE and reading back what was linked
+ATTACHMENT_QUERY_BUDGET = 2
+
+
+# Longest message text accepted from a socket, in characters
+MAX_MESSAGE_LENGTH = 10000
+
+
+def clean_message_content(content, has_attachments=False):
+    """
+    The text to store for a message sent over a socket, or None if it can
+    never be stored: not a string, empty without attachments, longer than
+    MAX_MESSAGE_LENGTH or holding NUL characters (PostgreSQL text refuses them).
+    """
+    if content is None and has_attachments:
+        return ""
+    if not isinstance(content, str) or len(content) > MAX_MESSAGE_LENGTH or "\x00" in content:
+        return None
+    if not content and not has_attachments:
+        return None
+    return content
+
+
+class EmptyMessage(ValueError):
+    """No text, and none of the attachment ids was one of the sender's uploads in the room"""
+
+
+def ingest_message(room_id, user, content, participant_ids, attachment_ids=()):
+    """
+    Store one chat message and everything that goes with it in a single
+    transaction. Returns None if the room is gone, otherwise a dict the
+    consumer can broadcast straight away. attachment_ids are the sender's
+    finished uploads (chatix.attachments) to send along. content must
+    have passed clean_message_content; EmptyMessage (nothing stored) when
+    it is empty and no attachment could be linked.
+    """
+    if clean_message_content(content, bool(attachment_ids)) is None:
+        raise ValueError("Message content cannot be stored")
+    if not settings.DEBUG:
+        return _ingest_message(room_id, user, content, participant_ids, attachment_ids)
+
+    # This thread's connection only: other sockets ingest at the same time
+    with QueryCounter(all_threads=False) as counter:
+        result = _ingest_message(room_id, user, content, participant_ids, attachment_ids)
+
+    budget = INGEST_QUERY_BUDGET + (ATTACHMENT_QUERY_BUDGET if attachment_ids else 0)
+    if counter.total > budget:
+        logger.warning(
+            "ingest_message used %d queries (budget %d) for room %s",
+            counter.total, budget, room_id
+        )
+    return result
+
+
+def _ingest_message(room_id, user, content, participant_ids, attachment_ids=()):
+    attachments = []
+    try:
+        with transaction.atomic():
+            msg = Message.objects.create(
+                id=next_message_id(),
+                chatroom_id=room_id,
+                sender=user,
+                content=content
+            )
+            if attachment_ids:
+                attachments = link_attachments(msg, list(attachment_ids))
+                if not attachments and not content:
+                    raise EmptyMessage(f"No attachment of {attachment_ids} could be sent")
+            _after_messages_saved([(msg, participant_ids)])
+    except IntegrityError:
+        # Room deleted after the consumer loaded its context; anything else is a real error
+        if ChatRoom.objects.filter(id=room_id).exists():
+            raise
+        return None
+
+    return {
+        "message_id": msg.id,
+        "created_at": msg.created_at,
+        "attachments": attachments,
+    }
+
+
+def persist_messages(entries):
+    """
+    Write-behind flush: insert a batch of (Message, participant_ids) pairs
+    whose ids were allocated up front, then run the same side effects as
+    ingest_message once for the whole batch.
+    """
+    with transaction.atomic():
+        # No ignore_conflicts: a taken id must not silently drop a broadcast message
+        Message.objects.bulk_create([msg for msg, _ in entries])
+        _after_messages_saved(entries)
+
+
+# Rooms per unhide DELETE: SQLite refuses expression trees deeper than 1000
+UNHIDE_ROOMS_PER_QUERY = 100
+
+
+def _after_messages_saved(entries):
+    # 🔥 Unhide every touched room for its participants (sender included), one DELETE per 100 rooms
+    room_users = defaultdict(set)
+    for msg, participant_ids in entries:
+        room_users[msg.chatroom_id].update(participant_ids, (msg.sender_id,))
+    unhide_user_ids = set().union(*room_users.values())
+
+    rooms = list(room_users.items())
+    for start in range(0, len(rooms), UNHIDE_ROOMS_PER_QUERY):
+        unhide = Q()
+        for room_id, user_ids in rooms[start:start + UNHIDE_ROOMS_PER_QUERY]:
+            unhide |= Q(chatroom_id=room_id, user_id__in=user_ids)
+        ChatRoom.hidden_for.through.objects.filter(unhide).delete()
+
+    messages = [msg for msg, _ in entries]
+    _update_inbox(messages)
+    index_messages(messages)
+    bump_room_versions(msg.chatroom_id for msg in messages)
+    bump_inbox_versions(unhide_user_ids)
+
+
+# =========================
+# INBOX
+# =========================
+
+SNIPPET_LENGTH = 120
+
+
+def inbox_for(user, favorites=False):
+    """The user's chat list, newest activity first, in one indexed query"""
+    entries = InboxEntry.objects.filter(user=user, is_hidden=False)
+    if favorites:
+        entries = entries.filter(is_favorite=True)
+    return entries.select_related("peer__userinfo", "chatroom").order_by("-last_activity_at")
+
+
+def sync_inbox_entries(room_id):
+    """Give every participant of a room an inbox row and keep peers right"""
+    room = ChatRoom.objects.filter(id=room_id).only("id", "created_at").first()
+    if room is None:
+        return
+
+    participant_ids = list(room.participants.values_list("id", flat=True))
+
+    existing = {entry.user_id: entry for entry in InboxEntry.objects.filter(chatroom_id=room_id)}
+    removed = [uid for uid in existing if uid not in participant_ids]
+    if removed:
+        InboxEntry.objects.filter(chatroom_id=room_id, user_id__in=removed).delete()
+        for uid in removed:
+            del existing[uid]
+    missing = [uid for uid in participant_ids if uid not in existing]
+
+    created = []
+    if missing:
+        last = Message.objects.filter(chatroom_id=room_id).order_by("-created_at", "-id").first()
+        hidden = set(room.hidden_for.values_list("id", flat=True))
+        favorite = set(room.favorited_by.values_list("id", flat=True))
+        fields = {"last_activity_at": room.created_at, **_last_message_fields(last)}
+        created = [
+            InboxEntry(
+                user_id=uid,
+                chatroom_id=room_id,
+                is_hidden=uid in hidden,
+                is_favorite=uid in favorite,
+                **fields
+            )
+            for uid in missing
+        ]
+
+    changed = []
+    for entry in [*existing.values(), *created]:
+        peer_id = _peer_for(entry.user_id, participant_ids)
+        if entry.peer_id != peer_id:
+            entry.peer_id = peer_id
+            changed.append(entry)
+
+    InboxEntry.objects.bulk_create(created, ignore_conflicts=True)
+    InboxEntry.objects.bulk_update([e for e in changed if e.pk], ["peer"])
+    bump_inbox_versions([*participant_ids, *removed])
+
+
+def mark_inbox_read(room_id, user_id, message_id=None):
+    """
+    Move the read cursor forward to message_id and recount what is left
+    unread after it, counting only what the user can still see (not
+    cleared, not deleted for them). Without a message id the room is
+    simply marked read.
+    """
+    entries = InboxEntry.objects.filter(chatroom_id=room_id, user_id=user_id)
+    if message_id is None:
+        if entries.filter(unread_count__gt=0).update(unread_count=0):
+            bump_inbox_versions([user_id])
+        return
+
+    unread_after = _visible_to(room_id, user_id).filter(
+        id__gt=message_id
+    ).exclude(
+        sender_id=user_id
+    ).order_by().values("chatroom_id").annotate(n=Count("id")).values("n")
+
+    moved = entries.filter(
+        Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id)
+    ).update(
+        last_read_message_id=message_id,
+        unread_count=Coalesce(Subquery(unread_after), 0),
+    )
+    if moved:
+        bump_inbox_versions([user_id])
+
+
+def toggle_favorite_flag(room, user):
+    """
+    Flip the room's favorite flag for user and return the new state. The
+    DELETE decides: a row removed means it was a favorite, otherwise it
+    is added. Two racing toggles therefore flip it twice, instead of
+    both acting on the same (possibly cached) answer.
+    """
+    through = ChatRoom.favorited_by.through
+    with transaction.atomic():
+        removed, _ = through.objects.filter(chatroom_id=room.id, user_id=user.id).delete()
+        if removed:
+            # What favorited_by.remove() announces: inbox flag and membership cache
+            m2m_changed.send(
+                sender=through, instance=room, action="post_remove", reverse=False,
+                model=User, pk_set={user.id}, using=through.objects.db,
+            )
+            return False
+        room.favorited_by.add(user)
+        return True
+
+
+# Message ids are BIGINT; anything outside never names a message
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+def is_room_message(room_id, message_id):
+    """Whether message_id is a message of the room (one primary key lookup)"""
+    if not 0 < message_id <= MAX_MESSAGE_ID:
+        return False
+    return Message.objects.filter(id=message_id, chatroom_id=room_id).exists()
+
+
+async def aread_cursor_of(room_id, user_id):
+    """Id of the last message user_id has read in the room, or None"""
+    return await InboxEntry.objects.filter(
+        chatroom_id=room_id, user_id=user_id
+    ).values_list("last_read_message_id", flat=True).afirst()
+
+
+def inbox_message_deleted(msg):
+    """Take a deleted message out of unread counts and last message snippets"""
+    # Only where it was counted: unread, and not cleared or deleted for the user,
+    # since clearing (mark_inbox_read) already left it out of the count
+    cleared = ClearWatermark.objects.filter(
+        user_id=OuterRef("user_id"), chatroom_id=msg.chatroom_id, cleared_at__gte=msg.created_at
+    )
+    InboxEntry.objects.filter(
+        Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=msg.id),
+        ~Exists(cleared),
+        chatroom_id=msg.chatroom_id,
+        unread_count__gt=0,
+    ).exclude(
+        user_id=msg.sender_id
+    ).exclude(
+        user_id__in=msg.deleted_for.values("id")
+    ).update(unread_count=F("unread_count") - 1)
+
+    shown = InboxEntry.objects.filter(chatroom_id=msg.chatroom_id, last_message_id=msg.id)
+    if shown.exists():
+        previous = Message.objects.filter(
+            chatroom_id=msg.chatroom_id
+        ).exclude(id=msg.id).order_by("-created_at", "-id").first()
+        fields = _last_message_fields(previous)
+        fields.pop("last_activity_at", None)  # the chat keeps its place in the list
+        shown.update(**fields)
+
+    bump_inbox_versions(
+        InboxEntry.objects.filter(chatroom_id=msg.chatroom_id).values_list("user_id", flat=True)
+    )
+
+
+def _update_inbox(messages):
+    # One UPDATE per room: newest message, unread += messages from others, unhide
+    by_room = defaultdict(list)
+    for msg in messages:
+        by_room[msg.chatroom_id].append(msg)
+
+    for room_id, room_messages in by_room.items():
+        last = max(room_messages, key=lambda m: (m.created_at, m.id))
+        total = len(room_messages)
+        sent = Counter(m.sender_id for m in room_messages)
+        unread = Case(
+            *[When(user_id=uid, then=Value(total - count)) for uid, count in sent.items()],
+            default=Value(total),
+            output_field=IntegerField(),
+        )
+        InboxEntry.objects.filter(chatroom_id=room_id).update(
+            unread_count=F("unread_count") + unread,
+            is_hidden=False,
+            **_last_message_fields(last)
+        )
+
+
+def _last_message_fields(msg):
+    if msg is None:
+        return {"last_message_id": None, "last_sender_id": None, "snippet": ""}
+    return {
+        "last_message_id": msg.id,
+        "last_sender_id": msg.sender_id,
+        # Only attachments have no text
+        "snippet": msg.content[:SNIPPET_LENGTH] or ATTACHMENT_SNIPPET,
+        "last_activity_at": msg.created_at,
+    }
+
+
+def _peer_for(user_id, participant_ids):
+    others = [pid for pid in participant_ids if pid != user_id]
+    if not others:
+        return user_id  # chat with yourself
+    if len(others) == 1:
+        return others[0]
+    return None
+
+
+def _avatar_url_for(user_id):
+    info = UserInfo.objects.filter(user_id=user_id).only("id", "image", "thumbnails").first()
+    return avatar_url(info, BUBBLE_AVATAR_SIZE)
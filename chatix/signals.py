@@ -0,0 +1,142 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .membership import FAVORITE, MEMBER, invalidate_membership
+from .models import ChatRoom, Message, UserInfo
+
+
+@receiver(pre_delete, sender=ChatRoom)
+def room_deleting(sender, instance, **kwargs):
+    # The inbox rows go with the room, so collect whose chat list changes first
+    from .versions import bump_inbox_versions
+
+    bump_inbox_versions(instance.inbox_entries.values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=ChatRoom)
+def room_deleted(sender, instance, **kwargs):
+    """Close every open socket of a room that no longer exists"""
+    from .search import unindex_room
+
+    unindex_room(instance.id)
+    invalidate_membership(MEMBER, room_ids=[instance.id])
+    invalidate_membership(FAVORITE, room_ids=[instance.id])
+
+    channel_layer = get_channel_layer()
+    async_to_sync(channel_layer.group_send)(
+        f"chat_{instance.id}",
+        {"type": "room_deleted"}
+    )
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep inbox rows in step with who is in a room (views and admin alike)"""
+    from .services import sync_inbox_entries
+
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    _invalidate(MEMBER, instance, reverse, pk_set)
+
+    if not reverse:
+        sync_inbox_entries(instance.id)
+    elif action == "post_clear":
+        instance.inbox.all().delete()
+    else:
+        for room_id in pk_set:
+            sync_inbox_entries(room_id)
+
+
+def _mirror_flag(flag, instance, action, reverse, pk_set):
+    from .models import InboxEntry
+    from .versions import bump_inbox_versions
+
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    value = action == "post_add"
+    if action == "post_clear":
+        entries = InboxEntry.objects.filter(**{"user" if reverse else "chatroom": instance})
+    elif reverse:
+        entries = InboxEntry.objects.filter(user=instance, chatroom_id__in=pk_set)
+    else:
+        entries = InboxEntry.objects.filter(chatroom=instance, user_id__in=pk_set)
+    entries.update(**{flag: value})
+
+    if reverse:
+        bump_inbox_versions([instance.id])
+    elif action == "post_clear":
+        bump_inbox_versions(entries.values_list("user_id", flat=True))
+    else:
+        bump_inbox_versions(pk_set)
+
+
+@receiver(m2m_changed, sender=ChatRoom.hidden_for.through)
+def hidden_for_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _mirror_flag("is_hidden", instance, action, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=ChatRoom.favorited_by.through)
+def favorited_by_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    _mirror_flag("is_favorite", instance, action, reverse, pk_set)
+    if action in ("post_add", "post_remove", "post_clear"):
+        _invalidate(FAVORITE, instance, reverse, pk_set)
+
+
+def _invalidate(kind, instance, reverse, pk_set):
+    # pk_set is None on clear: everything of the instance goes
+    if reverse:
+        invalidate_membership(kind, room_ids=pk_set, user_ids=[instance.id])
+    else:
+        invalidate_membership(kind, room_ids=[instance.id], user_ids=pk_set)
+
+
+@receiver(m2m_changed, sender=Message.deleted_for.through)
+def deleted_for_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """"Delete for me" changes what one user sees of a room's history"""
+    from .versions import bump_room_versions, bump_visibility
+
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    if not reverse:
+        if action == "post_clear":
+            bump_room_versions([instance.chatroom_id])
+        else:
+            bump_visibility(instance.chatroom_id, pk_set)
+        return
+
+    if action == "post_clear":
+        room_ids = instance.chatrooms.values_list("id", flat=True)
+    else:
+        room_ids = Message.objects.filter(id__in=pk_set).values_list("chatroom_id", flat=True)
+    for room_id in set(room_ids):
+        bump_visibility(room_id, [instance.id])
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, update_fields=None, **kwargs):
+    """A renamed user must be found under the new name (settings, admin)"""
+    from .directory import invalidate_user_directory
+
+    # Logins save last_login only, and a new user has no UserInfo yet
+    if created or (update_fields is not None and "username" not in update_fields):
+        return
+
+    renamed = UserInfo.objects.filter(user=instance).exclude(
+        username_key=instance.username.lower()
+    ).update(username_key=instance.username.lower())
+    if renamed:
+        invalidate_user_directory()
+
+
+@receiver(post_save, sender=UserInfo)
+def user_info_saved(sender, instance, **kwargs):
+    # register / settings_view: drop cached autocomplete answers
+    from .directory import invalidate_user_directory
+
+    invalidate_user_directory()
@@ -0,0 +1,50 @@
+"""
+Content-addressed media storage.
+
+Every uploaded file is saved as <name>.<first 12 hex of its sha256><ext>,
+e.g. profile_images/me.3f2a9c1b4d7e.jpg. A name therefore never points at
+different bytes, so chatix.media can serve it with a strong ETag and an
+"immutable" far-future Cache-Control, and uploading the same bytes twice
+stores them once.
+"""
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+
+HASH_LENGTH = 12
+
+_HASHED_NAME_RE = re.compile(rf"\.([0-9a-f]{{{HASH_LENGTH}}})\.[^./]+$")
+
+
+def content_hash(name):
+    """The hash part of a name saved by HashedMediaStorage, or None"""
+    match = _HASHED_NAME_RE.search(name)
+    return match.group(1) if match else None
+
+
+class HashedMediaStorage(FileSystemStorage):
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+
+        root, ext = os.path.splitext(name)
+        suffix = f".{digest.hexdigest()[:HASH_LENGTH]}{ext}"
+        if max_length is not None:
+            root = root[:max_length - len(suffix)]
+        hashed = f"{root}{suffix}"
+
+        # Same bytes already stored under this name
+        if self.exists(hashed):
+            return hashed
+        return super().save(hashed, content, max_length)
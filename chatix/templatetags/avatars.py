@@ -0,0 +1,13 @@
+from django import template
+
+from chatix.avatars import avatar_url
+
+register = template.Library()
+
+
+@register.filter
+def avatar(info, size):
+    """{{ user.userinfo|avatar:96 }}: the thumbnail for a box of that many px"""
+    if not getattr(info, "image", None):
+        return ""
+    return avatar_url(info, int(size)) or ""
@@ -1,3 +1,1733 @@
-from django.test import TestCase
+"""
+chatix tests.
 
-# Create your tests here.
+ViewBudgetTests holds the HTTP views to query budgets. Every view runs
+against a seeded account sized like a busy one: a few hundred rooms, a long
+history in the room it opens, hundreds of messages deleted for the viewer
+and messages deleted for dozens of others. Each view declares how many
+queries it may use. Query counts must not grow with the data, so going over
+a budget usually means a new N+1. Caches are cleared before every request,
+so budgets hold for a cold render.
+
+Wall-clock time depends on the machine, so it is only checked against a
+baseline recorded on the same machine. CHATIX_VIEW_BENCH_OUTPUT=<file>
+writes queries and milliseconds per view as JSON. Passing such a file back
+as CHATIX_VIEW_BENCH_BASELINE=<file> fails every view whose median time is
+more than CHATIX_VIEW_BENCH_THRESHOLD percent (default 25), and at least
+a few milliseconds, above it.
+
+The other test cases cover the machinery behind the sockets: write-behind,
+the channel broker, read cursors, resume, uploads and thumbnails.
+"""
+import asyncio
+import hashlib
+import importlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.exceptions import ChannelFull
+from channels.testing import WebsocketCommunicator
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from DjangoChat.settings import db_pool_options, sqlite_tuned_options
+
+from . import attachments
+from .attachments import attachment_root, blob_name, part_path, purge_stale_attachments
+from .avatars import AVATAR_SIZES, avatar_url, generate_thumbnails
+from . import db
+from .coalesce import CoalescingWriter
+from .db import QueryCounter
+from .fragments import ahistory_key
+from .directory import autocomplete_users, find_users, invalidate_user_directory, prefix_cache
+from .layers.broker import BrokerChannelLayer, ChannelBroker
+from .layers.memory import FastInMemoryChannelLayer
+from .membership import ais_favorite, ais_member, membership_cache
+from .models import Attachment, Blob, ChatRoom, ClearWatermark, InboxEntry, Message, Upload, UserInfo
+from .presence import aonline_user_ids, apresence_connect, apresence_disconnect, presence
+from .receipts import _write_read_cursors, read_cursors
+from .search import search_messages
+from .services import (
+    MAX_MESSAGE_LENGTH, SNIPPET_LENGTH, clear_history, ingest_message, mark_inbox_read, persist_messages,
+    publish_room_changed, remove_message, resume_batch, sync_inbox_entries, visible_messages,
+)
+from .versions import VERSION_CACHE
+from . import writebehind
+from .writebehind import MessageWriteBehind, next_message_id
+from .writelane import database_write_to_async, run_write
+
+ROOMS = 200
+FAVORITE_ROOMS = 30
+HIDDEN_ROOMS = 20
+HISTORY_LENGTH = 1000
+DELETED_FOR_VIEWER = 400
+CROWD = 40  # users each of the "deleted for many" messages is deleted for
+DELETED_FOR_CROWD = 50
+
+RUNS = 3
+# Percent a view's median time may exceed its baseline, and a floor in
+# milliseconds so views that take a few milliseconds do not fail on noise
+DEFAULT_TIME_THRESHOLD = 25
+TIME_SLACK_MS = 5
+
+# View -> queries for one cold request on the seeded data.
+# Session and user lookups are in every count.
+BUDGETS = {
+    "index": 4,  # inbox page, profile
+    "favorites": 4,
+    "chatroom": 10,  # access, room, peers, one page of history, read cursor
+    "search": 6,  # profile, directory, message index, results + attachments
+    "add_user_to_chatroom": 6,  # pair-key lookup, redirect
+    "add_user_to_chatroom_new": 16,  # room, participants, inbox rows
+    "delete_chatroom": 10,  # hide, inbox, clear watermark
+}
+
+
+def clear_caches():
+    caches[VERSION_CACHE].clear()
+    membership_cache.clear()
+    invalidate_user_directory()
+
+
+def make_user(username):
+    """A user with the profile the pages render"""
+    user = User.objects.create(username=username)
+    UserInfo.objects.create(
+        user=user,
+        name=username.title(),
+        email=f"{username}@example.com",
+        phone=str(1000000000 + user.id),
+    )
+    return user
+
+
+def socket(user, path):
+    """A WebsocketCommunicator on the real ASGI app, logged in as user"""
+    from DjangoChat.asgi import application
+
+    client = Client()
+    client.force_login(user)
+    return WebsocketCommunicator(application, path, headers=[
+        (b"cookie", f"sessionid={client.cookies['sessionid'].value}".encode()),
+        (b"origin", b"http://localhost"),
+        (b"host", b"localhost"),
+    ])
+
+
+def flush_writers():
+    """
+    Write what the sockets left in the coalescing writers now: their
+    exit-time flush would run after the test database is gone, against
+    the real one.
+    """
+    read_cursors.flush()
+    presence.last_seen.flush()
+
+
+async def receive_frame(communicator, frame_type):
+    """The next frame of frame_type, skipping others (presence...)"""
+    while True:
+        data = json.loads(await communicator.receive_from(timeout=5))
+        if data.get("type") == frame_type:
+            return data
+
+
+class ViewBudgetTests(TransactionTestCase):
+    """
+    A TransactionTestCase: the async views read through the chatix
+    executor threads, which would not see a TestCase's open transaction.
+    """
+
+    measured = {}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        baseline = os.environ.get("CHATIX_VIEW_BENCH_BASELINE")
+        cls.baseline = {}
+        if baseline:
+            with open(baseline) as f:
+                cls.baseline = json.load(f)
+        cls.time_threshold = float(os.environ.get("CHATIX_VIEW_BENCH_THRESHOLD", DEFAULT_TIME_THRESHOLD))
+
+    @classmethod
+    def tearDownClass(cls):
+        output = os.environ.get("CHATIX_VIEW_BENCH_OUTPUT")
+        if output:
+            with open(output, "w") as f:
+                json.dump(cls.measured, f, indent=2)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.viewer = make_user("viewer")
+        peers = [make_user(f"peer{i:03d}") for i in range(ROOMS)]
+        crowd = [make_user(f"crowd{i:02d}") for i in range(CROWD)]
+
+        self.rooms = []
+        for peer in peers:
+            room = ChatRoom.objects.create(
+                name=f"viewer & {peer.username}",
+                pair_key=ChatRoom.direct_pair_key(self.viewer.id, peer.id),
+            )
+            ChatRoom.participants.through.objects.bulk_create([
+                ChatRoom.participants.through(chatroom_id=room.id, user_id=uid)
+                for uid in (self.viewer.id, peer.id)
+            ])
+            sync_inbox_entries(room.id)
+            self.rooms.append((room, peer))
+        self.big_room, self.big_peer = self.rooms[0]
+
+        # A few messages everywhere, a long history in the first room
+        entries = []
+        next_id = 1
+        for room, peer in self.rooms:
+            count = HISTORY_LENGTH if room is self.big_room else 3
+            for i in range(count):
+                sender = self.viewer if i % 2 else peer
+                entries.append((
+                    Message(id=next_id, chatroom_id=room.id, sender_id=sender.id, content=f"hello {peer.username} number {i}"),
+                    [self.viewer.id, peer.id],
+                ))
+                next_id += 1
+        persist_messages(entries)
+
+        history = [msg.id for msg, _ in entries if msg.chatroom_id == self.big_room.id]
+        deleted_for = Message.deleted_for.through
+        deleted_for.objects.bulk_create(
+            [deleted_for(message_id=mid, user_id=self.viewer.id) for mid in history[:DELETED_FOR_VIEWER]]
+            + [
+                deleted_for(message_id=mid, user_id=user.id)
+                for mid in history[-DELETED_FOR_CROWD:] for user in crowd
+            ]
+        )
+
+        favorite_ids = [room.id for room, _ in self.rooms[:FAVORITE_ROOMS]]
+        hidden_ids = [room.id for room, _ in self.rooms[-HIDDEN_ROOMS:]]
+        ChatRoom.favorited_by.through.objects.bulk_create([
+            ChatRoom.favorited_by.through(chatroom_id=rid, user_id=self.viewer.id) for rid in favorite_ids
+        ])
+        ChatRoom.hidden_for.through.objects.bulk_create([
+            ChatRoom.hidden_for.through(chatroom_id=rid, user_id=self.viewer.id) for rid in hidden_ids
+        ])
+        InboxEntry.objects.filter(user=self.viewer, chatroom_id__in=favorite_ids).update(is_favorite=True)
+        InboxEntry.objects.filter(user=self.viewer, chatroom_id__in=hidden_ids).update(is_hidden=True)
+
+        self.client = Client()
+        self.client.force_login(self.viewer)
+
+    def measure(self, name, request, expected_status=200):
+        """
+        Run request() cold RUNS times after a warm-up and hold it to
+        BUDGETS[name], and to its baseline time when one was given.
+        """
+        max_queries = BUDGETS[name]
+
+        request()  # templates, URL resolvers, connections
+        queries, timings = [], []
+        for _ in range(RUNS):
+            clear_caches()
+            started = time.perf_counter()
+            with QueryCounter() as counter:
+                response = request()
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(counter.total)
+            self.assertEqual(response.status_code, expected_status, f"{name} answered {response.status_code}")
+
+        used, elapsed = max(queries), statistics.median(timings)
+        self.measured[name] = {"queries": used, "budget": max_queries, "ms": round(elapsed, 1)}
+        self.assertLessEqual(used, max_queries, f"{name} ran {used} queries, its budget is {max_queries}")
+
+        if name in self.baseline:
+            baseline_ms = self.baseline[name]["ms"]
+            limit = max(baseline_ms * (1 + self.time_threshold / 100), baseline_ms + TIME_SLACK_MS)
+            self.assertLessEqual(
+                elapsed, limit,
+                f"{name} took {elapsed:.1f}ms, its baseline is {baseline_ms}ms (limit {limit:.1f}ms)"
+            )
+        return response
+
+    # ---------- DASHBOARD ----------
+
+    def test_index(self):
+        response = self.measure("index", lambda: self.client.get(reverse("index")))
+        self.assertEqual(len(response.context["entries"]), ROOMS - HIDDEN_ROOMS)
+
+    def test_favorites(self):
+        response = self.measure("favorites", lambda: self.client.get(reverse("favorites")))
+        self.assertEqual(len(response.context["entries"]), FAVORITE_ROOMS)
+
+    # ---------- CHAT ROOM ----------
+
+    def test_chatroom(self):
+        response = self.measure("chatroom", lambda: self.client.get(reverse("chatroom", args=[self.big_room.id])))
+        self.assertContains(response, f"number {HISTORY_LENGTH - 1}")
+        self.assertNotContains(response, f"number {DELETED_FOR_VIEWER - 1}<")
+
+    # ---------- SEARCH ----------
+
+    def test_search(self):
+        response = self.measure("search", lambda: self.client.get(reverse("search"), {"q": "peer0"}))
+        self.assertTrue(response.context["users"])
+        self.assertTrue(response.context["message_results"])
+
+    # ---------- CREATE / OPEN CHAT ----------
+
+    def test_add_user_to_chatroom(self):
+        # The chat exists already: one lookup on its pair key
+        self.measure(
+            "add_user_to_chatroom",
+            lambda: self.client.get(reverse("add_user_to_chatroom", args=[self.big_peer.id])),
+            expected_status=302,
+        )
+
+    def test_add_user_to_chatroom_new(self):
+        strangers = iter([make_user(f"stranger{i}") for i in range(RUNS + 1)])
+        self.measure(
+            "add_user_to_chatroom_new",
+            lambda: self.client.get(reverse("add_user_to_chatroom", args=[next(strangers).id])),
+            expected_status=302,
+        )
+
+    # ---------- DELETE CHAT ----------
+
+    def test_delete_chatroom(self):
+        visible = iter([room for room, _ in self.rooms[FAVORITE_ROOMS:-HIDDEN_ROOMS]])
+        self.measure(
+            "delete_chatroom",
+            lambda: self.client.post(reverse("delete_chatroom", args=[next(visible).id])),
+        )
+
+
+# =========================
+# CONDITIONAL GET
+# =========================
+
+class ConditionalGetTests(TransactionTestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.user = make_user("viewer")
+
+    def test_revalidates_within_a_session(self):
+        self.client.force_login(self.user)
+        # force_login sets no csrf cookie; the first page hands one out
+        self.client.get(reverse("index"))
+        first = self.client.get(reverse("index"))
+        self.assertEqual(first.status_code, 200)
+        self.assertIn("private", first["Cache-Control"])
+        self.assertIn("no-cache", first["Cache-Control"])
+
+        second = self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(second["ETag"], first["ETag"])
+
+    def test_logging_in_again_changes_the_etag(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse("index"))
+        first = self.client.get(reverse("index"))
+
+        # New session and csrf secret: the old page's forms would be rejected
+        self.client.logout()
+        self.client.force_login(self.user)
+        second = self.client.get(reverse("index"), HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(second.status_code, 200)
+        self.assertNotEqual(second["ETag"], first["ETag"])
+
+
+# =========================
+# HISTORY FRAGMENTS
+# =========================
+
+class HistoryFragmentTests(TransactionTestCase):
+    """Committing: versions are bumped on commit"""
+
+    def setUp(self):
+        clear_caches()
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.first_id = self.send(self.bob, "hello there")
+        self.client.force_login(self.alice)
+
+    def send(self, user, content):
+        return ingest_message(self.room.id, user, content, [self.alice.id, self.bob.id])["message_id"]
+
+    def page(self):
+        response = self.client.get(reverse("chatroom", args=[self.room.id]))
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def cached_html(self):
+        key = async_to_sync(ahistory_key)(self.room.id, self.alice.id)
+        fragment = caches[VERSION_CACHE].get(key)
+        return fragment and fragment["html"]
+
+    def test_second_render_is_served_from_cache(self):
+        self.assertIn("hello there", self.page())
+        self.assertIn("hello there", self.cached_html())
+
+        # Bypasses every version bump, so only a cached render still shows the old text
+        Message.objects.filter(id=self.first_id).update(content="edited underneath")
+        self.assertIn("hello there", self.page())
+        self.assertNotIn("edited underneath", self.page())
+
+    def test_new_message_invalidates(self):
+        self.page()
+        Message.objects.filter(id=self.first_id).update(content="edited underneath")
+
+        self.send(self.bob, "second message")
+        html = self.page()
+        self.assertIn("second message", html)
+        self.assertIn("edited underneath", html)
+
+    def test_membership_change_invalidates(self):
+        self.page()
+        self.room.participants.remove(self.alice)
+        response = self.client.get(reverse("chatroom", args=[self.room.id]))
+        self.assertRedirects(response, reverse("index"), fetch_redirect_response=False)
+
+        self.room.participants.add(self.alice)
+        self.assertIn("hello there", self.page())
+
+    def test_rename_invalidates(self):
+        self.page()
+        old_html = self.cached_html()
+        self.assertIn("bob", old_html)
+
+        bob = Client()
+        bob.force_login(self.bob)
+        bob.post(reverse("settings"), {
+            "username": "robert", "name": "Robert", "email": "robert@example.com", "phone": "1234567890",
+        })
+
+        self.assertIsNone(self.cached_html())
+        self.page()
+        self.assertIn("robert", self.cached_html())
+        self.assertNotIn("bob", self.cached_html())
+
+
+# =========================
+# MESSAGE INGEST
+# =========================
+
+@override_settings(DEBUG=True)  # ingest_message counts its queries in DEBUG only
+class IngestQueryTests(TransactionTestCase):
+    """Committing: the ingests run on threads of their own"""
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.id, self.bob.id]
+        sync_inbox_entries(self.room.id)
+
+    def tearDown(self):
+        flush_writers()
+
+    def on_fresh_connection(self, fn):
+        def run():
+            try:
+                return fn()
+            finally:
+                connection.close()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(run).result()
+
+    def test_ingest_leaves_the_execute_wrappers_alone(self):
+        def ingest():
+            for n in range(3):
+                ingest_message(self.room.id, self.alice, f"message {n}", self.participant_ids)
+            return list(connection.execute_wrappers)
+
+        self.assertEqual(self.on_fresh_connection(ingest), [db._count_queries])
+
+    def test_load_test_reports_the_queries_of_an_ingest(self):
+        def ingest():
+            with QueryCounter() as counter:
+                ingest_message(self.room.id, self.alice, "counted", self.participant_ids)
+            return counter.total
+
+        direct = self.on_fresh_connection(ingest)
+        # One sender: the in-memory test database locks out concurrent writers
+        with tempfile.NamedTemporaryFile(suffix=".json") as output:
+            call_command(
+                "bench_websockets", rooms=1, users_per_room=1, messages=3, rate=0,
+                no_dashboards=True, output=output.name, stdout=io.StringIO(),
+            )
+            results = json.load(output)["results"]
+
+        self.assertEqual(results["deliveries"], results["expected_deliveries"])
+        self.assertEqual(results["queries_per_message"], direct)
+
+
+# =========================
+# WRITE-BEHIND
+# =========================
+
+class WriteBehindTests(TransactionTestCase):
+    """Committing: SQLite only checks the room foreign key at COMMIT"""
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.id, self.bob.id]
+
+    def submit(self, queue, content, room=None):
+        async def run():
+            return queue.submit((room or self.room).id, self.alice, content, self.participant_ids)
+        return async_to_sync(run)()["message_id"]
+
+    def test_ingest_and_write_behind_share_one_id_source(self):
+        queue = MessageWriteBehind()
+        queued = self.submit(queue, "written behind")
+        stored = ingest_message(self.room.id, self.alice, "with attachments", self.participant_ids)
+        queue.flush()
+
+        self.assertGreater(stored["message_id"], queued)
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("content", flat=True)),
+            ["written behind", "with attachments"],
+        )
+
+    def test_retried_batch_is_not_stored_twice(self):
+        queue = MessageWriteBehind()
+        self.submit(queue, "once")
+        batch = list(queue._pending)
+        queue.flush()
+
+        queue._pending.extend(batch)  # as if the first flush raised after committing
+        with self.assertNoLogs(writebehind.logger, "ERROR"):
+            queue.flush()
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_taken_id_is_logged_and_the_rest_of_the_batch_kept(self):
+        queue = MessageWriteBehind()
+        taken = self.submit(queue, "mine")
+        self.submit(queue, "also mine")
+        Message.objects.create(id=taken, chatroom=self.room, sender=self.bob, content="someone else's")
+
+        with self.assertLogs(writebehind.logger, "ERROR") as logs:
+            queue.flush()
+        self.assertIn(str(taken), logs.output[0])
+        self.assertEqual(
+            sorted(Message.objects.values_list("content", flat=True)),
+            ["also mine", "someone else's"],
+        )
+
+    def test_deleted_room_is_dropped_from_the_batch(self):
+        queue = MessageWriteBehind()
+        gone = ChatRoom.objects.create(name="gone")
+        self.submit(queue, "kept")
+        self.submit(queue, "lost", room=gone)
+        gone.delete()
+
+        queue.flush()
+        self.assertEqual(list(Message.objects.values_list("content", flat=True)), ["kept"])
+        self.assertEqual(len(queue), 0)
+
+    def test_content_that_cannot_be_stored_is_refused(self):
+        queue = MessageWriteBehind()
+        for content in (None, "", 42):
+            with self.assertRaises(ValueError):
+                self.submit(queue, content)
+        self.assertEqual(len(queue), 0)
+
+    def test_row_the_database_refuses_is_dropped_and_the_rest_stored(self):
+        queue = MessageWriteBehind()
+        self.submit(queue, "before")
+        # Queued behind submit()'s back, as an older worker would have
+        bad = Message(id=next_message_id(), chatroom_id=self.room.id, sender=self.alice, content=None)
+        queue._pending.append((bad, self.participant_ids))
+        self.submit(queue, "after")
+
+        with self.assertLogs(writebehind.logger, "ERROR") as logs:
+            queue.flush()
+        self.assertIn(str(bad.id), logs.output[0])
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("content", flat=True)),
+            ["before", "after"],
+        )
+        self.assertEqual(len(queue), 0)
+
+    def test_processes_on_one_host_claim_different_worker_ids(self):
+        with tempfile.TemporaryDirectory() as lock_dir, override_settings(CHATIX_WORKER_LOCK_DIR=lock_dir):
+            held = len(writebehind._worker_lock_files)
+            try:
+                # Each claim opens its own lock file handle, like another process would
+                first = writebehind._claim_worker_id()
+                second = writebehind._claim_worker_id()
+            finally:
+                for handle in writebehind._worker_lock_files[held:]:
+                    handle.close()
+                del writebehind._worker_lock_files[held:]
+        self.assertNotEqual(first, second)
+
+    def test_message_ids_grow(self):
+        ids = [next_message_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 2 ** 53)
+
+
+# =========================
+# WRITE LANE
+# =========================
+
+class WriteLaneTests(TransactionTestCase):
+    """Committing: lane writes happen on the writer thread's own connection"""
+
+    def setUp(self):
+        self.room = ChatRoom.objects.create(name="lane")
+        self.lock = threading.Lock()
+        self.running = 0
+        self.most_running = 0
+        self.threads = set()
+
+    def rename(self, i):
+        with self.lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            self.threads.add(threading.current_thread().name)
+        try:
+            time.sleep(0.01)  # long enough for callers to overlap if they could
+            ChatRoom.objects.filter(id=self.room.id).update(name=f"lane {i}")
+            return i
+        finally:
+            with self.lock:
+                self.running -= 1
+
+    @override_settings(CHATIX_SQLITE_WRITE_LANE=True)
+    def test_run_write_serializes_callers_on_the_lane(self):
+        with ThreadPoolExecutor(max_workers=4) as callers:
+            results = list(callers.map(lambda i: run_write(self.rename, i), range(8)))
+
+        self.assertEqual(results, list(range(8)))
+        self.assertEqual(self.most_running, 1)
+        self.assertTrue(all(name.startswith("chatix-writer") for name in self.threads), self.threads)
+        self.assertTrue(ChatRoom.objects.get(id=self.room.id).name.startswith("lane "))
+
+    @override_settings(CHATIX_SQLITE_WRITE_LANE=True)
+    def test_database_write_to_async_serializes_on_the_lane(self):
+        rename = database_write_to_async(self.rename)
+
+        async def run():
+            return await asyncio.gather(*(rename(i) for i in range(8)))
+
+        self.assertEqual(async_to_sync(run)(), list(range(8)))
+        self.assertEqual(self.most_running, 1)
+        self.assertTrue(all(name.startswith("chatix-writer") for name in self.threads), self.threads)
+
+    @override_settings(CHATIX_SQLITE_WRITE_LANE=True)
+    def test_write_from_the_lane_runs_inline(self):
+        # Submitting to the one writer thread from itself would deadlock
+        thread = run_write(lambda: run_write(lambda: threading.current_thread().name))
+        self.assertTrue(thread.startswith("chatix-writer"))
+
+    @override_settings(CHATIX_SQLITE_WRITE_LANE=False)
+    def test_lane_off_calls_straight_through(self):
+        self.assertEqual(run_write(self.rename, 1), 1)
+        self.assertEqual(self.threads, {threading.current_thread().name})
+
+        self.threads.clear()
+        self.assertEqual(async_to_sync(database_write_to_async(self.rename))(2), 2)
+        [thread] = self.threads
+        self.assertTrue(thread.startswith("chatix-db"), thread)
+        self.assertEqual(ChatRoom.objects.get(id=self.room.id).name, "lane 2")
+
+    def test_tuned_sqlite_connection(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite only")
+        with tempfile.TemporaryDirectory() as tmp:
+            tuned = type(connections["default"])({
+                **connection.settings_dict,
+                "NAME": os.path.join(tmp, "tuned.sqlite3"),
+                "OPTIONS": sqlite_tuned_options({"CHATIX_SQLITE_BUSY_TIMEOUT_MS": "1234"}),
+            }, alias="tuned")
+            try:
+                with tuned.cursor() as cursor:
+                    pragmas = {}
+                    for pragma in ("journal_mode", "synchronous", "busy_timeout", "temp_store"):
+                        cursor.execute(f"PRAGMA {pragma}")
+                        pragmas[pragma] = cursor.fetchone()[0]
+            finally:
+                tuned.close()
+
+        # synchronous NORMAL = 1, temp_store MEMORY = 2
+        self.assertEqual(pragmas, {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 1234, "temp_store": 2})
+        self.assertEqual(tuned.transaction_mode, "IMMEDIATE")
+
+
+# =========================
+# DATABASE EXECUTOR
+# =========================
+
+class DatabaseExecutorTests(TestCase):
+
+    def test_pool_is_sized_from_the_executor(self):
+        pool = db_pool_options(8, 4, environ={})
+        self.assertEqual((pool["min_size"], pool["max_size"]), (2, 12))
+
+        pool = db_pool_options(16, 2, environ={"CHATIX_DB_POOL_MIN_SIZE": "4", "CHATIX_DB_POOL_TIMEOUT": "3"})
+        self.assertEqual((pool["min_size"], pool["max_size"], pool["timeout"]), (4, 18, 3.0))
+
+        # psycopg_pool refuses max_size < min_size
+        pool = db_pool_options(1, 0, environ={"CHATIX_DB_POOL_MIN_SIZE": "4"})
+        self.assertEqual(pool["max_size"], 4)
+
+    @override_settings(CHATIX_DB_EXECUTOR_SIZE=2)
+    def test_async_calls_wait_for_an_executor_thread(self):
+        lock = threading.Lock()
+        running = most_running = 0
+        threads = set()
+
+        def work(i):
+            nonlocal running, most_running
+            with lock:
+                running += 1
+                most_running = max(most_running, running)
+                threads.add(threading.current_thread().name)
+            time.sleep(0.02)
+            with lock:
+                running -= 1
+            return i
+
+        async def run():
+            call = db.database_sync_to_async(work)
+            return await asyncio.gather(*(call(i) for i in range(6)))
+
+        # A fresh executor built from the overridden size
+        with patch.object(db, "_executor", None):
+            try:
+                self.assertEqual(async_to_sync(run)(), list(range(6)))
+            finally:
+                db.get_executor().shutdown()
+
+        self.assertEqual(most_running, 2)
+        self.assertEqual(len(threads), 2)
+        self.assertTrue(all(name.startswith("chatix-db") for name in threads), threads)
+
+    def test_pool_stats_endpoint(self):
+        staff = User.objects.create(username="ops", is_staff=True)
+        client = Client()
+        client.force_login(staff)
+
+        response = client.get(reverse("db_pool_stats"))
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual(payload["status"], "ok")
+        executor = payload["stats"]["executor"]
+        self.assertEqual(executor["max_workers"], db.get_executor()._max_workers)
+        self.assertGreaterEqual(executor["threads"], 0)
+        self.assertGreaterEqual(executor["queued"], 0)
+        if connection.vendor != "postgresql":
+            self.assertIsNone(payload["stats"]["pool"])
+
+    def test_pool_stats_endpoint_is_staff_only(self):
+        client = Client()
+        client.force_login(User.objects.create(username="alice"))
+        response = client.get(reverse("db_pool_stats"))
+        self.assertEqual(response.status_code, 403)
+
+
+# =========================
+# ROOM CONTEXT
+# =========================
+
+class RoomContextTests(TransactionTestCase):
+    """The consumer keeps its room context until the room group says otherwise"""
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        sync_inbox_entries(self.room.id)
+
+    def tearDown(self):
+        flush_writers()
+
+    def test_room_name_reloaded_only_on_invalidation(self):
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/")
+        bob = socket(self.bob, "/ws/notify/")
+
+        async def say(message):
+            await alice.send_to(text_data=json.dumps({"message": message}))
+            await receive_frame(alice, "chat")
+            return (await receive_frame(bob, "notification"))["room_name"]
+
+        async def run():
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+
+            # Renamed behind the consumer's back: the cached name stays
+            await ChatRoom.objects.filter(id=self.room.id).aupdate(name="renamed")
+            names = [await say("one")]
+
+            await sync_to_async(publish_room_changed)([self.room.id])
+            await asyncio.sleep(0.2)  # let the consumer handle the event first
+            names.append(await say("two"))
+
+            await alice.disconnect()
+            await bob.disconnect()
+            return names
+
+        self.assertEqual(async_to_sync(run)(), ["alice & bob", "renamed"])
+
+    def test_frame_without_text_keeps_the_socket_open(self):
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/")
+
+        async def run():
+            self.assertTrue((await alice.connect())[0])
+            for frame in (
+                {}, {"message": None}, {"message": "x" * (MAX_MESSAGE_LENGTH + 1)},
+                {"attachments": [10 ** 6]},  # nothing of ours to send
+            ):
+                await alice.send_to(text_data=json.dumps(frame))
+            await alice.send_to(text_data=json.dumps({"message": "still here"}))
+            chat = await receive_frame(alice, "chat")
+            await alice.disconnect()
+            return chat
+
+        self.assertEqual(async_to_sync(run)()["message"], "still here")
+        self.assertEqual(list(Message.objects.values_list("content", flat=True)), ["still here"])
+
+    def test_integrity_error_in_a_live_room_is_raised(self):
+        with patch("chatix.services.link_attachments", side_effect=IntegrityError("bad attachment")):
+            with self.assertRaises(IntegrityError):
+                ingest_message(self.room.id, self.alice, "hi", [self.alice.id, self.bob.id], [1])
+        self.assertIsNone(ingest_message(self.room.id + 1000, self.alice, "hi", [self.alice.id]))
+
+    def test_socket_closed_when_the_room_is_deleted(self):
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/")
+
+        async def run():
+            self.assertTrue((await alice.connect())[0])
+            await ChatRoom.objects.filter(id=self.room.id).adelete()
+            await receive_frame(alice, "room_deleted")
+            output = await alice.receive_output(timeout=5)
+            await alice.disconnect()
+            return output
+
+        self.assertEqual(async_to_sync(run)()["type"], "websocket.close")
+
+
+# =========================
+# MESSAGE HISTORY
+# =========================
+
+class HistoryPaginationTests(TransactionTestCase):
+    """Committing: the history view reads through executor threads"""
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        participant_ids = [self.alice.id, self.bob.id]
+
+        self.ids = [
+            ingest_message(self.room.id, self.bob, f"message {i}", participant_ids)["message_id"]
+            for i in range(9)
+        ]
+        # Most of the room shares one timestamp, so only the id breaks ties
+        same_time = timezone.now()
+        Message.objects.filter(id__in=self.ids[1:8]).update(created_at=same_time)
+        Message.objects.filter(id=self.ids[0]).update(created_at=same_time - timedelta(seconds=1))
+        Message.objects.filter(id=self.ids[8]).update(created_at=same_time + timedelta(seconds=1))
+
+        self.client.force_login(self.alice)
+
+    def tearDown(self):
+        flush_writers()
+
+    def test_older_pages_have_no_gaps_or_duplicates(self):
+        url = reverse("message_history", args=[self.room.id])
+        pages = []
+        params = {"limit": 2}
+        while True:
+            data = self.client.get(url, params).json()
+            pages.append([m["message_id"] for m in data["messages"]])
+            if not data["next_cursor"]:
+                break
+            params["before"] = data["next_cursor"]
+
+        self.assertEqual(pages[0], self.ids[-2:])
+        for page in pages:
+            self.assertEqual(page, sorted(page))  # oldest first within a page
+        self.assertEqual([mid for page in reversed(pages) for mid in page], self.ids)
+
+    def test_newer_messages_after_a_tied_cursor(self):
+        for seen in range(len(self.ids)):
+            batch = resume_batch(self.room.id, self.alice, self.ids[seen])
+            self.assertEqual([m["message_id"] for m in batch["messages"]], self.ids[seen + 1:])
+
+
+# =========================
+# RECONNECT RESUME
+# =========================
+
+class ResumeTests(TransactionTestCase):
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.id, self.bob.id]
+        sync_inbox_entries(self.room.id)
+
+        # Alice last saw `anchor`, which bob deleted while she was away
+        self.seen = self.send("seen")
+        self.anchor = self.send("anchor")
+        self.missed = self.send("missed")
+        self.hidden = self.send("deleted for alice")
+        self.last = self.send("last")
+        Message.objects.get(id=self.hidden).deleted_for.add(self.alice)
+        remove_message(Message.objects.get(id=self.anchor))
+
+    def tearDown(self):
+        flush_writers()
+
+    def send(self, content):
+        return ingest_message(self.room.id, self.bob, content, self.participant_ids)["message_id"]
+
+    def test_deleted_anchor_falls_back_to_ids(self):
+        batch = resume_batch(self.room.id, self.alice, self.anchor)
+        self.assertEqual([m["message_id"] for m in batch["messages"]], [self.missed, self.last])
+        self.assertEqual(batch["deleted"], [self.anchor])
+        self.assertFalse(batch["truncated"])
+
+    def test_resume_on_connect(self):
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/?since_message_id={self.anchor}")
+
+        async def run():
+            self.assertTrue((await alice.connect())[0])
+            frame = await receive_frame(alice, "resume")
+            await alice.disconnect()
+            return frame
+
+        frame = async_to_sync(run)()
+        self.assertEqual([m["message"] for m in frame["messages"]], ["missed", "last"])
+        self.assertEqual(frame["deleted"], [self.anchor])
+
+
+# =========================
+# INBOX
+# =========================
+
+class InboxTests(TestCase):
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.id, self.bob.id]
+
+    def send(self, sender, content):
+        return ingest_message(self.room.id, sender, content, self.participant_ids)["message_id"]
+
+    def entry(self, user):
+        return InboxEntry.objects.get(chatroom=self.room, user=user)
+
+    def test_insert_counts_for_the_others_only(self):
+        self.send(self.bob, "first")
+        last = self.send(self.bob, "x" * 500)
+
+        alice, bob = self.entry(self.alice), self.entry(self.bob)
+        self.assertEqual((alice.unread_count, bob.unread_count), (2, 0))
+        self.assertEqual((alice.last_message_id, alice.last_sender_id), (last, self.bob.id))
+        self.assertEqual(alice.snippet, "x" * SNIPPET_LENGTH)
+        self.assertEqual(bob.last_message_id, last)
+
+    def test_written_behind_batch_updates_once_per_room(self):
+        persist_messages([
+            (Message(id=next_message_id(), chatroom_id=self.room.id, sender=sender, content=content),
+             self.participant_ids)
+            for sender, content in ((self.bob, "one"), (self.alice, "two"), (self.bob, "three"))
+        ])
+        alice, bob = self.entry(self.alice), self.entry(self.bob)
+        self.assertEqual((alice.unread_count, bob.unread_count), (2, 1))
+        self.assertEqual((alice.snippet, bob.snippet), ("three", "three"))
+
+    def test_delete_takes_the_message_out(self):
+        self.send(self.bob, "kept")
+        removed = self.send(self.bob, "removed")
+        remove_message(Message.objects.get(id=removed))
+
+        alice = self.entry(self.alice)
+        self.assertEqual(alice.unread_count, 1)
+        self.assertEqual(alice.snippet, "kept")
+
+        remove_message(Message.objects.get(content="kept"))
+        alice = self.entry(self.alice)
+        self.assertEqual((alice.unread_count, alice.snippet, alice.last_message_id), (0, "", None))
+
+    def test_delete_skips_users_who_no_longer_counted_it(self):
+        carol = make_user("carol")
+        dave = make_user("dave")
+        self.room.participants.add(carol, dave)
+        self.participant_ids += [carol.id, dave.id]
+
+        removed = self.send(self.bob, "removed")
+        Message.objects.get(id=removed).deleted_for.add(carol)
+        clear_history(self.room.id, dave)
+        mark_inbox_read(self.room.id, dave.id)
+        self.send(self.bob, "later")
+        InboxEntry.objects.filter(user=carol).update(unread_count=1)  # "later" only
+
+        remove_message(Message.objects.get(id=removed))
+        counts = {user.username: self.entry(user).unread_count for user in (self.alice, carol, dave)}
+        self.assertEqual(counts, {"alice": 1, "carol": 1, "dave": 1})
+
+    def test_mark_read_recounts_what_is_left(self):
+        ids = [self.send(self.bob, f"message {i}") for i in range(3)]
+
+        mark_inbox_read(self.room.id, self.alice.id, ids[0])
+        self.assertEqual(self.entry(self.alice).unread_count, 2)
+        mark_inbox_read(self.room.id, self.alice.id, ids[-1])
+        self.assertEqual(self.entry(self.alice).unread_count, 0)
+        self.assertEqual(self.entry(self.alice).last_read_message_id, ids[-1])
+
+        # Reading a message already behind the cursor changes nothing
+        self.send(self.bob, "new")
+        mark_inbox_read(self.room.id, self.alice.id, ids[0])
+        self.assertEqual(self.entry(self.alice).unread_count, 1)
+
+
+# =========================
+# READ CURSORS
+# =========================
+
+class ReadCursorTests(TransactionTestCase):
+    """Committing: the consumer reads through executor threads"""
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.participant_ids = [self.alice.id, self.bob.id]
+        sync_inbox_entries(self.room.id)
+
+    def tearDown(self):
+        flush_writers()
+
+    def send(self, sender, content="hi"):
+        return ingest_message(self.room.id, sender, content, self.participant_ids)["message_id"]
+
+    def entry(self, user):
+        return InboxEntry.objects.get(chatroom=self.room, user=user)
+
+    def test_bad_key_is_dropped_and_the_rest_of_the_batch_written(self):
+        message_id = self.send(self.bob)
+        writer = CoalescingWriter("test cursors", _write_read_cursors, 60, merge=max)
+        writer.put((self.room.id, self.alice.id), message_id)
+        writer.put((self.room.id, self.bob.id), 10 ** 20)
+
+        with self.assertLogs("chatix.receipts", "WARNING"):
+            writer.flush()
+        self.assertEqual(len(writer), 0)
+        self.assertEqual(self.entry(self.alice).last_read_message_id, message_id)
+        self.assertIsNone(self.entry(self.bob).last_read_message_id)
+
+    def test_read_frame_needs_a_message_of_the_room(self):
+        other_room = ChatRoom.objects.create(name="elsewhere")
+        other_room.participants.add(self.alice)
+        elsewhere = ingest_message(other_room.id, self.alice, "x", [self.alice.id])["message_id"]
+        message_id = self.send(self.bob)
+
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/")
+        bob = socket(self.bob, f"/ws/chat/{self.room.id}/")
+
+        async def run():
+            self.assertTrue((await alice.connect())[0])
+            self.assertTrue((await bob.connect())[0])
+            for bad in (10 ** 20, -1, elsewhere + 10 ** 6):
+                await alice.send_to(text_data=json.dumps({"type": "read", "message_id": bad}))
+            await alice.send_to(text_data=json.dumps({"type": "read", "message_id": message_id}))
+            receipt = await receive_frame(bob, "read")
+            await alice.disconnect()
+            await bob.disconnect()
+            return receipt
+
+        receipt = async_to_sync(run)()
+        self.assertEqual(receipt["message_id"], message_id)
+        self.assertEqual(read_cursors._pending, {(self.room.id, self.alice.id): message_id})
+
+    def test_unread_count_skips_cleared_and_deleted_messages(self):
+        first = self.send(self.bob, "before the clear")
+        self.send(self.bob, "also before the clear")
+        clear_history(self.room.id, self.alice)
+        self.send(self.bob, "after")
+        deleted = self.send(self.bob, "deleted for alice")
+        self.send(self.bob, "after too")
+        Message.objects.get(id=deleted).deleted_for.add(self.alice)
+
+        mark_inbox_read(self.room.id, self.alice.id, first)
+        self.assertEqual(self.entry(self.alice).unread_count, 2)
+
+
+# =========================
+# MESSAGE SEARCH
+# =========================
+
+class MessageSearchTests(TestCase):
+
+    def setUp(self):
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.carol = make_user("carol")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.elsewhere = ChatRoom.objects.create(name="bob & carol")
+        self.elsewhere.participants.add(self.bob, self.carol)
+
+    def send(self, room, sender, content):
+        participant_ids = list(room.participants.values_list("id", flat=True))
+        return ingest_message(room.id, sender, content, participant_ids)["message_id"]
+
+    def found(self, user, query):
+        return [msg.id for msg in search_messages(user, query)[0]]
+
+    def test_only_rooms_the_user_is_in(self):
+        mine = self.send(self.room, self.bob, "apple pie")
+        self.send(self.elsewhere, self.bob, "apple crumble")
+
+        self.assertEqual(self.found(self.alice, "apple"), [mine])
+        self.assertEqual(len(self.found(self.bob, "apple")), 2)
+
+    def test_deleted_and_cleared_messages_are_hidden(self):
+        cleared = self.send(self.room, self.bob, "apple before clearing")
+        clear_history(self.room.id, self.alice)
+        deleted = self.send(self.room, self.bob, "apple deleted for alice")
+        Message.objects.get(id=deleted).deleted_for.add(self.alice)
+        kept = self.send(self.room, self.bob, "apple still visible")
+
+        self.assertEqual(self.found(self.alice, "apple"), [kept])
+        self.assertEqual(sorted(self.found(self.bob, "apple")), [cleared, deleted, kept])
+
+    def test_query_count_does_not_grow_with_hits(self):
+        self.client.force_login(self.alice)
+
+        def queries():
+            with QueryCounter() as counter:
+                self.client.get(reverse("message_search"), {"q": "apple"})
+            return counter.total
+
+        self.send(self.room, self.bob, "apple")
+        one_hit = queries()
+        for sender in (self.alice, self.bob, self.alice):
+            self.send(self.room, sender, "apple")
+        self.assertEqual(queries(), one_hit)
+
+
+# =========================
+# MEMBERSHIP
+# =========================
+
+class MembershipTests(TransactionTestCase):
+    """
+    Rows are changed straight through the m2m tables, like another worker
+    would: this process's membership cache never hears of it.
+    """
+
+    def setUp(self):
+        clear_caches()
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        sync_inbox_entries(self.room.id)
+
+    def tearDown(self):
+        flush_writers()
+
+    def test_toggle_favorite_goes_by_the_database(self):
+        self.assertFalse(async_to_sync(ais_favorite)(self.room.id, self.alice.id))
+        ChatRoom.favorited_by.through.objects.create(chatroom=self.room, user=self.alice)
+
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse("toggle_favorite", args=[self.room.id]))
+        self.assertFalse(response.json()["is_favorite"])
+        self.assertFalse(self.room.favorited_by.filter(id=self.alice.id).exists())
+        self.assertFalse(InboxEntry.objects.get(chatroom=self.room, user=self.alice).is_favorite)
+
+        response = self.client.post(reverse("toggle_favorite", args=[self.room.id]))
+        self.assertTrue(response.json()["is_favorite"])
+        self.assertTrue(InboxEntry.objects.get(chatroom=self.room, user=self.alice).is_favorite)
+
+    def test_socket_refused_after_removal_elsewhere(self):
+        self.assertTrue(async_to_sync(ais_member)(self.room.id, self.alice.id))
+        ChatRoom.participants.through.objects.filter(chatroom=self.room, user=self.alice).delete()
+
+        alice = socket(self.alice, f"/ws/chat/{self.room.id}/")
+
+        async def run():
+            connected, _ = await alice.connect()
+            if connected:
+                await alice.disconnect()
+            return connected
+
+        self.assertFalse(async_to_sync(run)())
+
+
+# =========================
+# IN-MEMORY CHANNEL LAYER
+# =========================
+
+class FastInMemoryLayerTests(SimpleTestCase):
+
+    def fill(self, overflow, count=3):
+        """Send count messages to a channel holding two, then read what it kept"""
+        async def run():
+            layer = FastInMemoryChannelLayer(capacity=2, overflow=overflow)
+            for n in range(count):
+                await layer.send("test.channel", {"type": "test", "n": n})
+            kept = [(await layer.receive("test.channel"))["n"] for _ in range(min(count, 2))]
+            return kept, layer.stats()
+        return asyncio.run(run())
+
+    def test_error_policy_raises_channel_full(self):
+        with self.assertRaises(ChannelFull):
+            self.fill("error")
+        kept, stats = self.fill("error", count=2)
+        self.assertEqual(kept, [0, 1])
+        self.assertEqual(stats["channel_full"], 0)
+
+    def test_drop_oldest_keeps_the_newest(self):
+        kept, stats = self.fill("drop_oldest")
+        self.assertEqual(kept, [1, 2])
+        self.assertEqual(stats["dropped"], 1)
+
+    def test_drop_newest_keeps_the_oldest(self):
+        kept, stats = self.fill("drop_newest")
+        self.assertEqual(kept, [0, 1])
+        self.assertEqual(stats["dropped"], 1)
+
+    def test_unknown_policy_is_refused(self):
+        with self.assertRaises(ValueError):
+            FastInMemoryChannelLayer(overflow="block")
+
+    def test_group_send_many_reaches_each_channel_once(self):
+        async def run():
+            layer = FastInMemoryChannelLayer()
+            both, one = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add("user_1", both)
+            await layer.group_add("user_2", both)
+            await layer.group_add("user_2", one)
+
+            await layer.group_send_many(["user_1", "user_2"], {"type": "chat.notification"})
+            received = [await layer.receive(both), await layer.receive(one)]
+            return received, layer.stats()
+
+        received, stats = asyncio.run(run())
+        self.assertEqual(received, [{"type": "chat.notification"}] * 2)
+        self.assertEqual(stats["fanout_deliveries"], 2)
+        self.assertEqual(stats["queued"], 0)
+
+    def test_stale_membership_does_not_hide_a_live_one(self):
+        async def run():
+            layer = FastInMemoryChannelLayer(group_expiry=60)
+            channel = await layer.new_channel()
+            await layer.group_add("user_1", channel)
+            await layer.group_add("user_2", channel)
+            layer.groups["user_1"][channel] -= 120
+
+            await layer.group_send_many(["user_1", "user_2"], {"type": "chat.notification"})
+            return await asyncio.wait_for(layer.receive(channel), timeout=1), layer.channel_groups[channel]
+
+        message, groups = asyncio.run(run())
+        self.assertEqual(message, {"type": "chat.notification"})
+        self.assertEqual(groups, {"user_2"})
+
+
+# =========================
+# CHANNEL BROKER
+# =========================
+
+class BrokerReconnectTests(SimpleTestCase):
+
+    def test_groups_are_rejoined_after_a_broker_restart(self):
+        async def run(path):
+            broker = asyncio.create_task(ChannelBroker(path).serve())
+            layer = BrokerChannelLayer(path)
+            channel = await layer.new_channel()
+            await layer.group_add("room", channel)
+
+            # The broker dies with its groups; the worker's socket goes with it
+            broker.cancel()
+            await asyncio.gather(broker, return_exceptions=True)
+            layer._connections[asyncio.get_running_loop()].writer.transport.abort()
+            broker = asyncio.create_task(ChannelBroker(path).serve())
+
+            try:
+                await layer.group_send("room", {"type": "chat.message", "text": "still here"})
+                return await asyncio.wait_for(layer.receive(channel), timeout=5)
+            finally:
+                await layer.close()
+                broker.cancel()
+                await asyncio.gather(broker, return_exceptions=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            message = asyncio.run(run(os.path.join(tmp, "broker.sock")))
+        self.assertEqual(message, {"type": "chat.message", "text": "still here"})
+
+
+    def test_connections_of_finished_event_loops_are_closed(self):
+        async def run(path):
+            broker = asyncio.create_task(ChannelBroker(path).serve())
+            layer = BrokerChannelLayer(path)
+            try:
+                # Each like async_to_sync from a thread outside the ASGI server
+                await asyncio.to_thread(asyncio.run, layer.group_add("room", "specific.first"))
+                [first] = layer._connections.values()
+                await asyncio.to_thread(asyncio.run, layer.group_add("room", "specific.second"))
+                return first, list(layer._connections.values())
+            finally:
+                for conn in layer._connections.values():
+                    conn.close()
+                broker.cancel()
+                await asyncio.gather(broker, return_exceptions=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first, connections = asyncio.run(run(os.path.join(tmp, "broker.sock")))
+        self.assertNotIn(first, connections)
+        self.assertEqual(first.sock.fileno(), -1)
+
+
+class SharedPresenceTests(SimpleTestCase):
+    """Two BrokerChannelLayers on one broker stand in for two workers"""
+
+    def tearDown(self):
+        # The process-wide tracker counted these sockets too; no database to write last seen to
+        presence.last_seen._pending.clear()
+
+    def run_with_workers(self, scenario):
+        async def run(path):
+            broker = asyncio.create_task(ChannelBroker(path).serve())
+            first, second = BrokerChannelLayer(path), BrokerChannelLayer(path)
+            try:
+                return await scenario(first, second)
+            finally:
+                await first.close()
+                await second.close()
+                broker.cancel()
+                await asyncio.gather(broker, return_exceptions=True)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            return asyncio.run(run(os.path.join(tmp, "broker.sock")))
+
+    def test_offline_only_when_the_last_worker_lets_go(self):
+        async def scenario(first, second):
+            came_online = [await apresence_connect(first, 7), await apresence_connect(second, 7)]
+            went_offline = [await apresence_disconnect(first, 7)]
+            online_meanwhile = await aonline_user_ids(first, [7])
+            went_offline.append(await apresence_disconnect(second, 7))
+            return came_online, went_offline, online_meanwhile, await aonline_user_ids(first, [7])
+
+        came_online, went_offline, online_meanwhile, online_after = self.run_with_workers(scenario)
+        self.assertEqual(came_online, [True, False])
+        self.assertEqual(went_offline, [False, True])
+        self.assertEqual(online_meanwhile, {7})
+        self.assertEqual(online_after, set())
+
+    def test_sockets_of_a_lost_worker_stop_counting(self):
+        async def scenario(first, second):
+            for user_id in (8, 10, 11):
+                await apresence_connect(first, user_id)
+            await apresence_connect(second, 9)
+            before = await aonline_user_ids(second, [8, 9, 10, 11])
+            await first.close()  # the worker is gone, holding three users
+            await asyncio.sleep(0.05)
+            after = await aonline_user_ids(second, [8, 9, 10, 11])
+            for user_id in (8, 10, 11):
+                presence.disconnect(user_id)
+            await apresence_disconnect(second, 9)
+            return before, after
+
+        before, after = self.run_with_workers(scenario)
+        self.assertEqual(before, {8, 9, 10, 11})
+        self.assertEqual(after, {9})
+
+
+# =========================
+# USER DIRECTORY
+# =========================
+
+class UserDirectoryTests(TestCase):
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        UserInfo.objects.create(user=self.alice, name="Alice", email="alice@example.com", phone="1000000001")
+        invalidate_user_directory()
+
+    def test_login_keeps_the_autocomplete_cache(self):
+        autocomplete_users("ali")
+        Client().force_login(self.alice)  # saves last_login
+        self.assertIsNotNone(prefix_cache.get("ali"))
+
+    def test_prefix_matches_name_and_email_case_insensitively(self):
+        UserInfo.objects.create(
+            user=User.objects.create(username="bob"), name="Alibek", email="b@example.com", phone="1000000002"
+        )
+        self.assertEqual([u.username for u in find_users("ALI")], ["alice", "bob"])
+        self.assertEqual([u.username for u in find_users("alice@")], ["alice"])
+        self.assertEqual(find_users("alicf"), [])
+
+    def test_account_without_a_profile_is_found_by_username(self):
+        admin = User.objects.create(username="Alison")  # createsuperuser makes no UserInfo
+        self.assertEqual([u.username for u in find_users("ali")], ["alice", "Alison"])
+        self.assertEqual([r["username"] for r in autocomplete_users("alis")], ["Alison"])
+        self.assertEqual(find_users("ali", exclude_user_id=admin.id)[0].userinfo.name, "Alice")
+        self.assertEqual(find_users("alia"), [])
+
+    def test_rename_clears_the_autocomplete_cache(self):
+        autocomplete_users("ali")
+        self.alice.username = "alicia"
+        self.alice.save()
+        self.assertIsNone(prefix_cache.get("ali"))
+        self.assertEqual(UserInfo.objects.get(user=self.alice).username_key, "alicia")
+
+
+# =========================
+# ATTACHMENTS
+# =========================
+
+FILE = b"0123456789"
+
+
+class UploadTests(TransactionTestCase):
+    """Committing: uploads are read and written on executor threads"""
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.enterContext(override_settings(CHATIX_ATTACHMENT_ROOT=root.name, CHATIX_UPLOAD_CHUNK_SIZE=4))
+
+        self.alice = make_user("alice")
+        self.bob = make_user("bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+
+    def start(self, user, data=FILE, sha256=None):
+        client = Client()
+        client.force_login(user)
+        response = client.post(
+            reverse("start_upload", args=[self.room.id]),
+            json.dumps({
+                "filename": "notes.txt",
+                "size": len(data),
+                "sha256": sha256 or hashlib.sha256(data).hexdigest(),
+            }),
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201)
+        return client, reverse("upload_chunk", args=[response.json()["upload_id"]])
+
+    def patch(self, client, url, offset, chunk):
+        return client.patch(url, chunk, content_type="application/octet-stream", headers={"Upload-Offset": str(offset)})
+
+    def send(self, user, data=FILE):
+        client, url = self.start(user, data)
+        for offset in range(0, len(data), 4):
+            response = self.patch(client, url, offset, data[offset:offset + 4])
+        return response
+
+    def test_resume_after_a_dropped_chunk(self):
+        client, url = self.start(self.alice)
+        self.assertEqual(self.patch(client, url, 0, FILE[:4]).status_code, 200)
+
+        # The connection dropped; the client asks where to carry on
+        head = client.head(url)
+        self.assertEqual((head["Upload-Offset"], head["Upload-Chunk-Size"]), ("4", "4"))
+        # A retry of the chunk that did arrive is refused with the real offset
+        retry = self.patch(client, url, 0, FILE[:4])
+        self.assertEqual(retry.status_code, 409)
+        self.assertEqual(retry.json()["offset"], 4)
+
+        self.patch(client, url, 4, FILE[4:8])
+        attachment = self.patch(client, url, 8, FILE[8:]).json()["attachment"]
+
+        sha256 = hashlib.sha256(FILE).hexdigest()
+        with open(os.path.join(attachment_root(), blob_name(sha256)), "rb") as f:
+            self.assertEqual(f.read(), FILE)
+        self.assertEqual(Attachment.objects.get(id=attachment["id"]).blob.sha256, sha256)
+        self.assertFalse(Upload.objects.exists())
+
+    def test_same_bytes_share_one_blob(self):
+        first = self.send(self.alice).json()["attachment"]
+        second = self.send(self.bob).json()["attachment"]
+
+        self.assertNotEqual(first["id"], second["id"])
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(
+            Attachment.objects.get(id=first["id"]).blob_id, Attachment.objects.get(id=second["id"]).blob_id
+        )
+        # No part file left behind by the duplicate
+        self.assertEqual(os.listdir(os.path.dirname(part_path("x"))), [])
+
+    def test_reused_blob_survives_a_purge(self):
+        sha256 = hashlib.sha256(FILE).hexdigest()
+        self.send(self.alice)
+        Attachment.objects.all().delete()  # never sent, long ago
+        Blob.objects.update(created_at=timezone.now() - timedelta(days=2))
+
+        # The dedup check only runs once the Blob row is there (and locked)
+        move_to_blob = attachments._move_to_blob
+        seen = []
+
+        def checked_move(path, digest):
+            seen.append(Blob.objects.filter(sha256=digest).exists())
+            move_to_blob(path, digest)
+
+        with patch("chatix.attachments._move_to_blob", checked_move):
+            self.send(self.bob)
+        self.assertEqual(seen, [True])
+
+        path = os.path.join(attachment_root(), blob_name(sha256))
+        self.assertEqual(purge_stale_attachments(timedelta(hours=1)), (0, 0, 0))
+        self.assertTrue(os.path.exists(path))
+
+        Attachment.objects.all().delete()
+        self.assertEqual(purge_stale_attachments(timedelta(hours=1)), (0, 0, 1))
+        self.assertFalse(os.path.exists(path))
+
+    def test_hash_mismatch_is_refused(self):
+        client, url = self.start(self.alice, sha256="0" * 64)
+        self.patch(client, url, 0, FILE[:4])
+        self.patch(client, url, 4, FILE[4:8])
+        with self.assertLogs("chatix.attachments", "WARNING"):
+            self.assertEqual(self.patch(client, url, 8, FILE[8:]).status_code, 422)
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(Upload.objects.exists())
+
+
+# =========================
+# AVATAR THUMBNAILS
+# =========================
+
+def png(width, height):
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), "teal").save(buffer, "PNG")
+    return ContentFile(buffer.getvalue())
+
+
+class ThumbnailTests(TransactionTestCase):
+    """Committing: the write lane may store the result from its own thread"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+        self.info = make_user("alice").userinfo
+        self.info.image.save("alice.png", png(600, 400))
+
+    def test_every_size_rendered_square(self):
+        self.assertEqual(avatar_url(self.info, 48), self.info.image.url)  # original until then
+
+        self.assertTrue(generate_thumbnails(self.info.id, self.info.image.name))
+        self.info.refresh_from_db()
+        self.assertEqual(sorted(self.info.thumbnails), sorted(map(str, AVATAR_SIZES)))
+        for size, name in self.info.thumbnails.items():
+            with self.info.image.storage.open(name) as f:
+                self.assertEqual(Image.open(f).size, (int(size), int(size)))
+
+        storage = self.info.image.storage
+        self.assertEqual(avatar_url(self.info, 48), storage.url(self.info.thumbnails["48"]))
+        self.assertEqual(avatar_url(self.info, 120), storage.url(self.info.thumbnails["256"]))
+        self.assertEqual(avatar_url(self.info, 512), self.info.image.url)
+
+    def test_replaced_picture_keeps_its_own_thumbnails(self):
+        old = self.info.image.name
+        self.info.image.save("alice-new.png", png(300, 300))
+
+        self.assertFalse(generate_thumbnails(self.info.id, old))
+        self.info.refresh_from_db()
+        self.assertEqual(self.info.thumbnails, {})
+
+    def test_not_an_image(self):
+        self.info.image.save("alice.png", ContentFile(b"not a picture"))
+        with self.assertLogs("chatix.avatars", "WARNING"):
+            self.assertFalse(generate_thumbnails(self.info.id, self.info.image.name))
+
+
+# =========================
+# MEDIA SERVING
+# =========================
+
+MEDIA_FILE = bytes(range(100))
+
+
+class MediaServingTests(SimpleTestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+        for name in ("notes.bin", "backup.tar.gz"):
+            with open(os.path.join(media.name, name), "wb") as f:
+                f.write(MEDIA_FILE)
+
+    def get(self, path, **headers):
+        """(response, body) for GET /media/<path>"""
+        async def run():
+            response = await AsyncClient().get(f"/media/{path}", headers=headers)
+            if not response.streaming:
+                return response, response.content
+            return response, b"".join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(run)()
+
+    def test_unchanged_file_answers_304(self):
+        response, body = self.get("notes.bin")
+        self.assertEqual((response.status_code, body), (200, MEDIA_FILE))
+
+        again, body = self.get("notes.bin", if_none_match=response["ETag"])
+        self.assertEqual((again.status_code, body), (304, b""))
+        self.assertEqual(again["ETag"], response["ETag"])
+
+    def test_byte_ranges(self):
+        response, body = self.get("notes.bin", range="bytes=10-19")
+        self.assertEqual((response.status_code, body), (206, MEDIA_FILE[10:20]))
+        self.assertEqual(response["Content-Range"], "bytes 10-19/100")
+
+        response, body = self.get("notes.bin", range="bytes=-5")
+        self.assertEqual((response.status_code, body), (206, MEDIA_FILE[-5:]))
+
+        response, _ = self.get("notes.bin", range="bytes=100-")
+        self.assertEqual((response.status_code, response["Content-Range"]), (416, "bytes */100"))
+
+    def test_invalid_or_stale_range_serves_the_whole_file(self):
+        response, body = self.get("notes.bin", range="bytes=20-10")
+        self.assertEqual((response.status_code, body), (200, MEDIA_FILE))
+
+        response, body = self.get("notes.bin", range="bytes=0-9", if_range='"stale"')
+        self.assertEqual((response.status_code, body), (200, MEDIA_FILE))
+
+    def test_compressed_file_is_sent_as_is(self):
+        response, body = self.get("backup.tar.gz", range="bytes=0-9")
+        self.assertEqual(response["Content-Type"], "application/gzip")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(body, MEDIA_FILE[:10])
+
+
+# =========================
+# DATA MIGRATIONS
+# =========================
+
+def migration(name):
+    return importlib.import_module(f"chatix.migrations.{name}")
+
+
+class PairKeyBackfillTests(TestCase):
+    """0009 run against rooms as they were before pair keys"""
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+    def room(self, name, *members):
+        room = ChatRoom.objects.create(name=name)
+        room.participants.add(*members)
+        return room
+
+    def backfill(self):
+        migration("0009_backfill_chatroom_pair_key").backfill_pair_keys(apps, None)
+
+    def test_duplicate_rooms_are_folded_into_the_oldest(self):
+        keeper = self.room("alice & bob", self.alice, self.bob)
+        duplicate = self.room("bob & alice", self.bob, self.alice)
+        Message.objects.create(id=1, chatroom=duplicate, sender=self.bob, content="hi")
+
+        self.backfill()
+        keeper.refresh_from_db()
+        self.assertEqual(keeper.pair_key, ChatRoom.direct_pair_key(self.alice.id, self.bob.id))
+        self.assertFalse(ChatRoom.objects.filter(id=duplicate.id).exists())
+        self.assertEqual(Message.objects.get(id=1).chatroom_id, keeper.id)
+
+    def test_orphaned_room_is_not_merged_into_the_self_chat(self):
+        self_chat = self.room("alice & alice", self.alice)
+        orphan = self.room("alice & carol", self.alice)  # carol's account was deleted
+        Message.objects.create(id=1, chatroom=orphan, sender=self.alice, content="still mine")
+
+        self.backfill()
+        self_chat.refresh_from_db()
+        orphan.refresh_from_db()
+        self.assertEqual(self_chat.pair_key, ChatRoom.direct_pair_key(self.alice.id, self.alice.id))
+        self.assertIsNone(orphan.pair_key)
+        self.assertEqual(Message.objects.get(id=1).chatroom_id, orphan.id)
+
+
+class ClearWatermarkMigrationTests(TestCase):
+    """0011 run against rooms cleared the old way, one deleted_for row per message"""
+
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.room = ChatRoom.objects.create(name="alice & bob")
+        self.room.participants.add(self.alice, self.bob)
+        self.start = timezone.now() - timedelta(days=1)
+
+    def message(self, id, minute):
+        Message.objects.create(id=id, chatroom=self.room, sender=self.bob, content=f"m{id}")
+        # created_at is auto_now_add
+        Message.objects.filter(id=id).update(created_at=self.start + timedelta(minutes=minute))
+
+    def delete_for(self, user, *message_ids):
+        for message_id in message_ids:
+            Message.objects.get(id=message_id).deleted_for.add(user)
+
+    def migrate(self):
+        migration("0011_deleted_for_to_clear_watermark").deleted_for_to_watermarks(apps, None)
+
+    def deleted_for(self, user):
+        return set(Message.objects.filter(deleted_for=user).values_list("id", flat=True))
+
+    def test_leading_run_becomes_a_watermark(self):
+        for id in range(1, 6):
+            self.message(id, id)
+        self.delete_for(self.alice, 1, 2, 4)  # a clear, then one selective delete
+        self.delete_for(self.bob, 3)
+
+        self.migrate()
+        mark = ClearWatermark.objects.get(user=self.alice, chatroom=self.room)
+        self.assertEqual(mark.cleared_at, Message.objects.get(id=2).created_at)
+        self.assertEqual(self.deleted_for(self.alice), {4})
+        self.assertFalse(ClearWatermark.objects.filter(user=self.bob).exists())
+        self.assertEqual(self.deleted_for(self.bob), {3})
+        self.assertEqual(
+            [m.id for m in visible_messages(self.room.id, self.alice).order_by("id")], [3, 5]
+        )
+
+    def test_message_sharing_a_timestamp_with_a_visible_one_stays_selective(self):
+        self.message(1, 1)
+        self.message(2, 2)
+        self.message(3, 2)
+        self.delete_for(self.alice, 1, 2)
+
+        self.migrate()
+        mark = ClearWatermark.objects.get(user=self.alice, chatroom=self.room)
+        self.assertEqual(mark.cleared_at, Message.objects.get(id=1).created_at)
+        self.assertEqual(self.deleted_for(self.alice), {2})
+        self.assertEqual([m.id for m in visible_messages(self.room.id, self.alice)], [3])
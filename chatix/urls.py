@@ -3,10 +3,12 @@ from django.contrib.auth import views as auth_views
 
 from .views import (
     Login, register, logout_view, settings_view,
-    index, search, chatroom,
+    index, search, user_autocomplete, message_search, chatroom, message_history,
     add_user_to_chatroom,
+    start_upload, upload_chunk, attachment_file,
     delete_chatroom, delete_message,
-    favorites, toggle_favorite
+    favorites, toggle_favorite,
+    channel_layer_stats, db_pool_stats
 )
 
 urlpatterns = [
@@ -22,13 +24,22 @@ urlpatterns = [
 
     path("index/", index, name="index"),
     path("search/", search, name="search"),
+    path("search/users/", user_autocomplete, name="user_autocomplete"),
+    path("search/messages/", message_search, name="message_search"),
     path("favorites/", favorites, name="favorites"),
 
     path("chatroom/<int:id>/", chatroom, name="chatroom"),
+    path("chatroom/<int:id>/messages/", message_history, name="message_history"),
+    path("chatroom/<int:id>/uploads/", start_upload, name="start_upload"),
+    path("uploads/<uuid:upload_id>/", upload_chunk, name="upload_chunk"),
+    path("attachments/<int:attachment_id>/", attachment_file, name="attachment_file"),
     path("add-user/<int:user_id>/", add_user_to_chatroom, name="add_user_to_chatroom"),
 
     path("room/delete/<int:room_id>/", delete_chatroom, name="delete_chatroom"),
     path("room/toggle-favorite/<int:room_id>/", toggle_favorite, name="toggle_favorite"),
     path("delete-message/<int:msg_id>/", delete_message, name="delete_message"),
 
+    path("ops/channel-layer/", channel_layer_stats, name="channel_layer_stats"),
+    path("ops/db-pool/", db_pool_stats, name="db_pool_stats"),
+
 ]
@@ -0,0 +1,81 @@
+"""
+Version counters for cached pages and conditional GETs.
+
+Three kinds of counters live in the "fragments" cache (settings.CACHES):
+
+- room: bumped by every saved or deleted message of a room
+- visibility: one per (room, user), bumped when that user clears the chat
+  or hides single messages
+- inbox: one per user, bumped whenever one of their InboxEntry rows or a
+  peer's name / avatar changes
+
+A counter holds the time of its last bump in nanoseconds (+1 if the clock
+has not moved past the previous value), so it doubles as Last-Modified and
+a counter that was evicted and is created again never repeats an old
+value. Bumps run after the surrounding transaction commits, so a reader
+never stores or validates pre-commit rows under a post-commit version.
+"""
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+
+VERSION_CACHE = "fragments"
+
+
+def _cache():
+    return caches[VERSION_CACHE]
+
+
+def room_key(room_id):
+    return f"chatix:room-version:{room_id}"
+
+
+def visibility_key(room_id, user_id):
+    return f"chatix:visibility:{room_id}:{user_id}"
+
+
+def inbox_key(user_id):
+    return f"chatix:inbox-version:{user_id}"
+
+
+def _bump(keys):
+    cache = _cache()
+    current = cache.get_many(keys)
+    now = time.time_ns()
+    cache.set_many({key: max(now, current.get(key, 0) + 1) for key in keys}, None)
+
+
+def _bump_on_commit(keys):
+    if keys:
+        transaction.on_commit(lambda: _bump(keys))
+
+
+def bump_room_versions(room_ids):
+    """Everyone's cached history of these rooms is stale"""
+    _bump_on_commit([room_key(room_id) for room_id in set(room_ids)])
+
+
+def bump_visibility(room_id, user_ids):
+    """Only these users' cached history of the room is stale"""
+    _bump_on_commit([visibility_key(room_id, user_id) for user_id in set(user_ids)])
+
+
+def bump_inbox_versions(user_ids):
+    """These users' chat lists changed"""
+    _bump_on_commit([inbox_key(user_id) for user_id in set(user_ids)])
+
+
+async def aversions(keys):
+    """Current values of keys (created as "now" if missing), or None if they cannot be kept"""
+    cache = _cache()
+    versions = await cache.aget_many(keys)
+    if len(versions) < len(keys):
+        now = time.time_ns()
+        for key in keys:
+            if key not in versions:
+                await cache.aadd(key, now, None)
+        versions = await cache.aget_many(keys)
+        if len(versions) < len(keys):
+            return None  # evicted again straight away
+    return [versions[key] for key in keys]
@@ -1,14 +1,45 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import functools
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import JsonResponse
-from django.db.models import Q
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.db import transaction
+from django.db.models import prefetch_related_objects
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 
-from .models import ChatRoom, Message, UserInfo
+from .attachments import (
+    aappend_chunk, afinish_upload, max_attachment_size, serialize_attachment, serve_attachment,
+    upload_chunk_size
+)
+from .avatars import schedule_thumbnails
+from .db import database_sync_to_async, pool_stats
+from .models import Attachment, ChatRoom, InboxEntry, Message, Upload, UserInfo
+from .directory import afind_users, autocomplete_users
+from .fragments import aget_fragment, ahistory_key, aset_fragment
+from .membership import ais_member, is_member
+from .presence import ais_active
+from .search import SEARCH_MAX_PAGE_SIZE, SEARCH_PAGE_SIZE, search_messages
+from .services import (
+    HISTORY_MAX_PAGE_SIZE, HISTORY_PAGE_SIZE,
+    amessage_page, aread_cursor_of, clear_history, inbox_for, mark_inbox_read,
+    publish_room_changed, remove_message, serialize_message, toggle_favorite_flag
+)
+from .versions import (
+    aversions, bump_inbox_versions, bump_room_versions, inbox_key, room_key, visibility_key
+)
+from .writelane import database_write_to_async, write_lane
 
 
 # ---------- AUTH ----------
@@ -37,6 +68,7 @@ def Login(request):
     return render(request, "chatix/login.html")
 
 
+@write_lane
 def register(request):
     if request.method == "POST":
         username = request.POST.get("username", "").strip()
@@ -84,13 +116,14 @@ def register(request):
         )
 
         # ✅ Create UserInfo
-        UserInfo.objects.create(
+        user_info = UserInfo.objects.create(
             user=user,
             name=name,
             email=email,
             phone=phone,
             image=image
         )
+        schedule_thumbnails(user_info)
 
         messages.success(request, "Account created successfully. Please login.")
         return redirect("login")
@@ -99,6 +132,7 @@ def register(request):
 
 
 @login_required
+@write_lane
 def settings_view(request):
     if request.method == "POST":
         username = request.POST.get("username", "").strip()
@@ -130,7 +164,20 @@ def settings_view(request):
         user_info.email = email # Keep sync
         if image:
             user_info.image = image
+            user_info.thumbnails = {}  # the old picture's, until the new ones are rendered
         user_info.save()
+        if image:
+            schedule_thumbnails(user_info)
+
+        # Name / avatar show up in every cached history page of the user's rooms,
+        # in their peers' chat lists and in their own navbar
+        room_ids = list(user.chatrooms.values_list("id", flat=True))
+        bump_room_versions(room_ids)
+        bump_inbox_versions([user.id, *InboxEntry.objects.filter(peer=user).values_list("user_id", flat=True)])
+
+        # New avatar -> open chat sockets must drop their cached avatar URL
+        if image:
+            publish_room_changed(room_ids, user_id=user.id)
 
         messages.success(request, "Profile updated successfully")
         return redirect("settings")
@@ -143,94 +190,357 @@ def logout_view(request):
     return redirect("login")
 
 
+# ---------- ASYNC RENDERING ----------
+
+async def arender(request, template_name, context):
+    """render() for async views: everything the template reads must be loaded already"""
+    # base.html shows request.user and user.userinfo, which would otherwise query lazily
+    user = await request.auser()
+    request.user = await User.objects.select_related("userinfo").aget(pk=user.pk)
+    return render(request, template_name, context)
+
+
+def conditional(validators):
+    """
+    Conditional GET for async views. validators(request, ...) returns the
+    ETag parts and the version (ns) behind Last-Modified from cache
+    counters, or None to skip; a matching If-None-Match / If-Modified-Since
+    gets its 304 before the view runs any of its queries.
+
+    The session key and CSRF secret go into every ETag: logging in again
+    rotates both, so a page cached under the old session (with its stale
+    csrf token in the forms) is never revalidated into the new one.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            found = await validators(request, *args, **kwargs) if request.method in ("GET", "HEAD") else None
+            if found is None:
+                return await view(request, *args, **kwargs)
+
+            parts, version = found
+            parts = (*parts, request.session.session_key or "", request.META.get("CSRF_COOKIE", ""))
+            etag = '"%s"' % hashlib.sha1(":".join(map(str, parts)).encode()).hexdigest()
+            last_modified = version // 10**9
+
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                response.headers.setdefault("ETag", etag)
+                response.headers.setdefault("Last-Modified", http_date(last_modified))
+                # Per-user pages: browsers only, and always revalidated
+                patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+async def inbox_validators(request, *args, **kwargs):
+    user = await request.auser()
+    versions = await aversions([inbox_key(user.id)])
+    if versions is None:
+        return None
+    return (request.path, user.id, versions[0]), versions[0]
+
+
+async def history_validators(request, id):
+    user = await request.auser()
+    # Outsiders fall through to the view's 403
+    if not await ais_member(id, user.id):
+        return None
+    versions = await aversions([room_key(id), visibility_key(id, user.id)])
+    if versions is None:
+        return None
+    parts = ("history", id, user.id, *versions, request.GET.get("before", ""), request.GET.get("limit", ""))
+    return parts, max(versions)
+
+
 # ---------- DASHBOARD ----------
 
 @login_required
-def index(request):
-    from django.db.models import Max
-    chatrooms = ChatRoom.objects.filter(
-        participants=request.user
-    ).exclude(
-        hidden_for=request.user
-    ).annotate(
-        last_msg_time=Max('messages__created_at')
-    ).order_by('-last_msg_time')
-
-    return render(request, "chatix/index.html", {
-        "chatrooms": chatrooms
+@conditional(inbox_validators)
+async def index(request):
+    user = await request.auser()
+    # One scan of the user's inbox rows, no matter how many rooms they have
+    return await arender(request, "chatix/index.html", {
+        "entries": [entry async for entry in inbox_for(user)]
     })
 
 
 # ---------- SEARCH ----------
 
 @login_required
-def search(request):
+async def search(request):
+    user = await request.auser()
     query = request.GET.get("q", "")
     users = []
+    message_results, more_messages = [], False
 
     if query:
-        users = User.objects.filter(
-            Q(username__icontains=query) |
-            Q(userinfo__name__icontains=query) |
-            Q(userinfo__email__icontains=query)
-        ).exclude(id=request.user.id)
+        # Indexed prefix lookups, capped at SEARCH_LIMIT rows
+        users = await afind_users(query, exclude_user_id=user.id)
+        # Ranking runs raw SQL, which has no async cursor, so it takes the db executor
+        message_results, more_messages = await database_sync_to_async(search_messages)(user, query)
 
-    return render(request, "chatix/search.html", {
+    return await arender(request, "chatix/search.html", {
         "users": users,
-        "query": query
+        "query": query,
+        "message_results": message_results,
+        "more_messages": more_messages
+    })
+
+
+@login_required
+def user_autocomplete(request):
+    """Type-ahead for the people search box"""
+    return JsonResponse({
+        "status": "ok",
+        "results": autocomplete_users(request.GET.get("q", ""), exclude_user_id=request.user.id),
+    })
+
+
+@login_required
+def message_search(request):
+    """Ranked, paginated full-text search over the user's own chats"""
+    query = request.GET.get("q", "")
+
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+        limit = min(int(request.GET.get("limit", SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({"status": "invalid"}, status=400)
+
+    results, has_next = search_messages(request.user, query, page=page, page_size=limit)
+    prefetch_related_objects(results, "attachments")
+
+    return JsonResponse({
+        "status": "ok",
+        "page": page,
+        "has_next": has_next,
+        "results": [
+            {**serialize_message(msg), "room_id": msg.chatroom_id, "room_name": msg.chatroom.name}
+            for msg in results
+        ],
     })
 
 
 # ---------- CHAT ROOM ----------
 
 @login_required
-def chatroom(request, id):
-    room = get_object_or_404(ChatRoom, id=id)
+async def chatroom(request, id):
+    user = await request.auser()
+    room = await aget_object_or_404(ChatRoom, id=id)
 
-    if request.user not in room.participants.all():
+    if not await ais_member(room.id, user.id):
         return redirect("index")
 
-    messages_qs = room.messages.all().exclude(deleted_for=request.user)
-    
+    participants = [p async for p in room.participants.select_related("userinfo")]
+
+    # Newest page only, older history is fetched by message_history on scroll.
+    # Unchanged since the last render -> one cache hit instead of the query and template loop
+    key = await ahistory_key(room.id, user.id)
+    history = await aget_fragment(key) if key else None
+    if history is None:
+        messages_page, next_cursor = await amessage_page(room.id, user)
+        history = {
+            "html": render_to_string("chatix/message_list.html", {
+                "messages": messages_page,
+                "viewer": user,
+            }),
+            "next_cursor": next_cursor,
+            "last_message_id": messages_page[-1].id if messages_page else None,
+        }
+        if key:
+            await aset_fragment(key, history)
+
+    await database_write_to_async(mark_inbox_read)(room.id, user.id, history["last_message_id"])
+
     # Get the other user
     other_user = None
     is_active = False
-    for p in room.participants.all():
-        if p != request.user:
+    for p in participants:
+        if p != user:
             other_user = p
-            # Check if active (within 5 minutes)
-            if p.last_login:
-                from django.utils import timezone
-                from datetime import timedelta
-                is_active = (timezone.now() - p.last_login) < timedelta(minutes=5)
+            # Online via a socket, or seen within 5 minutes
+            is_active = await ais_active(get_channel_layer(), p)
             break
 
-    return render(request, "chatix/chatroom.html", {
+    # How far the other side has read, for the ✓✓ marker
+    peer_read_message_id = await aread_cursor_of(room.id, other_user.id) if other_user else None
+
+    return await arender(request, "chatix/chatroom.html", {
         "room": room,
-        "messages": messages_qs,
+        "participants": participants,
+        "history_html": mark_safe(history["html"]),
+        "next_cursor": history["next_cursor"],
         "other_user": other_user,
-        "is_active": is_active
+        "is_active": is_active,
+        "peer_read_message_id": peer_read_message_id
+    })
+
+
+@login_required
+@conditional(history_validators)
+async def message_history(request, id):
+    """Older messages for infinite scroll, keyset-paginated on (created_at, id)"""
+    user = await request.auser()
+
+    if not await ais_member(id, user.id):
+        await aget_object_or_404(ChatRoom, id=id)  # missing rooms stay a 404
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    try:
+        limit = min(int(request.GET.get("limit", HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE)
+        page, next_cursor = await amessage_page(
+            id, user, before=request.GET.get("before"), limit=max(limit, 1)
+        )
+    except ValueError:
+        return JsonResponse({"status": "invalid"}, status=400)
+
+    return JsonResponse({
+        "status": "ok",
+        "messages": [serialize_message(msg) for msg in page],
+        "next_cursor": next_cursor,
     })
 
 
+# ---------- ATTACHMENTS ----------
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+@login_required
+async def start_upload(request, id):
+    """Open a resumable upload of one file for the room (see chatix.attachments)"""
+    if request.method != "POST":
+        return JsonResponse({"status": "invalid"}, status=400)
+
+    user = await request.auser()
+    if not await ais_member(id, user.id):
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    # A few hundred bytes of JSON; the file itself only ever comes in chunks
+    try:
+        data = json.loads(request.body)
+        filename = os.path.basename(str(data["filename"]).replace("\\", "/")).strip()[:255]
+        size = int(data["size"])
+        sha256 = str(data.get("sha256") or "").lower()
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"status": "invalid"}, status=400)
+
+    if not filename or size <= 0 or (sha256 and not _SHA256_RE.match(sha256)):
+        return JsonResponse({"status": "invalid"}, status=400)
+    if size > max_attachment_size():
+        return JsonResponse({"status": "too_large", "max_size": max_attachment_size()}, status=413)
+
+    content_type = str(data.get("content_type") or "")[:100] or mimetypes.guess_type(filename)[0]
+    upload = await database_write_to_async(Upload.objects.create)(
+        user=user,
+        chatroom_id=id,
+        filename=filename,
+        content_type=content_type or "application/octet-stream",
+        size=size,
+        sha256=sha256,
+    )
+
+    return JsonResponse({
+        "status": "ok",
+        "upload_id": str(upload.id),
+        "offset": 0,
+        "chunk_size": upload_chunk_size(),
+    }, status=201)
+
+
+@login_required
+async def upload_chunk(request, upload_id):
+    """
+    HEAD / GET: how many bytes have arrived, to resume from.
+    PATCH with an Upload-Offset header: append the body at that offset; the
+    last chunk answers with the finished attachment.
+    """
+    user = await request.auser()
+    upload = await Upload.objects.filter(id=upload_id, user_id=user.id).afirst()
+    if upload is None:
+        raise Http404("No such upload")
+
+    if request.method in ("GET", "HEAD"):
+        return _upload_state(upload.offset, upload.size)
+    if request.method != "PATCH":
+        return JsonResponse({"status": "invalid"}, status=405, headers={"Allow": "GET, HEAD, PATCH"})
+
+    try:
+        offset = int(request.headers["Upload-Offset"])
+        length = int(request.headers["Content-Length"])
+    except (KeyError, ValueError):
+        return JsonResponse({"status": "invalid"}, status=400)
+
+    if offset != upload.offset:
+        return _upload_state(upload.offset, upload.size, status="conflict", http_status=409)
+    if length <= 0 or length > min(upload_chunk_size(), upload.size - offset):
+        return JsonResponse({"status": "too_large", "chunk_size": upload_chunk_size()}, status=413)
+
+    # The request is read as a stream, straight onto disk
+    new_offset = await aappend_chunk(upload, request, offset, length)
+    if new_offset is None:
+        upload = await Upload.objects.filter(id=upload_id).afirst()
+        if upload is None:
+            raise Http404("No such upload")
+        return _upload_state(upload.offset, upload.size, status="conflict", http_status=409)
+    if new_offset < upload.size:
+        return _upload_state(new_offset, upload.size)
+
+    attachment = await afinish_upload(upload)
+    if attachment is None:
+        return JsonResponse({"status": "hash_mismatch"}, status=422)
+
+    return _upload_state(new_offset, upload.size, attachment=serialize_attachment(attachment))
+
+
+def _upload_state(offset, size, status="ok", http_status=200, **extra):
+    return JsonResponse(
+        {"status": status, "offset": offset, "size": size, **extra},
+        status=http_status,
+        # HEAD has no body: a resuming client learns the chunk size from here
+        headers={
+            "Upload-Offset": str(offset),
+            "Upload-Chunk-Size": str(upload_chunk_size()),
+            "Cache-Control": "no-store",
+        },
+    )
+
+
+@login_required
+async def attachment_file(request, attachment_id):
+    """Download an attachment, for members of its room only"""
+    user = await request.auser()
+    attachment = await aget_object_or_404(Attachment.objects.select_related("blob"), id=attachment_id)
+
+    # Not sent yet: only its uploader knows it exists
+    if attachment.message_id is None and attachment.uploader_id != user.id:
+        raise Http404("No such attachment")
+    if not await ais_member(attachment.chatroom_id, user.id):
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    return await serve_attachment(request, attachment)
+
+
 # ---------- CREATE / OPEN CHAT ----------
 
 @login_required
+@write_lane
 def add_user_to_chatroom(request, user_id):
     receiver = get_object_or_404(User, id=user_id)
     sender = request.user
 
-    chatroom = ChatRoom.objects.filter(
-        participants=sender
-    ).filter(
-        participants=receiver
-    ).first()
-
-    if not chatroom:
-        chatroom = ChatRoom.objects.create(
-            name=f"{sender.username} & {receiver.username}"
+    # One indexed lookup on the canonical pair key, unique so it cannot race into duplicates
+    with transaction.atomic():
+        chatroom, created = ChatRoom.objects.get_or_create(
+            pair_key=ChatRoom.direct_pair_key(sender.id, receiver.id),
+            defaults={"name": f"{sender.username} & {receiver.username}"}
         )
-        chatroom.participants.add(sender, receiver)
+        if created:
+            chatroom.participants.add(sender, receiver)
 
     chatroom.hidden_for.remove(sender)
     return redirect("chatroom", chatroom.id)
@@ -239,13 +549,20 @@ def add_user_to_chatroom(request, user_id):
 # ---------- DELETE CHAT (FOR ME ONLY) ----------
 
 @login_required
+@write_lane
 def delete_chatroom(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id)
-    room.hidden_for.add(request.user)
-    
-    # Also hide all messages for this user
-    for msg in room.messages.all():
-        msg.deleted_for.add(request.user)
+    if not is_member(room.id, request.user.id):
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    with transaction.atomic():
+        room.hidden_for.add(request.user)
+        mark_inbox_read(room.id, request.user.id)
+
+        # Also hide all messages for this user: one watermark row, not one per message
+        clear_history(room.id, request.user)
+
+    publish_room_changed([room.id], user_id=request.user.id)
 
     return JsonResponse({"status": "ok"})
 
@@ -253,20 +570,22 @@ def delete_chatroom(request, room_id):
 # ---------- DELETE MESSAGE (FIXED & WORKING) ----------
 
 @login_required
-def delete_message(request, msg_id):
+async def delete_message(request, msg_id):
     if request.method != "POST":
         return JsonResponse({"status": "invalid"}, status=400)
 
-    msg = get_object_or_404(Message, id=msg_id)
+    user = await request.auser()
+    msg = await aget_object_or_404(Message, id=msg_id)
 
-    if msg.sender != request.user and not request.user.is_superuser:
+    if msg.sender_id != user.id and not user.is_superuser:
         return JsonResponse({"status": "forbidden"}, status=403)
 
-    room_id = msg.chatroom.id
-    msg.delete()
+    room_id = msg.chatroom_id
+    # Transactions are sync only; on the writer lane when it is on
+    await database_write_to_async(remove_message)(msg)
 
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
+    await channel_layer.group_send(
         f"chat_{room_id}",
         {
             "type": "message_deleted",
@@ -280,31 +599,51 @@ def delete_message(request, msg_id):
 # ---------- FAVORITES ----------
 
 @login_required
-def favorites(request):
+@conditional(inbox_validators)
+async def favorites(request):
     """View all favorite chats"""
-    favorite_rooms = ChatRoom.objects.filter(
-        favorited_by=request.user,
-        participants=request.user
-    ).exclude(hidden_for=request.user)
-    
-    return render(request, "chatix/favorites.html", {
-        "chatrooms": favorite_rooms
+    user = await request.auser()
+    return await arender(request, "chatix/favorites.html", {
+        "entries": [entry async for entry in inbox_for(user, favorites=True)]
     })
 
 
 @login_required
-def toggle_favorite(request, room_id):
+async def toggle_favorite(request, room_id):
     """Toggle favorite status of a chat"""
-    room = get_object_or_404(ChatRoom, id=room_id)
+    user = await request.auser()
+    room = await aget_object_or_404(ChatRoom, id=room_id)
     
-    if request.user not in room.participants.all():
+    if not await ais_member(room.id, user.id):
         return JsonResponse({"status": "forbidden"}, status=403)
     
-    if request.user in room.favorited_by.all():
-        room.favorited_by.remove(request.user)
-        is_favorite = False
-    else:
-        room.favorited_by.add(request.user)
-        is_favorite = True
+    # Decided by the database, not the cached flag (another worker may have changed it)
+    is_favorite = await database_write_to_async(toggle_favorite_flag)(room, user)
     
-    return JsonResponse({"status": "ok", "is_favorite": is_favorite})
\ No newline at end of file
+    return JsonResponse({"status": "ok", "is_favorite": is_favorite})
+
+
+# ---------- OPS ----------
+
+@login_required
+async def channel_layer_stats(request):
+    """Channel layer counters (queue depth, drops, fan-out time) for staff"""
+    user = await request.auser()
+    if not user.is_staff:
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    # Async so the counters are read on the event loop that updates them
+    channel_layer = get_channel_layer()
+    if not hasattr(channel_layer, "stats"):
+        return JsonResponse({"status": "unsupported"}, status=404)
+
+    return JsonResponse({"status": "ok", "stats": channel_layer.stats()})
+
+
+@login_required
+def db_pool_stats(request):
+    """Database executor and connection pool counters for staff"""
+    if not request.user.is_staff:
+        return JsonResponse({"status": "forbidden"}, status=403)
+
+    return JsonResponse({"status": "ok", "stats": pool_stats()})
@@ -0,0 +1,325 @@
+"""
+Write-behind message persistence.
+
+Every Message.id, written behind or not, comes from this process's
+MessageIdAllocator (next_message_id), so ids grow with time across all
+workers and never collide with an autoincrement value.
+
+With CHATIX_WRITE_BEHIND on, ChatConsumer no longer waits for an INSERT
+before broadcasting. Each message is broadcast immediately and queued here; the queue is flushed with
+bulk_create once it holds CHATIX_WRITE_BEHIND_BATCH_SIZE messages or
+CHATIX_WRITE_BEHIND_INTERVAL seconds have passed, whichever comes first.
+
+created_at is stamped when the batch is written, so it can trail the
+broadcast by up to one flush interval. Order within a process is kept.
+"""
+import asyncio
+import atexit
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.db import DataError, IntegrityError
+from django.utils import timezone
+
+from .writelane import database_write_to_async
+
+logger = logging.getLogger(__name__)
+
+
+# =========================
+# ID ALLOCATOR
+# =========================
+class MessageIdAllocator:
+    """
+    Snowflake-style ids that fit in 53 bits, so browsers can still hold
+    them as plain JS numbers:
+
+        41 bits milliseconds since EPOCH_MS | 4 bits worker | 8 bits sequence
+
+    Ids are unique per worker and grow with time. Every message gets one
+    (next_message_id), so the table's autoincrement is never used and ids
+    stay ordered across workers.
+    """
+    EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+    WORKER_BITS = 4
+    SEQUENCE_BITS = 8
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id % (1 << self.WORKER_BITS)
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = max(int(time.time() * 1000) - self.EPOCH_MS, self._last_ms)
+
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+
+            self._last_ms = now_ms
+            return (
+                (now_ms << (self.WORKER_BITS + self.SEQUENCE_BITS))
+                | (self.worker_id << self.SEQUENCE_BITS)
+                | self._sequence
+            )
+
+
+_allocator = None
+_allocator_lock = threading.Lock()
+_worker_lock_files = []
+
+
+def next_message_id():
+    """Id for a new Message; the only place message ids come from"""
+    global _allocator
+    if _allocator is None:
+        with _allocator_lock:
+            if _allocator is None:
+                worker_id = getattr(settings, "CHATIX_WORKER_ID", None)
+                if worker_id is None:
+                    worker_id = _claim_worker_id()
+                _allocator = MessageIdAllocator(worker_id)
+    return _allocator.next_id()
+
+
+def _claim_worker_id():
+    """
+    A worker id no other process on this host holds: an exclusive flock on
+    one of 16 lock files, kept until the process exits. Workers on several
+    hosts need CHATIX_WORKER_ID instead.
+    """
+    lock_dir = getattr(settings, "CHATIX_WORKER_LOCK_DIR", None) or tempfile.gettempdir()
+    for worker_id in range(1 << MessageIdAllocator.WORKER_BITS):
+        handle = open(os.path.join(lock_dir, f"chatix-worker-{worker_id}.lock"), "a")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            continue
+        _worker_lock_files.append(handle)
+        return worker_id
+    raise RuntimeError(
+        "All %d message id worker slots are taken; set CHATIX_WORKER_ID" % (1 << MessageIdAllocator.WORKER_BITS)
+    )
+
+
+# =========================
+# WRITE-BEHIND QUEUE
+# =========================
+class MessageWriteBehind:
+    """In-process queue of unsaved messages, flushed in batches"""
+
+    def __init__(self, batch_size=200, interval=0.25,
+                 retry_delay=0.5, max_retry_delay=30.0):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def submit(self, room_id, user, content, participant_ids):
+        """Queue a message and return what the consumer needs to broadcast it"""
+        from .models import Message
+        from .services import clean_message_content
+
+        # A row the INSERT refuses would hold up every message behind it
+        if clean_message_content(content) is None:
+            raise ValueError("Write-behind message content must be a non-empty string")
+
+        msg = Message(
+            id=next_message_id(),
+            chatroom_id=room_id,
+            sender=user,
+            content=content,
+        )
+        with self._lock:
+            self._pending.append((msg, list(participant_ids)))
+            size = len(self._pending)
+
+        self._ensure_flusher()
+        if size >= self.batch_size:
+            self._wakeup.set()
+
+        return {
+            "message_id": msg.id,
+            "created_at": timezone.now(),
+        }
+
+    # ---------- FLUSHING ----------
+
+    def _ensure_flusher(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run())
+
+    async def _run(self):
+        delay = self.retry_delay
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            while self._pending:
+                try:
+                    await database_write_to_async(self._flush_once)()
+                except Exception:
+                    logger.exception(
+                        "Write-behind flush failed, %d messages pending; retrying in %.1fs",
+                        len(self._pending), delay
+                    )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.max_retry_delay)
+                    break
+                delay = self.retry_delay
+
+    def _take_batch(self):
+        with self._lock:
+            count = min(self.batch_size, len(self._pending))
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _put_back(self, batch):
+        with self._lock:
+            self._pending.extendleft(reversed(batch))
+
+    def _flush_once(self):
+        from .services import persist_messages
+
+        batch = self._take_batch()
+        if not batch:
+            return
+        try:
+            try:
+                persist_messages(batch)
+            except (DataError, IntegrityError):
+                # Usually a room deleted while its messages were queued, or a
+                # retry of a batch that was stored before its error surfaced
+                batch = _drop_stored(_drop_deleted_rooms(batch))
+                try:
+                    if batch:
+                        persist_messages(batch)
+                except (DataError, IntegrityError):
+                    # Still refused: some row can never be written. Find it one
+                    # row at a time rather than retrying the whole batch forever
+                    _persist_each(batch)
+        except Exception:
+            self._put_back(batch)
+            raise
+
+    def flush(self):
+        """Write everything still queued (shutdown path, runs synchronously)"""
+        while self._pending:
+            self._flush_once()
+
+
+def _persist_each(batch):
+    """
+    Write the batch one message per transaction, dropping messages the
+    database refuses. Written messages leave the list as they go, so on a
+    connection error only the rest is put back.
+    """
+    from .services import persist_messages
+
+    while batch:
+        msg, participant_ids = batch[0]
+        try:
+            persist_messages([(msg, participant_ids)])
+        except (DataError, IntegrityError) as exc:
+            logger.error(
+                "Write-behind dropped message %d from user %s in room %s: %s",
+                msg.id, msg.sender_id, msg.chatroom_id, exc
+            )
+        batch.pop(0)
+
+
+def _drop_deleted_rooms(batch):
+    from .models import ChatRoom
+
+    room_ids = {msg.chatroom_id for msg, _ in batch}
+    alive = set(ChatRoom.objects.filter(id__in=room_ids).values_list("id", flat=True))
+    dropped = len(batch)
+    batch = [entry for entry in batch if entry[0].chatroom_id in alive]
+    dropped -= len(batch)
+    if dropped:
+        logger.warning("Write-behind dropped %d messages for deleted rooms", dropped)
+    return batch
+
+
+def _drop_stored(batch):
+    from .models import Message
+
+    stored = {
+        row["id"]: row
+        for row in Message.objects.filter(id__in=[msg.id for msg, _ in batch]).values(
+            "id", "chatroom_id", "sender_id", "content"
+        )
+    }
+    kept = []
+    for msg, participant_ids in batch:
+        row = stored.get(msg.id)
+        if row is None:
+            kept.append((msg, participant_ids))
+        elif (row["chatroom_id"], row["sender_id"], row["content"]) != (msg.chatroom_id, msg.sender_id, msg.content):
+            # Two workers with the same CHATIX_WORKER_ID; the message was already broadcast
+            logger.error(
+                "Write-behind message id %d is taken by another message; dropped message from user %s in room %s",
+                msg.id, msg.sender_id, msg.chatroom_id
+            )
+    return kept
+
+
+# =========================
+# PROCESS-WIDE INSTANCE
+# =========================
+_write_behind = None
+_init_lock = threading.Lock()
+
+
+def write_behind_enabled():
+    return getattr(settings, "CHATIX_WRITE_BEHIND", False)
+
+
+def get_write_behind():
+    global _write_behind
+    if _write_behind is None:
+        with _init_lock:
+            if _write_behind is None:
+                _write_behind = MessageWriteBehind(
+                    batch_size=getattr(settings, "CHATIX_WRITE_BEHIND_BATCH_SIZE", 200),
+                    interval=getattr(settings, "CHATIX_WRITE_BEHIND_INTERVAL", 0.25),
+                )
+                atexit.register(_flush_at_exit)
+    return _write_behind
+
+
+def _flush_at_exit():
+    if _write_behind is None or not len(_write_behind):
+        return
+    try:
+        _write_behind.flush()
+    except Exception:
+        logger.exception("Write-behind lost %d messages at shutdown", len(_write_behind))
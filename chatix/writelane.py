@@ -0,0 +1,82 @@
+"""
+Single writer lane for SQLite.
+
+SQLite takes one writer at a time. When database_sync_to_async threads,
+flushers and views all write at once they queue on the file lock, and the
+losers fail with "database is locked". With CHATIX_SQLITE_WRITE_LANE on,
+chatix's write paths run on one dedicated thread with one long-lived
+connection instead. Writes are applied back to back and reads stay on the
+normal threads (WAL lets them run next to the writer).
+
+With the lane off (the default, and always on PostgreSQL) everything below
+simply calls straight through.
+
+Writes Django does on its own, like session saves and last_login on login,
+stay outside the lane; busy_timeout and IMMEDIATE transactions cover those.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .db import database_sync_to_async
+
+_THREAD_PREFIX = "chatix-writer"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def lane_enabled():
+    return getattr(settings, "CHATIX_SQLITE_WRITE_LANE", False)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=_THREAD_PREFIX)
+        return _executor
+
+
+def _on_lane():
+    return threading.current_thread().name.startswith(_THREAD_PREFIX)
+
+
+def _call(fn, args, kwargs):
+    # Same connection hygiene as database_sync_to_async, on the lane's own connection
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+def run_write(fn, *args, **kwargs):
+    """Run fn on the writer thread and wait for its result"""
+    if not lane_enabled() or _on_lane():
+        return fn(*args, **kwargs)
+    return _get_executor().submit(_call, fn, args, kwargs).result()
+
+
+def write_lane(fn):
+    """Decorator for sync code that writes, e.g. a whole view"""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return run_write(fn, *args, **kwargs)
+    return wrapper
+
+
+def database_write_to_async(fn):
+    """database_sync_to_async for writes: runs on the writer thread when the lane is on"""
+    default = database_sync_to_async(fn)
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if not lane_enabled():
+            return await default(*args, **kwargs)
+        return await asyncio.wrap_future(_get_executor().submit(_call, fn, args, kwargs))
+    return wrapper